@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+Set the portal capability of existing membership purposes from their
+legacy codes and names. Purposes with a capability are left untouched.
+"""
+import logging
+from odoo import api, SUPERUSER_ID
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {'lang': 'en_US'})
+    Purpose = env['agency.membership.purpose'].with_context(active_test=False)
+    purposes = Purpose.search([('capability', '=', False)])
+    for purpose in purposes:
+        capability = Purpose._guess_capability(purpose.code, purpose.name)
+        if capability:
+            purpose.capability = capability
+    _logger.info(f"Set the portal capability of {len(purposes)} membership purposes")
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import ValidationError
 
 
@@ -85,6 +85,33 @@ class Agency(models.Model):
         tracking=True
     )
 
+    # Portal capabilities derived from membership purposes.
+    # An agency without any purpose keeps access to every feature but contracts.
+    has_sales = fields.Boolean(
+        string='Sales Enabled',
+        compute='_compute_capabilities',
+        store=True,
+        index=True
+    )
+    has_bonus = fields.Boolean(
+        string='Bonus Enabled',
+        compute='_compute_capabilities',
+        store=True,
+        index=True
+    )
+    has_tickets = fields.Boolean(
+        string='Tickets Enabled',
+        compute='_compute_capabilities',
+        store=True,
+        index=True
+    )
+    has_contract = fields.Boolean(
+        string='Contract Enabled',
+        compute='_compute_capabilities',
+        store=True,
+        index=True
+    )
+
     preferred_language = fields.Selection([
         ('tr', 'Turkish'),
         ('en', 'English'),
@@ -220,6 +247,17 @@ class Agency(models.Model):
         for agency in self:
             agency.user_count = len(agency.agency_user_ids.filtered('active'))
 
+    @api.depends('membership_purpose_ids.capability', 'membership_purpose_ids.active')
+    def _compute_capabilities(self):
+        """Compute portal capability flags from membership purposes"""
+        for agency in self:
+            purposes = agency.membership_purpose_ids
+            capabilities = set(purposes.mapped('capability'))
+            agency.has_sales = not purposes or 'sales' in capabilities
+            agency.has_bonus = not purposes or 'bonus' in capabilities
+            agency.has_tickets = not purposes or 'tickets' in capabilities
+            agency.has_contract = 'contract' in capabilities
+
     def _compute_statistics(self):
         """Compute agency statistics - override in extensions"""
         for agency in self:
@@ -379,6 +417,38 @@ class Agency(models.Model):
 
         return master_user
 
+    # ==================== Portal Profile ====================
+
+    def _get_portal_profile(self, write_date=None):
+        """Get the portal profile dictionary of this agency.
+
+        The profile is served from a worker-level cache keyed on the agency
+        ``write_date``, so any write on the agency yields a fresh entry.
+        Membership purpose changes clear the cache explicitly. Callers that
+        already fetched ``write_date`` may pass it to skip reading the record.
+        """
+        self.ensure_one()
+        write_date = write_date or self.write_date
+        profile = dict(self._get_portal_profile_cached(self.id, write_date, self.env.lang))
+        profile['membership_purposes'] = list(profile['membership_purposes'])
+        return profile
+
+    @tools.ormcache('agency_id', 'write_date', 'lang')
+    def _get_portal_profile_cached(self, agency_id, write_date, lang):
+        """Build the portal profile, cached per (agency, write_date, lang)"""
+        agency = self.sudo().with_context(lang=lang).browse(agency_id)
+        return {
+            'id': agency.id,
+            'name': agency.name,
+            'partner_id': agency.partner_id.id or None,
+            'membership_purposes': tuple(agency.membership_purpose_ids.mapped('name')),
+            'has_bonus': agency.has_bonus,
+            'has_sales': agency.has_sales,
+            'has_tickets': agency.has_tickets,
+            'has_contract': agency.has_contract,
+            'default_language': agency.default_language or None,
+        }
+
     def get_active_users(self):
         """Get active agency users"""
         return self.agency_user_ids.filtered('active')
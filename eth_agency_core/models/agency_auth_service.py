@@ -98,6 +98,73 @@ class AgencyAuthService(models.Model):
             _logger.error(f"Token validation error: {str(e)}")
             return {'success': False, 'message': 'Token validation failed'}
 
+    def get_portal_context(self, token):
+        """Load user, permissions and agency settings for a portal token
+
+        User and agency columns are fetched in a single joined query; the
+        agency profile itself comes from the travel.agency portal profile
+        cache. Returns None when the token is unknown or expired.
+        """
+        if not token:
+            return None
+
+        self.env['agency.user'].flush_model()
+        self.env['travel.agency'].flush_model()
+        self.env.cr.execute("""
+            SELECT u.id, u.name, u.email, u.phone, u.address, u.country_id, u.city_id,
+                   u.is_master, u.can_create_users, u.can_manage_bookings,
+                   u.can_view_reports, u.can_manage_agency, u.token_expiry,
+                   a.id, a.name, a.write_date, a.commission_type, a.commission_percentage
+              FROM agency_user u
+              JOIN travel_agency a ON a.id = u.agency_id
+             WHERE u.login_token = %s AND u.active
+             LIMIT 1
+        """, [token])
+        row = self.env.cr.fetchone()
+        if not row:
+            return None
+
+        (user_id, name, email, phone, address, country_id, city_id,
+         is_master, can_create_users, can_manage_bookings,
+         can_view_reports, can_manage_agency, token_expiry,
+         agency_id, agency_name, agency_write_date,
+         commission_type, commission_percentage) = row
+
+        if not token_expiry or datetime.now() > token_expiry:
+            self.env['agency.user'].browse(user_id).invalidate_token()
+            return None
+
+        permissions = {
+            'can_create_users': can_create_users,
+            'can_manage_bookings': can_manage_bookings,
+            'can_view_reports': can_view_reports,
+            'can_manage_agency': can_manage_agency,
+            'is_master': is_master,
+        }
+        country = self.env['res.country'].browse(country_id) if country_id else None
+        city = self.env['res.country.state'].browse(city_id) if city_id else None
+
+        return {
+            'user_id': user_id,
+            'user_data': {
+                'id': user_id,
+                'name': name,
+                'email': email,
+                'phone': phone,
+                'country_id': [country.id, country.name] if country else None,
+                'city_id': [city.id, city.name] if city else None,
+                'address': address,
+                'agency_id': agency_id,
+                'agency_name': agency_name,
+                'is_master': is_master,
+                'permissions': permissions,
+            },
+            'permissions': permissions,
+            'agency': self.env['travel.agency'].browse(agency_id)._get_portal_profile(agency_write_date),
+            'commission_type': commission_type or 'gross',
+            'commission_percentage': commission_percentage or 0.0,
+        }
+
     def logout_user(self, token):
         """Logout user by invalidating token"""
         try:
@@ -14,7 +14,51 @@ class AgencyMembershipPurpose(models.Model):
     description = fields.Text(string='Description', translate=True)
     icon = fields.Char(string='Icon', help='Icon class for display (e.g., fa-shopping-cart)')
     color = fields.Integer(string='Color Index', default=0)
+    capability = fields.Selection([
+        ('sales', 'Sales'),
+        ('bonus', 'Bonus'),
+        ('tickets', 'Tickets'),
+        ('contract', 'Contract'),
+    ], string='Portal Capability', index=True,
+        help='Portal feature unlocked for agencies having this purpose')
 
     _sql_constraints = [
         ('code_unique', 'UNIQUE(code)', 'Purpose code must be unique!')
     ]
+
+    # Legacy purpose codes and names mapped to capabilities
+    _CAPABILITY_ALIASES = {
+        'sales': ('SALES', 'Sales', 'Satış'),
+        'bonus': ('BONUS', 'Bonus'),
+        'tickets': ('TICKET', 'Ticket', 'Tickets', 'Ticket Sales', 'Bilet'),
+        'contract': ('CONTRACT', 'Contract', 'Sözleşme', 'Stop Sales'),
+    }
+
+    @api.model
+    def _guess_capability(self, code, name=None):
+        """Capability of a legacy purpose code or name, if any"""
+        return next((
+            capability for capability, aliases in self._CAPABILITY_ALIASES.items()
+            if code in aliases or (name and name in aliases)
+        ), False)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        for vals in vals_list:
+            # Set once on creation, afterwards only changed explicitly
+            if 'capability' not in vals:
+                vals['capability'] = self._guess_capability(vals.get('code'), vals.get('name'))
+        purposes = super(AgencyMembershipPurpose, self).create(vals_list)
+        # Agency portal profiles embed purpose names, see travel.agency
+        self.env.registry.clear_cache()
+        return purposes
+
+    def write(self, vals):
+        res = super(AgencyMembershipPurpose, self).write(vals)
+        self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        res = super(AgencyMembershipPurpose, self).unlink()
+        self.env.registry.clear_cache()
+        return res
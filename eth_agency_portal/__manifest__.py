@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 {
     'name': 'Agency Portal',
-    'version': '18.0.1.0.0',
+    'version': '18.0.1.3.0',
     'category': 'Website',
     'summary': 'Agency self-service portal',
     'description': """
@@ -32,6 +32,9 @@ This module provides a complete portal interface for agency users.
     'data': [
         'security/ir.model.access.csv',
         'data/portal_config_data.xml',
+        'data/ticket_hold_cron.xml',
+        'data/ticket_sales_rollup_cron.xml',
+        'data/report_job_cron.xml',
         # New templates (eth_travel_agency_web style)
         'templates/auth_templates.xml',
         'templates/base_templates.xml',
@@ -51,6 +54,7 @@ This module provides a complete portal interface for agency users.
         'views/portal_profile.xml',
         'views/portal_registration.xml',
         'views/portal_login.xml',
+        'views/portal_performance_views.xml',
     ],
     'assets': {
         'web.assets_frontend': [
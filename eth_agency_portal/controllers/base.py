@@ -1,36 +1,50 @@
 # -*- coding: utf-8 -*-
 import logging
 import functools
+import psycopg2.errors
+from collections import namedtuple
+from types import MappingProxyType
 from odoo import http, _
 from odoo.http import request
 
 _logger = logging.getLogger(__name__)
 
+# Errors of concurrent transactions; handlers re-raise them so that Odoo
+# retries the request on a fresh transaction instead of reporting them
+CONCURRENCY_ERRORS = (
+    psycopg2.errors.SerializationFailure,
+    psycopg2.errors.LockNotAvailable,
+    psycopg2.errors.DeadlockDetected,
+)
+
 
 class LanguageManager:
-    """Centralized language management with caching"""
+    """Centralized language management with caching
 
-    _cache = {
-        'languages': None,
-        'translations': {},
-    }
+    Language lists and translatable terms are cached per database and
+    language by the agency.portal.language model.
+    """
 
     @classmethod
     def get_available_languages(cls):
         """Get available languages with caching"""
-        if cls._cache['languages'] is None:
-            langs = request.env['res.lang'].sudo().search([('active', '=', True)])
-            cls._cache['languages'] = [(lang.code, lang.name) for lang in langs]
-        return cls._cache['languages']
+        return request.env['agency.portal.language'].sudo().get_available_languages()
+
+    @classmethod
+    def get_translatable_terms(cls, lang):
+        """Get precomputed translatable terms for a language"""
+        return request.env['agency.portal.language'].sudo().get_translatable_terms(lang)
 
     @classmethod
-    def get_current_language(cls):
+    def get_current_language(cls, agency_lang=None):
         """
         Get current language with CORRECT priority:
         1. Session (user's explicit choice) - HIGHEST PRIORITY
         2. Cookie (frontend_lang) - for website persistence
         3. Agency default (if no session preference)
         4. System default (fallback)
+
+        ``agency_lang`` is the already loaded agency default, if any.
         """
         # 1. CHECK SESSION FIRST (user's explicit choice)
         session_lang = request.session.get('agency_lang')
@@ -50,6 +64,8 @@ class LanguageManager:
             _logger.debug(f"Error reading cookie: {str(e)}")
 
         # 3. Check agency default (only if no session preference)
+        if agency_lang:
+            return agency_lang
         try:
             agency_id = request.session.get('agency_id')
             if agency_id:
@@ -101,20 +117,19 @@ class LanguageManager:
     @classmethod
     def clear_cache(cls):
         """Clear language cache"""
-        cls._cache = {'languages': None, 'translations': {}}
+        request.env.registry.clear_cache()
 
 
-def require_auth(redirect_url='/agency/login'):
-    """Decorator to require authentication"""
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(self, *args, **kwargs):
-            if not request.session.get('agency_token'):
-                _logger.info(f"Unauthorized access attempt to {func.__name__}")
-                return request.redirect(redirect_url)
-            return func(self, *args, **kwargs)
-        return wrapper
-    return decorator
+def _apply_language(lang):
+    """Set the request context and website language"""
+    request.update_context(lang=lang)
+
+    # Also set frontend_lang for website templates
+    if hasattr(request, 'frontend_lang'):
+        request.frontend_lang = lang
+
+    # Force env to use the language
+    request.env = request.env(context=dict(request.env.context, lang=lang))
 
 
 def auto_language(func):
@@ -129,14 +144,7 @@ def auto_language(func):
             current_lang = LanguageManager.get_current_language()
 
             # ALWAYS set context to current language
-            request.update_context(lang=current_lang)
-
-            # Also set frontend_lang for website templates
-            if hasattr(request, 'frontend_lang'):
-                request.frontend_lang = current_lang
-
-            # Force env to use the language
-            request.env = request.env(context=dict(request.env.context, lang=current_lang))
+            _apply_language(current_lang)
 
             _logger.debug(f"auto_language: Set context to {current_lang}")
 
@@ -148,6 +156,42 @@ def auto_language(func):
     return wrapper
 
 
+class AgencyContext(namedtuple('AgencyContext', [
+    'token', 'user_id', 'user', 'permissions',
+    'agency_id', 'agency', 'commission_type', 'commission_percentage', 'lang',
+])):
+    """Immutable per-request context of the authenticated agency user"""
+    __slots__ = ()
+
+    def has_permission(self, permission):
+        """Check a user permission (no permission system means allowed)"""
+        if not self.permissions:
+            return True
+        return self.permissions.get(permission, False)
+
+
+def agency_context(redirect_url='/agency/login'):
+    """
+    Decorator requiring an authenticated agency user.
+    Loads user, permissions, agency and language once, sets the request
+    language and passes the AgencyContext to the handler after self.
+    Unauthenticated JSON requests get an 'Unauthorized' error result.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            ctx = self._get_agency_context()
+            if not ctx:
+                _logger.info(f"Unauthorized access attempt to {func.__name__}")
+                if request.dispatcher.routing_type == 'json':
+                    return {'success': False, 'error': 'Unauthorized'}
+                return request.redirect(redirect_url)
+            kwargs.pop('ctx', None)
+            return func(self, ctx, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class AgencyPortalBase(http.Controller):
     """Base controller with common methods"""
 
@@ -157,6 +201,50 @@ class AgencyPortalBase(http.Controller):
         """Check if user is authenticated"""
         return bool(request.session.get('agency_token'))
 
+    def _get_agency_context(self):
+        """Get the agency request context, loaded once per request"""
+        if not hasattr(request, '_agency_context'):
+            request._agency_context = self._load_agency_context()
+        return request._agency_context
+
+    def _load_agency_context(self):
+        """Load user, agency and language in one pass and seed request caches"""
+        token = request.session.get('agency_token')
+        if not token:
+            return None
+
+        try:
+            data = request.env['agency.auth.service'].sudo().get_portal_context(token)
+        except Exception as e:
+            _logger.error(f"Error loading agency context: {str(e)}")
+            return None
+
+        if not data:
+            _logger.warning("Agency context: token invalid or expired")
+            self._clear_session()
+            return None
+
+        agency = data['agency']
+        lang = LanguageManager.get_current_language(agency_lang=agency.get('default_language'))
+        _apply_language(lang)
+
+        # Seed the per-request caches used by the helper methods below
+        request._cached_user_data = dict(data['user_data'], permissions=dict(data['permissions']))
+        request._cached_agency_data = dict(agency)
+
+        user = dict(data['user_data'], permissions=MappingProxyType(data['permissions']))
+        return AgencyContext(
+            token=token,
+            user_id=data['user_id'],
+            user=MappingProxyType(user),
+            permissions=MappingProxyType(data['permissions']),
+            agency_id=agency['id'],
+            agency=MappingProxyType(agency),
+            commission_type=data['commission_type'],
+            commission_percentage=data['commission_percentage'],
+            lang=lang,
+        )
+
     def _get_current_user(self):
         """Get current user data with caching in request"""
         if not hasattr(request, '_cached_user_data'):
@@ -221,7 +309,7 @@ class AgencyPortalBase(http.Controller):
     # ==================== Agency Methods ====================
 
     def _get_agency_data(self, agency_id=None):
-        """Get agency data with caching"""
+        """Get agency data with request and worker-level caching"""
         if not hasattr(request, '_cached_agency_data'):
             try:
                 if not agency_id:
@@ -238,23 +326,10 @@ class AgencyPortalBase(http.Controller):
                     request._cached_agency_data = None
                     return None
 
-                # Get membership purposes
-                membership_purposes = []
-                if agency.membership_purpose_ids:
-                    membership_purposes = agency.membership_purpose_ids.mapped('name')
-
-                request._cached_agency_data = {
-                    'id': agency.id,
-                    'name': agency.name,
-                    'partner_id': agency.partner_id.id if agency.partner_id else None,
-                    'membership_purposes': membership_purposes,
-                    'has_bonus': not membership_purposes or 'Bonus' in membership_purposes,
-                    'has_sales': not membership_purposes or 'Sales' in membership_purposes or 'Satış' in membership_purposes,
-                    'has_tickets': not membership_purposes or 'Ticket' in membership_purposes or 'Tickets' in membership_purposes or 'Ticket Sales' in membership_purposes or 'Bilet' in membership_purposes,
-                    'default_language': agency.default_language if hasattr(agency, 'default_language') else None,
-                }
+                # Profile is cached across requests, keyed on write_date
+                request._cached_agency_data = agency._get_portal_profile()
 
-                _logger.debug(f"Agency data loaded: {agency.name}")
+                _logger.debug(f"Agency data loaded: {agency_id}")
 
             except Exception as e:
                 _logger.error(f"Error getting agency data: {str(e)}")
@@ -262,6 +337,39 @@ class AgencyPortalBase(http.Controller):
 
         return request._cached_agency_data
 
+    # ==================== Capabilities ====================
+
+    def _has_capability(self, capability):
+        """Check an optional model or field, computed once per registry"""
+        return request.env['agency.portal.capabilities'].get(capability)
+
+    # ==================== Ticket Cart ====================
+
+    def _get_ticket_cart(self, create=True):
+        """Get the server-side ticket cart of the current agency user"""
+        Cart = request.env['agency.ticket.cart'].sudo()
+        ctx = self._get_agency_context()
+        if not ctx:
+            return Cart
+        return Cart._get_user_cart(ctx.user_id, ctx.agency_id, create=create)
+
+    def _get_agency_order(self, order_id, agency_data):
+        """Get an order of the agency, or an empty recordset"""
+        return request.env['sale.order'].sudo().search([
+            ('id', '=', int(order_id)),
+            ('portal_agency_id', '=', agency_data['id']),
+        ], limit=1)
+
+    def _cart_conflict_response(self, cart):
+        """Result for a cart change made on a stale cart version"""
+        return {
+            'success': False,
+            'conflict': True,
+            'error': _('The cart was changed in another window.'),
+            'cart': cart.to_dict(),
+            'visitors': cart.get_visitors(),
+        }
+
     # ==================== Template Preparation ====================
 
     def _prepare_values(self, **kwargs):
@@ -269,17 +377,16 @@ class AgencyPortalBase(http.Controller):
         try:
             user_data = self._get_current_user()
             agency_data = self._get_agency_data()
-            current_lang = LanguageManager.get_current_language()
-
-            # Get translatable terms for JavaScript
-            translatable_terms = self._get_translatable_terms()
+            # Routes under agency_context already resolved the language
+            ctx = getattr(request, '_agency_context', None)
+            current_lang = ctx.lang if ctx else LanguageManager.get_current_language()
 
             custom_values = {
                 'user_data': user_data,
                 'agency_data': agency_data,
                 'current_language': current_lang,
                 'available_languages': LanguageManager.get_available_languages(),
-                'translatable_terms': translatable_terms,
+                'translatable_terms': self._get_translatable_terms(current_lang),
                 '_': _,
             }
 
@@ -298,30 +405,9 @@ class AgencyPortalBase(http.Controller):
                 **kwargs
             }
 
-    def _get_translatable_terms(self):
+    def _get_translatable_terms(self, lang=None):
         """Get common translatable terms for templates"""
-        return {
-            'dashboard': _('Dashboard'),
-            'users': _('Users'),
-            'settings': _('Settings'),
-            'logout': _('Logout'),
-            'reports': _('Reports'),
-            'bookings': _('Bookings'),
-            'bonus': _('Bonus'),
-            'tickets': _('Tickets'),
-            'messages': _('Messages'),
-            'announcements': _('Announcements'),
-            'save': _('Save'),
-            'cancel': _('Cancel'),
-            'confirm': _('Confirm'),
-            'delete': _('Delete'),
-            'edit': _('Edit'),
-            'view': _('View'),
-            'loading': _('Loading...'),
-            'error': _('Error'),
-            'success': _('Success'),
-            'warning': _('Warning'),
-        }
+        return LanguageManager.get_translatable_terms(lang or LanguageManager.get_current_language())
 
     # ==================== Language Routes ====================
 
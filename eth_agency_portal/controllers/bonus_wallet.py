@@ -2,7 +2,7 @@
 import logging
 from odoo import http, fields, _
 from odoo.http import request
-from .base import AgencyPortalBase, require_auth, auto_language
+from .base import AgencyPortalBase, agency_context
 from datetime import datetime, timedelta
 
 _logger = logging.getLogger(__name__)
@@ -12,13 +12,12 @@ class BonusWalletController(AgencyPortalBase):
     """Bonus wallet management controllers - uses Travel API"""
 
     @http.route('/agency/bonus-wallet', type='http', auth="public", website=True, csrf=False)
-    @require_auth()
-    @auto_language
-    def bonus_wallet(self, **kw):
+    @agency_context()
+    def bonus_wallet(self, ctx, **kw):
         """Main bonus wallet page"""
         try:
-            agency_data = self._get_agency_data()
-            user_data = self._get_current_user()
+            agency_data = ctx.agency
+            user_data = ctx.user
 
             # Check if agency has Bonus purpose
             if not agency_data or not agency_data.get('has_bonus', False):
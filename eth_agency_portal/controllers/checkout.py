@@ -3,12 +3,12 @@
 Checkout Controller for Agency Portal
 Handles billing address, payment selection, and order creation
 """
-import copy
 import logging
 from datetime import datetime
 from odoo import http, _
 from odoo.http import request
-from .base import AgencyPortalBase
+from odoo.exceptions import UserError
+from .base import AgencyPortalBase, agency_context, CONCURRENCY_ERRORS
 
 _logger = logging.getLogger(__name__)
 
@@ -16,82 +16,31 @@ _logger = logging.getLogger(__name__)
 class CheckoutController(AgencyPortalBase):
     """Checkout flow controllers"""
 
-    def _get_checkout_key(self):
-        """Get session key for checkout data"""
-        agency_data = self._get_agency_data()
-        agency_id = agency_data.get('id', 0) if agency_data else 0
-        return f'ticket_checkout_{agency_id}'
-
     def _get_checkout_data(self):
-        """Get checkout data from session"""
-        key = self._get_checkout_key()
-        data = request.session.get(key, {})
-        _logger.info(f"[CHECKOUT-GET] key={key}, has_billing={bool(data.get('billing_address'))}, keys={list(data.keys())}")
-        return data
-
-    def _save_checkout_data(self, data):
-        """Save checkout data to session"""
-        # Deep copy to ensure session detects change
-        data_copy = copy.deepcopy(data)
-        key = self._get_checkout_key()
-        request.session[key] = data_copy
-        request.session.modified = True
-        _logger.info(f"[CHECKOUT-SAVE] key={key}, has_billing={bool(data_copy.get('billing_address'))}, keys={list(data_copy.keys())}")
-
-    def _clear_checkout_data(self):
-        """Clear checkout data from session"""
-        request.session.pop(self._get_checkout_key(), None)
-
-    def _get_cart_key(self):
-        """Get session key for ticket cart"""
-        agency_data = self._get_agency_data()
-        agency_id = agency_data.get('id', 0) if agency_data else 0
-        return f'ticket_cart_{agency_id}'
-
-    def _get_cart(self):
-        """Get cart from session"""
-        return request.session.get(self._get_cart_key(), {'lines': [], 'visit_date': None, 'total': 0})
-
-    def _clear_cart(self):
-        """Clear cart from session"""
-        request.session.pop(self._get_cart_key(), None)
-
-    def _get_visitors_key(self):
-        """Get session key for visitors"""
-        agency_data = self._get_agency_data()
-        agency_id = agency_data.get('id', 0) if agency_data else 0
-        return f'ticket_visitors_{agency_id}'
-
-    def _get_visitors(self):
-        """Get visitors from session"""
-        return request.session.get(self._get_visitors_key(), [])
-
-    def _clear_visitors(self):
-        """Clear visitors from session"""
-        request.session.pop(self._get_visitors_key(), None)
+        """Get checkout data of the current ticket cart"""
+        return self._get_ticket_cart(create=False).get_checkout_data()
 
     # ==================== API Endpoints ====================
 
     @http.route('/agency/api/tickets/checkout/prepare', type='json', auth='public', methods=['POST'], csrf=False)
-    def prepare_checkout(self, cart=None, visitors=None, **kw):
-        """Prepare checkout - save cart and visitors to session"""
+    @agency_context()
+    def prepare_checkout(self, ctx, **kw):
+        """Prepare checkout - the server-side cart and visitors are checked out as is"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
-            if not cart or not cart.get('lines'):
+            cart = self._get_ticket_cart(create=False)
+            if not cart or not cart.line_ids:
                 return {'success': False, 'error': 'Cart is empty'}
 
-            # Save cart and visitors to checkout session
-            checkout_data = {
-                'cart': cart,
-                'visitors': visitors or [],
-                'prepared_at': datetime.now().isoformat()
-            }
-            self._save_checkout_data(checkout_data)
+            cart.prepare_checkout()
 
             return {'success': True}
 
+        except CONCURRENCY_ERRORS:
+            # Retried by Odoo, then held or sold out
+            raise
+        except UserError as e:
+            # Tickets no longer available
+            return {'success': False, 'error': str(e)}
         except Exception as e:
             _logger.error(f"Error preparing checkout: {str(e)}", exc_info=True)
             return {'success': False, 'error': str(e)}
@@ -99,12 +48,10 @@ class CheckoutController(AgencyPortalBase):
     # ==================== Billing Address Page ====================
 
     @http.route('/agency/tickets/checkout/billing', type='http', auth="public", website=True, csrf=False)
-    def billing_address_page(self, **kw):
+    @agency_context()
+    def billing_address_page(self, ctx, **kw):
         """Billing address page"""
         try:
-            if not self._is_authenticated():
-                return request.redirect('/agency/login')
-
             checkout_data = self._get_checkout_data()
             if not checkout_data or not checkout_data.get('cart', {}).get('lines'):
                 return request.redirect('/agency/tickets')
@@ -113,7 +60,7 @@ class CheckoutController(AgencyPortalBase):
             visitors = checkout_data.get('visitors', [])
 
             # Get countries for dropdown
-            countries = request.env['res.country'].sudo().search([], order='name')
+            countries = request.env['agency.portal.lookup'].get_countries()
 
             values = self._prepare_values(
                 page_name='checkout_billing',
@@ -148,21 +95,18 @@ class CheckoutController(AgencyPortalBase):
             return {'success': False, 'error': str(e)}
 
     @http.route('/agency/api/tickets/checkout/billing/save', type='json', auth='public', methods=['POST'], csrf=False)
-    def save_billing_address(self, billing_data=None, **kw):
+    @agency_context()
+    def save_billing_address(self, ctx, billing_data=None, **kw):
         """Save billing address"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
             if not billing_data:
                 return {'success': False, 'error': 'No billing data provided'}
 
-            checkout_data = self._get_checkout_data()
-            if not checkout_data:
+            cart = self._get_ticket_cart(create=False)
+            if not cart or not cart.checkout_prepared_at:
                 return {'success': False, 'error': 'Checkout session expired'}
 
-            checkout_data['billing_address'] = billing_data
-            self._save_checkout_data(checkout_data)
+            cart.write({'billing_address': billing_data})
 
             return {'success': True}
 
@@ -173,12 +117,10 @@ class CheckoutController(AgencyPortalBase):
     # ==================== Payment Page ====================
 
     @http.route('/agency/tickets/checkout/payment', type='http', auth="public", website=True, csrf=False)
-    def payment_page(self, **kw):
+    @agency_context()
+    def payment_page(self, ctx, **kw):
         """Payment method selection page"""
         try:
-            if not self._is_authenticated():
-                return request.redirect('/agency/login')
-
             checkout_data = self._get_checkout_data()
             if not checkout_data or not checkout_data.get('cart', {}).get('lines'):
                 return request.redirect('/agency/tickets')
@@ -194,11 +136,8 @@ class CheckoutController(AgencyPortalBase):
             # Get available payment providers (check if payment module is installed)
             payment_providers = []
             try:
-                if 'payment.provider' in request.env:
-                    payment_providers = request.env['payment.provider'].sudo().search([
-                        ('state', '=', 'enabled'),
-                        ('is_published', '=', True)
-                    ])
+                if self._has_capability('payment_provider'):
+                    payment_providers = request.env['agency.portal.lookup'].get_payment_providers()
             except Exception as e:
                 _logger.warning(f"Payment module not available: {str(e)}")
 
@@ -207,7 +146,8 @@ class CheckoutController(AgencyPortalBase):
                 cart=cart,
                 visitors=visitors,
                 billing_address=billing_address,
-                payment_providers=payment_providers
+                payment_providers=payment_providers,
+                checkout_key=checkout_data.get('checkout_key'),
             )
             return request.render('eth_agency_portal.agency_checkout_payment', values)
 
@@ -218,57 +158,76 @@ class CheckoutController(AgencyPortalBase):
     # ==================== Bank Transfer (Havale) ====================
 
     @http.route('/agency/api/tickets/checkout/bank-transfer', type='json', auth='public', methods=['POST'], csrf=False)
-    def process_bank_transfer(self, billing_data=None, **kw):
+    @agency_context()
+    def process_bank_transfer(self, ctx, billing_data=None, checkout_key=None, **kw):
         """Process bank transfer order"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
+            agency_data = ctx.agency
 
-            agency_data = self._get_agency_data()
-            if not agency_data:
-                return {'success': False, 'error': 'Agency not found'}
+            cart_record = self._get_ticket_cart(create=False)
+            checkout_key, replayed = self._get_checkout_replay(ctx, cart_record, checkout_key)
+            if replayed:
+                # Retried submission, the order already exists
+                return replayed
 
-            checkout_data = self._get_checkout_data()
+            checkout_data = cart_record.get_checkout_data()
             if not checkout_data:
                 return {'success': False, 'error': 'Checkout session expired'}
+            if checkout_data.get('checkout_key') != checkout_key:
+                return {'success': False, 'error': 'The cart was changed, please review your order'}
 
             cart = checkout_data.get('cart', {})
             visitors = checkout_data.get('visitors', [])
-            # Use billing_data from frontend if provided (localStorage), fallback to session
+            # Use billing_data from frontend if provided (localStorage), fallback to the cart
             billing_address = billing_data if billing_data else checkout_data.get('billing_address', {})
 
             if not cart.get('lines'):
                 return {'success': False, 'error': 'Cart is empty'}
 
-            # Create or find partner from billing address
-            partner = self._get_or_create_partner(billing_address, agency_data)
+            # All or nothing: a failed step undoes the stock reservation
+            with request.env.cr.savepoint():
+                # Claim the key first, a concurrent duplicate waits here and
+                # is retried once the first commits, then replays its response
+                checkout_request, replayed = request.env['agency.checkout.request'].sudo().claim(
+                    checkout_key, ctx.user_id, 'bank_transfer')
+                if replayed:
+                    return replayed
+
+                # Reserve stock first so sold-out dates fail before any order work
+                # Note: For bank transfer, we reserve stock immediately but order stays in draft until payment
+                self._update_inventory(cart, cart_record.id)
+
+                # Create or find partner from billing address
+                partner = self._get_or_create_partner(billing_address, agency_data)
+
+                # Create the sale order
+                order = self._create_sale_order(cart, partner, agency_data, 'bank_transfer')
+                if not order:
+                    raise UserError(_('Failed to create order'))
+
+                # Save visitors to order (as order notes or custom field)
+                self._save_order_visitors(order, visitors)
+
+                result = {
+                    'success': True,
+                    'order_id': order.id,
+                    'order_name': order.name,
+                    'amount_total': order.amount_total,
+                    'payment_method': 'bank_transfer'
+                }
+                checkout_request.set_response(order, result)
 
-            # Create the sale order
-            order = self._create_sale_order(cart, partner, agency_data, 'bank_transfer')
+            # Clear cart, visitors and checkout state
+            cart_record.clear()
 
-            if not order:
-                return {'success': False, 'error': 'Failed to create order'}
-
-            # Save visitors to order (as order notes or custom field)
-            self._save_order_visitors(order, visitors)
-
-            # Update inventory (reserve stock for bank transfer - will be confirmed when payment received)
-            # Note: For bank transfer, we reserve stock immediately but order stays in draft until payment
-            self._update_inventory(cart)
-
-            # Clear checkout session
-            self._clear_checkout_data()
-            self._clear_cart()
-            self._clear_visitors()
-
-            return {
-                'success': True,
-                'order_id': order.id,
-                'order_name': order.name,
-                'amount_total': order.amount_total,
-                'payment_method': 'bank_transfer'
-            }
+            return result
 
+        except CONCURRENCY_ERRORS:
+            # Retried by Odoo, then sold out or ordered
+            raise
+        except UserError as e:
+            # Sold out or order not created, nothing was written
+            return {'success': False, 'error': str(e)}
         except Exception as e:
             _logger.error(f"Error processing bank transfer: {str(e)}", exc_info=True)
             return {'success': False, 'error': str(e)}
@@ -276,23 +235,27 @@ class CheckoutController(AgencyPortalBase):
     # ==================== Credit Card Payment ====================
 
     @http.route('/agency/api/tickets/checkout/credit-card', type='json', auth='public', methods=['POST'], csrf=False)
-    def process_credit_card(self, provider_id=None, billing_data=None, **kw):
+    @agency_context()
+    def process_credit_card(self, ctx, provider_id=None, billing_data=None, checkout_key=None, **kw):
         """Initialize credit card payment"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
+            agency_data = ctx.agency
 
-            agency_data = self._get_agency_data()
-            if not agency_data:
-                return {'success': False, 'error': 'Agency not found'}
+            cart_record = self._get_ticket_cart(create=False)
+            checkout_key, replayed = self._get_checkout_replay(ctx, cart_record, checkout_key)
+            if replayed:
+                # Retried submission, the order already exists
+                return replayed
 
-            checkout_data = self._get_checkout_data()
+            checkout_data = cart_record.get_checkout_data()
             if not checkout_data:
                 return {'success': False, 'error': 'Checkout session expired'}
+            if checkout_data.get('checkout_key') != checkout_key:
+                return {'success': False, 'error': 'The cart was changed, please review your order'}
 
             cart = checkout_data.get('cart', {})
             visitors = checkout_data.get('visitors', [])
-            # Use billing_data from frontend if provided (localStorage), fallback to session
+            # Use billing_data from frontend if provided (localStorage), fallback to the cart
             billing_address = billing_data if billing_data else checkout_data.get('billing_address', {})
 
             if not cart.get('lines'):
@@ -301,49 +264,79 @@ class CheckoutController(AgencyPortalBase):
             if not provider_id:
                 return {'success': False, 'error': 'Payment provider not selected'}
 
-            # Create or find partner from billing address
-            partner = self._get_or_create_partner(billing_address, agency_data)
+            if not self._has_capability('payment_provider'):
+                return {'success': False, 'error': 'Payment module not available'}
 
-            # Create the sale order
-            order = self._create_sale_order(cart, partner, agency_data, 'credit_card')
-
-            if not order:
-                return {'success': False, 'error': 'Failed to create order'}
-
-            # Save visitors to order
-            self._save_order_visitors(order, visitors)
+            # Get payment provider, one of those offered on the payment page
+            provider_ids = {p.id for p in request.env['agency.portal.lookup'].get_payment_providers()}
+            if int(provider_id) not in provider_ids:
+                return {'success': False, 'error': 'Invalid payment provider'}
+            provider = request.env['payment.provider'].sudo().browse(int(provider_id))
 
-            # Update inventory
-            self._update_inventory(cart)
+            # All or nothing: a failed step undoes the stock reservation
+            with request.env.cr.savepoint():
+                # Claim the key first, a concurrent duplicate waits here and
+                # is retried once the first commits, then replays its response
+                checkout_request, replayed = request.env['agency.checkout.request'].sudo().claim(
+                    checkout_key, ctx.user_id, 'credit_card')
+                if replayed:
+                    return replayed
+
+                # Reserve stock first so sold-out dates fail before any order work
+                self._update_inventory(cart, cart_record.id)
+
+                # Create or find partner from billing address
+                partner = self._get_or_create_partner(billing_address, agency_data)
+
+                # Create the sale order
+                order = self._create_sale_order(cart, partner, agency_data, 'credit_card')
+                if not order:
+                    raise UserError(_('Failed to create order'))
+
+                # Save visitors to order
+                self._save_order_visitors(order, visitors)
+
+                # Create payment transaction
+                transaction = self._create_payment_transaction(order, provider)
+
+                result = {
+                    'success': True,
+                    'order_id': order.id,
+                    'order_name': order.name,
+                    'amount_total': order.amount_total,
+                    'transaction_id': transaction.id if transaction else None,
+                    'payment_url': f'/agency/tickets/checkout/pay/{order.id}'
+                }
+                checkout_request.set_response(order, result)
 
-            # Get payment provider
-            provider = request.env['payment.provider'].sudo().browse(int(provider_id))
-            if not provider.exists():
-                return {'success': False, 'error': 'Invalid payment provider'}
+            # Clear cart, visitors and checkout state
+            cart_record.clear()
 
-            # Create payment transaction
-            transaction = self._create_payment_transaction(order, provider)
-
-            # Clear checkout session
-            self._clear_checkout_data()
-            self._clear_cart()
-            self._clear_visitors()
-
-            return {
-                'success': True,
-                'order_id': order.id,
-                'order_name': order.name,
-                'amount_total': order.amount_total,
-                'transaction_id': transaction.id if transaction else None,
-                'payment_url': f'/agency/tickets/checkout/pay/{order.id}'
-            }
+            return result
 
+        except CONCURRENCY_ERRORS:
+            # Retried by Odoo, then sold out or ordered
+            raise
+        except UserError as e:
+            # Sold out or order not created, nothing was written
+            return {'success': False, 'error': str(e)}
         except Exception as e:
             _logger.error(f"Error processing credit card: {str(e)}", exc_info=True)
             return {'success': False, 'error': str(e)}
 
     # ==================== Helper Methods ====================
 
+    def _get_checkout_replay(self, ctx, cart, checkout_key=None):
+        """Get the idempotency key of a checkout submission and the stored
+        response when it was already processed.
+
+        The key is sent by the payment page, or derived from the cart for
+        clients that do not send it.
+        """
+        checkout_key = checkout_key or cart.get_checkout_key()
+        replayed = request.env['agency.checkout.request'].sudo().get_response(checkout_key, ctx.user_id)
+        return checkout_key, replayed
+
     def _get_or_create_partner(self, billing_address, agency_data):
         """Get or create partner from billing address"""
         Partner = request.env['res.partner'].sudo()
@@ -398,111 +391,81 @@ class CheckoutController(AgencyPortalBase):
             visit_date = cart.get('visit_date')
 
             # Get agency for commission settings
-            agency = request.env['travel.agency'].sudo().browse(agency_data.get('id'))
-            commission_type = 'gross'
-            commission_percentage = 0.0
-
-            # Safely get commission settings
-            try:
-                if agency.exists() and hasattr(agency, 'commission_type'):
-                    commission_type = agency.commission_type or 'gross'
-                if agency.exists() and hasattr(agency, 'commission_percentage'):
-                    commission_percentage = agency.commission_percentage or 0.0
-            except Exception:
-                pass
+            agency = request.env['travel.agency'].sudo().browse(agency_data.get('id')).exists()
+            commission_type = agency.commission_type or 'gross'
+            commission_percentage = agency.commission_percentage or 0.0
 
             # Find EUR pricelist to match ticket prices
-            eur_currency = request.env['res.currency'].sudo().search([('name', '=', 'EUR')], limit=1)
-            eur_pricelist = None
-            if eur_currency:
-                eur_pricelist = request.env['product.pricelist'].sudo().search([
-                    ('currency_id', '=', eur_currency.id),
-                    ('active', '=', True)
-                ], limit=1)
+            eur_pricelist_id = request.env['agency.portal.lookup'].get_pricelist_id('EUR')
 
             order_vals = {
                 'partner_id': partner.id,
                 'client_order_ref': f"AGENCY_{agency_data['id']}_{int(datetime.now().timestamp())}",
+                'portal_agency_id': agency_data['id'],
             }
 
             # Set EUR pricelist if available
-            if eur_pricelist:
-                order_vals['pricelist_id'] = eur_pricelist.id
+            if eur_pricelist_id:
+                order_vals['pricelist_id'] = eur_pricelist_id
 
             # Add ticket_date if field exists
-            if 'ticket_date' in SaleOrder._fields:
+            if self._has_capability('sale_ticket_date'):
                 order_vals['ticket_date'] = visit_date
 
-            # Try to create order - first without commission fields for compatibility
-            order = SaleOrder.create(order_vals)
-
-            # Try to update commission fields separately (they may not exist in DB yet)
-            # Check if columns actually exist in database, not just in model
-            try:
-                request.env.cr.execute("""
-                    SELECT column_name FROM information_schema.columns
-                    WHERE table_name = 'sale_order' AND column_name = 'agency_id'
-                """)
-                has_commission_columns = bool(request.env.cr.fetchone())
-
-                if has_commission_columns:
-                    commission_vals = {}
-                    if agency.exists():
-                        commission_vals['agency_id'] = agency.id
-                    commission_vals['commission_type'] = commission_type
-                    commission_vals['commission_percentage'] = commission_percentage
-                    if commission_vals:
-                        order.write(commission_vals)
-            except Exception as e:
-                _logger.warning(f"Could not set commission fields: {e}")
+            # Prefetch all cart products in one query
+            cart_lines = cart.get('lines', [])
+            products = request.env['product.product'].sudo().browse([
+                int(line.get('variant_id') or line.get('product_id')) for line in cart_lines
+            ]).exists()
+            products_by_id = {product.id: product for product in products}
 
-            # Create order lines
+            # Order lines are created together with the order
+            order_lines = []
             order_total = 0.0
-            for line in cart.get('lines', []):
-                product_id = line.get('variant_id') or line.get('product_id')
-                product = request.env['product.product'].sudo().browse(int(product_id))
+            for line in cart_lines:
+                product = products_by_id.get(int(line.get('variant_id') or line.get('product_id')))
+                if not product:
+                    continue
+                # For Net commission type, the price already includes commission
+                # For Gross, price is base price and commission is calculated separately
+                price_unit = line.get('price', product.list_price)
+                quantity = line.get('quantity', 1)
+                order_lines.append((0, 0, {
+                    'product_id': product.id,
+                    'product_uom_qty': quantity,
+                    'price_unit': price_unit,
+                }))
+                order_total += price_unit * quantity
+            order_vals['order_line'] = order_lines
+
+            # Commission fields come from an optional extension module
+            if self._has_capability('sale_agency') and agency:
+                order_vals['agency_id'] = agency.id
+            if self._has_capability('sale_commission'):
+                order_vals['commission_type'] = commission_type
+                order_vals['commission_percentage'] = commission_percentage
+            if self._has_capability('sale_commission_amount') and commission_percentage > 0:
+                if commission_type == 'gross':
+                    # Gross: commission is percentage of base price
+                    commission_amount = order_total * (commission_percentage / 100)
+                else:
+                    # Net: price shown includes commission, calculate commission from total
+                    # If price = base * (1 + commission%), then commission = price - base
+                    # base = price / (1 + commission%), commission = price - base
+                    base_amount = order_total / (1 + commission_percentage / 100)
+                    commission_amount = order_total - base_amount
+                order_vals['commission_amount'] = commission_amount
 
-                if product.exists():
-                    # For Net commission type, the price already includes commission
-                    # For Gross, price is base price and commission is calculated separately
-                    price_unit = line.get('price', product.list_price)
-
-                    request.env['sale.order.line'].sudo().create({
-                        'order_id': order.id,
-                        'product_id': product.id,
-                        'product_uom_qty': line.get('quantity', 1),
-                        'price_unit': price_unit,
-                    })
-
-                    order_total += price_unit * line.get('quantity', 1)
-
-            # Calculate and save commission amount
-            try:
-                # Check if commission_amount column exists in DB
-                request.env.cr.execute("""
-                    SELECT column_name FROM information_schema.columns
-                    WHERE table_name = 'sale_order' AND column_name = 'commission_amount'
-                """)
-                has_commission_amount = bool(request.env.cr.fetchone())
-
-                if has_commission_amount and commission_percentage > 0:
-                    if commission_type == 'gross':
-                        # Gross: commission is percentage of base price
-                        commission_amount = order_total * (commission_percentage / 100)
-                    else:
-                        # Net: price shown includes commission, calculate commission from total
-                        # If price = base * (1 + commission%), then commission = price - base
-                        # base = price / (1 + commission%), commission = price - base
-                        base_amount = order_total / (1 + commission_percentage / 100)
-                        commission_amount = order_total - base_amount
-
-                    order.write({'commission_amount': commission_amount})
-                    _logger.info(f"Order {order.name}: Commission {commission_type} {commission_percentage}% = {commission_amount}")
-            except Exception as e:
-                _logger.warning(f"Could not set commission_amount: {e}")
+            order = SaleOrder.create(order_vals)
+            if 'commission_amount' in order_vals:
+                _logger.info(f"Order {order.name}: Commission {commission_type} {commission_percentage}% = {order_vals['commission_amount']}")
 
             return order
 
+        except CONCURRENCY_ERRORS:
+            # The agency rollup rows of the day were updated by a concurrent
+            # checkout; the request is retried instead of reporting no order
+            raise
         except Exception as e:
             _logger.error(f"Error creating sale order: {str(e)}", exc_info=True)
             return None
@@ -510,22 +473,27 @@ class CheckoutController(AgencyPortalBase):
     def _save_order_visitors(self, order, visitors):
         """Save visitor information to order - creates visitor.form records"""
         try:
-            if not visitors:
+            if not visitors or not self._has_capability('visitor_form'):
                 return
 
-            VisitorForm = request.env['visitor.form'].sudo()
+            # Product templates of all visitors in one query
+            product_ids = {
+                int(v.get('product_id') or v.get('variant_id'))
+                for v in visitors
+                if not v.get('product_template_id') and (v.get('product_id') or v.get('variant_id'))
+            }
+            products = request.env['product.product'].sudo().browse(list(product_ids)).exists()
+            template_by_product = {product.id: product.product_tmpl_id.id for product in products}
 
+            vals_list = []
             for v in visitors:
-                # Get product template ID
                 product_template_id = v.get('product_template_id')
                 if not product_template_id:
                     product_id = v.get('product_id') or v.get('variant_id')
                     if product_id:
-                        product = request.env['product.product'].sudo().browse(int(product_id))
-                        product_template_id = product.product_tmpl_id.id if product.exists() else False
+                        product_template_id = template_by_product.get(int(product_id), False)
 
-                # Create visitor.form record
-                visitor_vals = {
+                vals_list.append({
                     'sale_order_id': order.id,
                     'visitor_first_name': v.get('first_name', '') or v.get('visitor_first_name', ''),
                     'visitor_last_name': v.get('last_name', '') or v.get('visitor_last_name', ''),
@@ -534,73 +502,66 @@ class CheckoutController(AgencyPortalBase):
                     'visitor_identity': v.get('identity', '') or v.get('visitor_identity', ''),
                     'product_template_id': int(product_template_id) if product_template_id else False,
                     'visitor_index': v.get('visitor_index', 0),
-                }
+                })
 
-                VisitorForm.create(visitor_vals)
-                _logger.info(f"Created visitor record for order {order.name}: {visitor_vals.get('visitor_first_name')} {visitor_vals.get('visitor_last_name')}")
+            request.env['visitor.form'].sudo().create(vals_list)
+            _logger.debug("Created %s visitor records for order %s", len(vals_list), order.name)
 
+        except CONCURRENCY_ERRORS:
+            raise
         except Exception as e:
             _logger.error(f"Error saving order visitors: {str(e)}", exc_info=True)
 
     def _create_payment_transaction(self, order, provider):
         """Create payment transaction for credit card"""
         try:
+            if not self._has_capability('payment_transaction'):
+                return None
+
             Transaction = request.env['payment.transaction'].sudo()
 
-            transaction = Transaction.create({
-                'provider_id': provider.id,
-                'amount': order.amount_total,
-                'currency_id': order.currency_id.id,
-                'partner_id': order.partner_id.id,
-                'reference': f"TICKET-{order.name}",
-                'sale_order_ids': [(4, order.id)],
-            })
+            # A failed transaction must not abort the order savepoint
+            with request.env.cr.savepoint():
+                transaction = Transaction.create({
+                    'provider_id': provider.id,
+                    'amount': order.amount_total,
+                    'currency_id': order.currency_id.id,
+                    'partner_id': order.partner_id.id,
+                    'reference': f"TICKET-{order.name}",
+                    'sale_order_ids': [(4, order.id)],
+                })
 
             return transaction
 
+        except CONCURRENCY_ERRORS:
+            raise
         except Exception as e:
             _logger.error(f"Error creating payment transaction: {str(e)}")
             return None
 
-    def _update_inventory(self, cart):
-        """Update daily inventory for sold tickets"""
-        try:
-            visit_date = cart.get('visit_date')
-            if not visit_date:
-                return
-
-            DailyInventory = request.env['eth.daily.inventory'].sudo()
-
-            for line in cart.get('lines', []):
-                product_id = line.get('variant_id') or line.get('product_id')
-                quantity = line.get('quantity', 0)
-
-                if product_id and quantity > 0:
-                    inventory = DailyInventory.search([
-                        ('product_id', '=', int(product_id)),
-                        ('date', '=', visit_date),
-                        ('state', '=', 'confirmed')
-                    ], limit=1)
+    def _update_inventory(self, cart, cart_id=None):
+        """Reserve daily inventory for sold tickets, all lines at once.
 
-                    if inventory:
-                        # Update sale quantity
-                        inventory.sale_qty += quantity
-                        _logger.info(f"Updated inventory for product {product_id}: +{quantity} sales")
+        The holds of the cart are turned into the reservation. Raises
+        UserError when a product of the visit date is sold out.
+        """
+        quantities = {}
+        for line in cart.get('lines', []):
+            product_id = line.get('variant_id') or line.get('product_id')
+            if product_id and line.get('quantity', 0) > 0:
+                quantities[int(product_id)] = quantities.get(int(product_id), 0) + line['quantity']
 
-        except Exception as e:
-            _logger.error(f"Error updating inventory: {str(e)}")
+        request.env['agency.ticket.inventory'].reserve(cart.get('visit_date'), quantities, cart_id=cart_id)
 
     # ==================== Confirmation Page ====================
 
     @http.route('/agency/tickets/checkout/confirmation/<int:order_id>', type='http', auth="public", website=True, csrf=False)
-    def confirmation_page(self, order_id, **kw):
+    @agency_context()
+    def confirmation_page(self, ctx, order_id, **kw):
         """Order confirmation page"""
         try:
-            if not self._is_authenticated():
-                return request.redirect('/agency/login')
-
-            order = request.env['sale.order'].sudo().browse(order_id)
-            if not order.exists():
+            order = self._get_agency_order(order_id, ctx.agency)
+            if not order:
                 return request.redirect('/agency/tickets')
 
             values = self._prepare_values(
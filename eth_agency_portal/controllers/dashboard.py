@@ -2,7 +2,7 @@
 import logging
 from odoo import http, fields, _
 from odoo.http import request
-from .base import AgencyPortalBase, require_auth, auto_language
+from .base import AgencyPortalBase, agency_context
 
 _logger = logging.getLogger(__name__)
 
@@ -11,13 +11,12 @@ class DashboardController(AgencyPortalBase):
     """Dashboard controller"""
 
     @http.route('/agency/dashboard', type='http', auth="public", website=True, csrf=False)
-    @require_auth()
-    @auto_language
-    def agency_dashboard(self, **kwargs):
+    @agency_context()
+    def agency_dashboard(self, ctx, **kwargs):
         """Agency dashboard page"""
         try:
             # Get user data first
-            user_data = self._get_current_user()
+            user_data = ctx.user
             if not user_data:
                 _logger.warning("Dashboard: No user data found")
                 return request.redirect('/agency/login')
@@ -36,7 +35,7 @@ class DashboardController(AgencyPortalBase):
                 return request.render('eth_agency_portal.agency_access_denied', values)
 
             # Get agency data
-            agency_data = self._get_agency_data()
+            agency_data = ctx.agency
 
             # Get statistics (example - replace with real logic)
             stats = {
@@ -4,9 +4,11 @@ Reports Controller - Agency Reports Page
 """
 import logging
 from datetime import datetime, timedelta
-from odoo import http, _
+from odoo import http, fields, _
+from odoo.exceptions import UserError
 from odoo.http import request
-from .base import AgencyPortalBase, require_auth, auto_language
+from odoo.addons.eth_agency_portal.models.report_export import export_chunks, EXPORT_REPORTS
+from .base import AgencyPortalBase, agency_context
 
 _logger = logging.getLogger(__name__)
 
@@ -17,11 +19,10 @@ class AgencyReports(AgencyPortalBase):
     # ==================== Main Reports Page ====================
 
     @http.route('/agency/reports', type='http', auth='public', website=True)
-    @require_auth()
-    @auto_language
-    def reports_page(self, **kwargs):
+    @agency_context()
+    def reports_page(self, ctx, **kwargs):
         """Main reports page with 4 sections based on membership"""
-        agency_data = self._get_agency_data()
+        agency_data = ctx.agency
 
         values = self._prepare_values(
             page_title=_('Reports'),
@@ -35,17 +36,13 @@ class AgencyReports(AgencyPortalBase):
 
     def _has_contract_permission(self, agency_data):
         """Check if agency has contract/stop sales permission"""
-        if not agency_data:
-            return False
-        purposes = agency_data.get('membership_purposes', [])
-        return 'Contract' in purposes or 'Sözleşme' in purposes or 'Stop Sales' in purposes
+        return bool(agency_data and agency_data.get('has_contract', False))
 
     # ==================== Ticket Reports ====================
 
     @http.route('/agency/reports/tickets', type='http', auth='public', website=True)
-    @require_auth()
-    @auto_language
-    def ticket_reports_page(self, **kwargs):
+    @agency_context()
+    def ticket_reports_page(self, ctx, **kwargs):
         """Ticket reports detail page"""
         values = self._prepare_values(
             page_title=_('Ticket Reports'),
@@ -53,15 +50,11 @@ class AgencyReports(AgencyPortalBase):
         return request.render('eth_agency_portal.portal_reports_tickets', values)
 
     @http.route('/agency/api/reports/tickets/summary', type='json', auth='public', methods=['POST'], csrf=False)
-    def get_ticket_summary(self, date_from=None, date_to=None, **kwargs):
-        """Get ticket sales summary from API"""
+    @agency_context()
+    def get_ticket_summary(self, ctx, date_from=None, date_to=None, **kwargs):
+        """Get ticket sales summary from the sales rollup"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Not authenticated'}
-
-            agency_id = self._get_agency_id()
-            if not agency_id:
-                return {'success': False, 'error': 'No agency found'}
+            agency_id = ctx.agency_id
 
             # Default date range: last 30 days
             if not date_from:
@@ -69,80 +62,8 @@ class AgencyReports(AgencyPortalBase):
             if not date_to:
                 date_to = datetime.now().strftime('%Y-%m-%d')
 
-            # Get orders from local database (eth_daily_inventory)
-            Order = request.env['sale.order'].sudo()
-
-            # Find agency partner
-            agency = request.env['travel.agency'].sudo().browse(agency_id)
-            partner_id = agency.partner_id.id if agency.partner_id else None
-
-            if not partner_id:
-                return {'success': False, 'error': 'Agency partner not found'}
-
-            domain = [
-                ('partner_id', '=', partner_id),
-                ('date_order', '>=', date_from),
-                ('date_order', '<=', date_to),
-            ]
-
-            # Check if ticket orders have specific field
-            if 'is_ticket_order' in Order._fields:
-                domain.append(('is_ticket_order', '=', True))
-
-            orders = Order.search(domain, order='date_order desc')
-
-            # Calculate summary
-            total_orders = len(orders)
-            total_amount = sum(orders.mapped('amount_total'))
-            total_tickets = sum(orders.mapped('order_line.product_uom_qty'))
-
-            # Group by state
-            by_state = {}
-            for order in orders:
-                state = order.state
-                if state not in by_state:
-                    by_state[state] = {'count': 0, 'amount': 0}
-                by_state[state]['count'] += 1
-                by_state[state]['amount'] += order.amount_total
-
-            # Group by product (ticket type)
-            by_product = {}
-            for order in orders:
-                for line in order.order_line:
-                    product_name = line.product_id.name
-                    if product_name not in by_product:
-                        by_product[product_name] = {'quantity': 0, 'amount': 0}
-                    by_product[product_name]['quantity'] += line.product_uom_qty
-                    by_product[product_name]['amount'] += line.price_subtotal
-
-            # Recent orders
-            recent_orders = []
-            for order in orders[:10]:
-                recent_orders.append({
-                    'id': order.id,
-                    'name': order.name,
-                    'date': order.date_order.strftime('%Y-%m-%d %H:%M') if order.date_order else '',
-                    'amount': order.amount_total,
-                    'state': order.state,
-                    'ticket_count': sum(order.order_line.mapped('product_uom_qty')),
-                })
-
-            return {
-                'success': True,
-                'data': {
-                    'summary': {
-                        'total_orders': total_orders,
-                        'total_amount': total_amount,
-                        'total_tickets': int(total_tickets),
-                        'currency': orders[0].currency_id.symbol if orders else '€',
-                    },
-                    'by_state': by_state,
-                    'by_product': by_product,
-                    'recent_orders': recent_orders,
-                    'date_from': date_from,
-                    'date_to': date_to,
-                }
-            }
+            job = request.env['agency.report.job'].sudo().get_report(agency_id, 'tickets', date_from, date_to)
+            return self._report_job_response(ctx, job)
 
         except Exception as e:
             _logger.error(f"Error getting ticket summary: {str(e)}")
@@ -151,9 +72,8 @@ class AgencyReports(AgencyPortalBase):
     # ==================== Bonus Reports ====================
 
     @http.route('/agency/reports/bonus', type='http', auth='public', website=True)
-    @require_auth()
-    @auto_language
-    def bonus_reports_page(self, **kwargs):
+    @agency_context()
+    def bonus_reports_page(self, ctx, **kwargs):
         """Bonus reports detail page"""
         values = self._prepare_values(
             page_title=_('Bonus Reports'),
@@ -161,13 +81,12 @@ class AgencyReports(AgencyPortalBase):
         return request.render('eth_agency_portal.portal_reports_bonus', values)
 
     @http.route('/agency/api/reports/bonus/summary', type='json', auth='public', methods=['POST'], csrf=False)
-    def get_bonus_summary(self, date_from=None, date_to=None, **kwargs):
+    @agency_context()
+    def get_bonus_summary(self, ctx, date_from=None, date_to=None, **kwargs):
         """Get bonus reservations summary from API"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Not authenticated'}
-
-            token = request.session.get('agency_token')
+            agency_id = ctx.agency_id
+            token = ctx.token
 
             # Default date range: last 30 days
             if not date_from:
@@ -175,63 +94,9 @@ class AgencyReports(AgencyPortalBase):
             if not date_to:
                 date_to = datetime.now().strftime('%Y-%m-%d')
 
-            # Call Travel API for bonus summary
-            api_client = request.env['travel.api.client'].sudo()
-
-            # Get bonus wallet
-            wallet_result = api_client.get_bonus_wallet(token)
-            wallet_data = wallet_result.get('data', {}) if wallet_result.get('success') else {}
-
-            # Get bonus reservations
-            reservations_result = api_client.get_bonus_reservations(token, {
-                'date_from': date_from,
-                'date_to': date_to,
-            })
-
-            reservations = reservations_result.get('data', []) if reservations_result.get('success') else []
-
-            # Calculate summary
-            total_reservations = len(reservations)
-            total_bonus = sum(r.get('bonus_amount', 0) for r in reservations)
-
-            # Group by state
-            by_state = {}
-            for res in reservations:
-                state = res.get('state', 'unknown')
-                if state not in by_state:
-                    by_state[state] = {'count': 0, 'bonus': 0}
-                by_state[state]['count'] += 1
-                by_state[state]['bonus'] += res.get('bonus_amount', 0)
-
-            # Group by hotel
-            by_hotel = {}
-            for res in reservations:
-                hotel = res.get('hotel_name', 'Unknown')
-                if hotel not in by_hotel:
-                    by_hotel[hotel] = {'count': 0, 'bonus': 0, 'nights': 0}
-                by_hotel[hotel]['count'] += 1
-                by_hotel[hotel]['bonus'] += res.get('bonus_amount', 0)
-                by_hotel[hotel]['nights'] += res.get('room_nights', 0)
-
-            # Recent reservations
-            recent = reservations[:10] if isinstance(reservations, list) else []
-
-            return {
-                'success': True,
-                'data': {
-                    'wallet': wallet_data,
-                    'summary': {
-                        'total_reservations': total_reservations,
-                        'total_bonus': total_bonus,
-                        'currency': wallet_data.get('currency', 'EUR'),
-                    },
-                    'by_state': by_state,
-                    'by_hotel': by_hotel,
-                    'recent_reservations': recent,
-                    'date_from': date_from,
-                    'date_to': date_to,
-                }
-            }
+            job = request.env['agency.report.job'].sudo().get_report(
+                agency_id, 'bonus', date_from, date_to, token=token)
+            return self._report_job_response(ctx, job)
 
         except Exception as e:
             _logger.error(f"Error getting bonus summary: {str(e)}")
@@ -240,9 +105,8 @@ class AgencyReports(AgencyPortalBase):
     # ==================== Hotel Booking Reports ====================
 
     @http.route('/agency/reports/bookings', type='http', auth='public', website=True)
-    @require_auth()
-    @auto_language
-    def booking_reports_page(self, **kwargs):
+    @agency_context()
+    def booking_reports_page(self, ctx, **kwargs):
         """Hotel booking reports detail page"""
         values = self._prepare_values(
             page_title=_('Hotel Booking Reports'),
@@ -250,13 +114,12 @@ class AgencyReports(AgencyPortalBase):
         return request.render('eth_agency_portal.portal_reports_bookings', values)
 
     @http.route('/agency/api/reports/bookings/summary', type='json', auth='public', methods=['POST'], csrf=False)
-    def get_booking_summary(self, date_from=None, date_to=None, **kwargs):
+    @agency_context()
+    def get_booking_summary(self, ctx, date_from=None, date_to=None, **kwargs):
         """Get hotel bookings summary from API"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Not authenticated'}
-
-            token = request.session.get('agency_token')
+            agency_id = ctx.agency_id
+            token = ctx.token
 
             # Default date range: last 30 days
             if not date_from:
@@ -264,58 +127,9 @@ class AgencyReports(AgencyPortalBase):
             if not date_to:
                 date_to = datetime.now().strftime('%Y-%m-%d')
 
-            # Call Travel API for bookings
-            api_client = request.env['travel.api.client'].sudo()
-            result = api_client.get_hotel_bookings(token, {
-                'date_from': date_from,
-                'date_to': date_to,
-            })
-
-            bookings = result.get('data', []) if result.get('success') else []
-
-            # Calculate summary
-            total_bookings = len(bookings)
-            total_amount = sum(b.get('total_amount', 0) for b in bookings)
-            total_nights = sum(b.get('nights', 0) for b in bookings)
-
-            # Group by state
-            by_state = {}
-            for booking in bookings:
-                state = booking.get('state', 'unknown')
-                if state not in by_state:
-                    by_state[state] = {'count': 0, 'amount': 0}
-                by_state[state]['count'] += 1
-                by_state[state]['amount'] += booking.get('total_amount', 0)
-
-            # Group by hotel
-            by_hotel = {}
-            for booking in bookings:
-                hotel = booking.get('hotel_name', 'Unknown')
-                if hotel not in by_hotel:
-                    by_hotel[hotel] = {'count': 0, 'amount': 0, 'nights': 0}
-                by_hotel[hotel]['count'] += 1
-                by_hotel[hotel]['amount'] += booking.get('total_amount', 0)
-                by_hotel[hotel]['nights'] += booking.get('nights', 0)
-
-            # Recent bookings
-            recent = bookings[:10] if isinstance(bookings, list) else []
-
-            return {
-                'success': True,
-                'data': {
-                    'summary': {
-                        'total_bookings': total_bookings,
-                        'total_amount': total_amount,
-                        'total_nights': total_nights,
-                        'currency': 'EUR',
-                    },
-                    'by_state': by_state,
-                    'by_hotel': by_hotel,
-                    'recent_bookings': recent,
-                    'date_from': date_from,
-                    'date_to': date_to,
-                }
-            }
+            job = request.env['agency.report.job'].sudo().get_report(
+                agency_id, 'bookings', date_from, date_to, token=token)
+            return self._report_job_response(ctx, job)
 
         except Exception as e:
             _logger.error(f"Error getting booking summary: {str(e)}")
@@ -324,9 +138,8 @@ class AgencyReports(AgencyPortalBase):
     # ==================== Stop Sales Reports ====================
 
     @http.route('/agency/reports/stop-sales', type='http', auth='public', website=True)
-    @require_auth()
-    @auto_language
-    def stop_sales_reports_page(self, **kwargs):
+    @agency_context()
+    def stop_sales_reports_page(self, ctx, **kwargs):
         """Stop sales reports detail page"""
         values = self._prepare_values(
             page_title=_('Stop Sales Reports'),
@@ -334,14 +147,11 @@ class AgencyReports(AgencyPortalBase):
         return request.render('eth_agency_portal.portal_reports_stop_sales', values)
 
     @http.route('/agency/api/reports/stop-sales/summary', type='json', auth='public', methods=['POST'], csrf=False)
-    def get_stop_sales_summary(self, date_from=None, date_to=None, **kwargs):
+    @agency_context()
+    def get_stop_sales_summary(self, ctx, date_from=None, date_to=None, **kwargs):
         """Get stop sales summary"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Not authenticated'}
-
-            token = request.session.get('agency_token')
-            agency_id = self._get_agency_id()
+            agency_id = ctx.agency_id
 
             # Default date range: next 30 days for stop sales
             if not date_from:
@@ -349,14 +159,9 @@ class AgencyReports(AgencyPortalBase):
             if not date_to:
                 date_to = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d')
 
-            # Check if stop sales model exists in local database
-            StopSales = request.env.get('hotel.stop.sales')
-
-            if StopSales is None:
-                # Try travel.stop.sales
-                StopSales = request.env.get('travel.stop.sales')
-
-            if StopSales is None:
+            # Check if a stop sales model exists in local database
+            Report = request.env['agency.stop.sales.report'].sudo()
+            if Report._get_stop_sales_model() is None:
                 return {
                     'success': True,
                     'data': {
@@ -372,64 +177,104 @@ class AgencyReports(AgencyPortalBase):
                     }
                 }
 
-            # Get agency's interested hotels
-            agency = request.env['travel.agency'].sudo().browse(agency_id)
-            hotel_ids = []
-            if hasattr(agency, 'interested_hotel_ids') and agency.interested_hotel_ids:
-                hotel_ids = agency.interested_hotel_ids.ids
-
-            # Query stop sales
-            domain = [
-                ('date_from', '<=', date_to),
-                ('date_to', '>=', date_from),
-            ]
-            if hotel_ids:
-                domain.append(('hotel_id', 'in', hotel_ids))
-
-            stop_sales = StopSales.sudo().search(domain, order='date_from desc')
-
-            # Calculate summary
-            total_stop_sales = len(stop_sales)
-            active_stop_sales = len(stop_sales.filtered(lambda s: s.state == 'active' if hasattr(s, 'state') else True))
-
-            # Group by hotel
-            by_hotel = {}
-            for ss in stop_sales:
-                hotel_name = ss.hotel_id.name if ss.hotel_id else 'Unknown'
-                if hotel_name not in by_hotel:
-                    by_hotel[hotel_name] = {'count': 0, 'days': 0}
-                by_hotel[hotel_name]['count'] += 1
-                # Calculate days
-                if ss.date_from and ss.date_to:
-                    days = (ss.date_to - ss.date_from).days + 1
-                    by_hotel[hotel_name]['days'] += days
-
-            # Recent stop sales
-            recent = []
-            for ss in stop_sales[:10]:
-                recent.append({
-                    'id': ss.id,
-                    'hotel_name': ss.hotel_id.name if ss.hotel_id else 'Unknown',
-                    'date_from': ss.date_from.strftime('%Y-%m-%d') if ss.date_from else '',
-                    'date_to': ss.date_to.strftime('%Y-%m-%d') if ss.date_to else '',
-                    'room_type': ss.room_type_id.name if hasattr(ss, 'room_type_id') and ss.room_type_id else 'All',
-                    'reason': ss.reason if hasattr(ss, 'reason') else '',
-                })
-
-            return {
-                'success': True,
-                'data': {
-                    'summary': {
-                        'total_stop_sales': total_stop_sales,
-                        'active_stop_sales': active_stop_sales,
-                    },
-                    'by_hotel': by_hotel,
-                    'recent_stop_sales': recent,
-                    'date_from': date_from,
-                    'date_to': date_to,
-                }
-            }
+            data = Report.get_summary(agency_id, date_from, date_to)
+            data.update(date_from=date_from, date_to=date_to)
+            return {'success': True, 'data': data}
 
         except Exception as e:
             _logger.error(f"Error getting stop sales summary: {str(e)}")
             return {'success': False, 'error': str(e)}
+
+    # ==================== Report Jobs ====================
+
+    @http.route('/agency/api/reports/jobs/status', type='json', auth='public', methods=['POST'], csrf=False)
+    @agency_context()
+    def get_report_job_status(self, ctx, job_id=None, **kwargs):
+        """Poll a queued report; returns the summary once it is computed"""
+        try:
+            agency_id = ctx.agency_id
+            job = request.env['agency.report.job'].sudo().search([
+                ('id', '=', int(job_id or 0)),
+                ('agency_id', '=', agency_id),
+            ], limit=1)
+            if not job:
+                return {'success': False, 'error': 'Report not found'}
+            return self._report_job_response(ctx, job)
+
+        except Exception as e:
+            _logger.error(f"Error getting report job status: {str(e)}")
+            return {'success': False, 'error': str(e)}
+
+    def _report_job_response(self, ctx, job):
+        """JSON response of a report job: its summary, or the job to poll"""
+        if job.state == 'failed':
+            return {'success': False, 'error': job.error}
+        if job.state != 'done':
+            return {'success': True, 'pending': True, 'job_id': job.id}
+        data = dict(job.result)
+        if job.report_type == 'bonus':
+            # The wallet is the current balance, not data of the range
+            wallet_result = request.env['travel.api.client'].sudo().get_bonus_wallet(ctx.token)
+            wallet_data = wallet_result.get('data', {}) if wallet_result.get('success') else {}
+            data['wallet'] = wallet_data
+            data['summary'] = dict(data['summary'], currency=wallet_data.get('currency', 'EUR'))
+        return {'success': True, 'data': data}
+
+    # ==================== Exports ====================
+
+    @http.route('/agency/api/reports/<string:report>/export', type='http', auth='public', methods=['GET'], csrf=False)
+    @agency_context()
+    def export_report(self, ctx, report, format='csv', date_from=None, date_to=None, **kwargs):
+        """Stream all rows of a report as CSV or XLSX"""
+        if report not in EXPORT_REPORTS or format not in ('csv', 'xlsx'):
+            return request.not_found()
+        # Same memberships as the report sections
+        permitted = {
+            'tickets': ctx.agency.get('has_tickets', False),
+            'bonus': ctx.agency.get('has_bonus', False),
+            'bookings': ctx.agency.get('has_sales', False),
+            'stop-sales': self._has_contract_permission(ctx.agency),
+        }
+        if not permitted[report]:
+            return request.not_found()
+
+        # Same default ranges as the summaries: stop sales look ahead
+        today = datetime.now()
+        if report == 'stop-sales':
+            date_from = date_from or today.strftime('%Y-%m-%d')
+            date_to = date_to or (today + timedelta(days=30)).strftime('%Y-%m-%d')
+        else:
+            date_from = date_from or (today - timedelta(days=30)).strftime('%Y-%m-%d')
+            date_to = date_to or today.strftime('%Y-%m-%d')
+        try:
+            fields.Date.to_date(date_from)
+            fields.Date.to_date(date_to)
+        except ValueError:
+            return request.make_response('Invalid date range', status=400)
+
+        params = {
+            'agency_id': ctx.agency_id,
+            'token': ctx.token,
+            'date_from': date_from,
+            'date_to': date_to,
+        }
+        # Travel API failures are reported here, before the file is sent
+        try:
+            params = request.env['agency.report.export'].sudo()._prepare_export(report, params)
+        except UserError as e:
+            _logger.error(f"Error exporting {report} report: {str(e)}")
+            return request.make_response(str(e), status=502)
+
+        # Rows are read while the response is sent, on a cursor of their own
+        chunks = export_chunks(
+            request.env.cr.dbname, request.env.uid, dict(request.env.context), report, format, params)
+        filename = f"{report}_{date_from}_{date_to}.{format}"
+        content_type = (
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            if format == 'xlsx' else 'text/csv; charset=utf-8'
+        )
+        return request.make_response(chunks, headers=[
+            ('Content-Type', content_type),
+            ('Content-Disposition', f'attachment; filename="{filename}"'),
+            ('Cache-Control', 'no-store'),
+        ])
@@ -3,7 +3,7 @@ import logging
 import base64
 from odoo import http, _
 from odoo.http import request
-from .base import AgencyPortalBase, require_auth, auto_language, LanguageManager
+from .base import AgencyPortalBase, agency_context, LanguageManager
 
 _logger = logging.getLogger(__name__)
 
@@ -12,12 +12,11 @@ class SettingsController(AgencyPortalBase):
     """Settings and profile management controllers"""
 
     @http.route('/agency/settings', type='http', auth="public", website=True, csrf=False)
-    @require_auth()
-    @auto_language
-    def agency_settings(self, **kwargs):
+    @agency_context()
+    def agency_settings(self, ctx, **kwargs):
         """Agency settings page"""
         try:
-            agency_id = self._get_agency_id()
+            agency_id = ctx.agency_id
 
             # Get detailed agency info for settings
             agency_extra = {}
@@ -30,24 +29,27 @@ class SettingsController(AgencyPortalBase):
                     interested_hotels = []
                     all_hotels = []
                     try:
+                        has_hotel_code = self._has_capability('travel_hotel_code')
+                        has_hotel_city = self._has_capability('travel_hotel_city')
+
                         # Check if interested_hotel_ids field exists (from eth_agency_hotel_ext)
-                        if 'interested_hotel_ids' in agency._fields:
+                        if self._has_capability('agency_interested_hotels'):
                             interested_hotels = [{
                                 'id': hotel.id,
                                 'name': hotel.name,
-                                'code': hotel.code if hasattr(hotel, 'code') else '',
-                                'city': hotel.city_id.name if hasattr(hotel, 'city_id') and hotel.city_id else '',
+                                'code': hotel.code if has_hotel_code else '',
+                                'city': hotel.city_id.name if has_hotel_city and hotel.city_id else '',
                             } for hotel in agency.interested_hotel_ids]
                             _logger.info(f"Found {len(interested_hotels)} interested hotels for agency")
 
                         # Get all available hotels for selection (if hotel model exists)
-                        if 'eth.travel.hotel' in request.env:
+                        if self._has_capability('travel_hotel'):
                             hotels = request.env['eth.travel.hotel'].sudo().search([('status', '=', 'active')])
                             all_hotels = [{
                                 'id': hotel.id,
                                 'name': hotel.name,
-                                'code': hotel.code if hasattr(hotel, 'code') else '',
-                                'city': hotel.city_id.name if hasattr(hotel, 'city_id') and hotel.city_id else '',
+                                'code': hotel.code if has_hotel_code else '',
+                                'city': hotel.city_id.name if has_hotel_city and hotel.city_id else '',
                             } for hotel in hotels]
                             _logger.info(f"Found {len(all_hotels)} available hotels")
                     except Exception as e:
@@ -254,6 +256,8 @@ class SettingsController(AgencyPortalBase):
                 ('agency_id', '=', agency_id)
             ], order='create_date desc', limit=50)
 
+            # Hotels of a request come from the hotel extension module
+            has_hotels = self._has_capability('update_request_hotels')
             requests_data = []
             for req in requests:
                 data = {
@@ -264,15 +268,15 @@ class SettingsController(AgencyPortalBase):
                     'state': req.state,
                     'state_label': dict(req._fields['state'].selection).get(req.state, req.state),
                     'reason': req.reason,
-                    'rejection_reason': req.rejection_reason if hasattr(req, 'rejection_reason') else '',
+                    'rejection_reason': req.rejection_reason or '',
                     'create_date': req.create_date.strftime('%Y-%m-%d %H:%M:%S') if req.create_date else '',
-                    'approved_date': req.approved_date.strftime('%Y-%m-%d %H:%M:%S') if hasattr(req, 'approved_date') and req.approved_date else '',
+                    'approved_date': req.approved_date.strftime('%Y-%m-%d %H:%M:%S') if req.approved_date else '',
                 }
 
                 # Add item details
-                if req.request_type in ['add_hotel', 'remove_hotel'] and hasattr(req, 'hotel_ids'):
+                if req.request_type in ['add_hotel', 'remove_hotel'] and has_hotels:
                     data['items'] = req.hotel_ids.mapped('name')
-                elif req.request_type in ['add_membership', 'remove_membership'] and hasattr(req, 'membership_purpose_ids'):
+                elif req.request_type in ['add_membership', 'remove_membership']:
                     data['items'] = req.membership_purpose_ids.mapped('name')
                 else:
                     data['items'] = []
@@ -289,12 +293,11 @@ class SettingsController(AgencyPortalBase):
             return {'success': False, 'error': str(e)}
 
     @http.route('/agency/profile', type='http', auth="public", website=True, csrf=False)
-    @require_auth()
-    @auto_language
-    def agency_profile(self, **kwargs):
+    @agency_context()
+    def agency_profile(self, ctx, **kwargs):
         """Agency user profile"""
         try:
-            user_data = self._get_current_user()
+            user_data = ctx.user
             # Get countries for dropdown
             countries = request.env['res.country'].sudo().search([], order='name')
 
@@ -329,7 +332,7 @@ class SettingsController(AgencyPortalBase):
                         update_data['city_id'] = int(kwargs.get('city_id'))
 
                     # Update profile via auth service
-                    token = request.session.get('agency_token')
+                    token = ctx.token
                     auth_service = request.env['agency.auth.service'].sudo()
                     result = auth_service.update_agency_user(user_data['id'], update_data, token)
 
@@ -353,9 +356,8 @@ class SettingsController(AgencyPortalBase):
             return request.redirect('/agency/dashboard')
 
     @http.route('/agency/change-password', type='http', auth="public", website=True, csrf=False)
-    @require_auth()
-    @auto_language
-    def agency_change_password(self, **kwargs):
+    @agency_context()
+    def agency_change_password(self, ctx, **kwargs):
         """Change password for logged in users"""
         try:
             values = self._prepare_values(page_name='profile')
@@ -375,7 +377,7 @@ class SettingsController(AgencyPortalBase):
                         values['error'] = _('New password must be at least 6 characters long.')
                     else:
                         # Change password via auth service
-                        token = request.session.get('agency_token')
+                        token = ctx.token
                         auth_service = request.env['agency.auth.service'].sudo()
                         result = auth_service.change_user_password(token, current_password, new_password)
 
@@ -395,15 +397,14 @@ class SettingsController(AgencyPortalBase):
             return request.redirect('/agency/dashboard')
 
     @http.route('/agency/business-profile', type='http', auth="public", website=True, csrf=False)
-    @require_auth()
-    @auto_language
-    def agency_business_profile(self, **kwargs):
+    @agency_context()
+    def agency_business_profile(self, ctx, **kwargs):
         """Agency business profile edit page"""
-        user_data = self._get_current_user()
+        user_data = ctx.user
         if not user_data:
             return request.redirect('/agency/login')
 
-        agency_id = self._get_agency_id()
+        agency_id = ctx.agency_id
 
         # Get the agency and registration record
         try:
@@ -422,9 +423,9 @@ class SettingsController(AgencyPortalBase):
             # Prepare business profile data
             business_profile = {
                 'name': agency.name,
-                'email': agency.email if hasattr(agency, 'email') else '',
-                'phone': agency.phone if hasattr(agency, 'phone') else '',
-                'website': agency.website if hasattr(agency, 'website') else '',
+                'email': agency.email or '',
+                'phone': agency.phone or '',
+                'website': agency.website or '',
                 'preferred_language': registration.preferred_language if registration else 'tr',
                 'country_id': registration.country_id.id if registration and registration.country_id else None,
                 'country_name': registration.country_id.name if registration and registration.country_id else '',
@@ -525,14 +526,14 @@ class SettingsController(AgencyPortalBase):
 
                 # Refresh business_profile data
                 business_profile.update({
-                    'email': agency.email if hasattr(agency, 'email') else '',
-                    'phone': agency.phone if hasattr(agency, 'phone') else '',
-                    'website': agency.website if hasattr(agency, 'website') else '',
+                    'email': agency.email or '',
+                    'phone': agency.phone or '',
+                    'website': agency.website or '',
                     'preferred_language': registration.preferred_language,
                     'country_id': registration.country_id.id if registration.country_id else None,
                     'country_name': registration.country_id.name if registration.country_id else '',
-                    'city_id': registration.city_id.id if hasattr(registration, 'city_id') and registration.city_id else None,
-                    'address': registration.address if hasattr(registration, 'address') else '',
+                    'city_id': registration.city_id.id if registration.city_id else None,
+                    'address': registration.address or '',
                 })
 
                 # Refresh cities
@@ -556,11 +557,11 @@ class SettingsController(AgencyPortalBase):
         return request.render('eth_agency_portal.agency_business_profile_edit', values)
 
     @http.route('/agency/download-confirmation-file/<int:registration_id>', type='http', auth="public")
-    @require_auth()
-    def download_confirmation_file(self, registration_id, **kwargs):
+    @agency_context()
+    def download_confirmation_file(self, ctx, registration_id, **kwargs):
         """Download confirmation file"""
         try:
-            agency_id = self._get_agency_id()
+            agency_id = ctx.agency_id
 
             # Get registration
             Registration = request.env.get('travel.agency.registration') or request.env.get('agency.registration')
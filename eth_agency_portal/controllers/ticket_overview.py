@@ -4,13 +4,24 @@ Ticket Overview Controller for Agency Portal
 Handles listing, viewing, editing, and deleting ticket orders
 """
 import logging
-from datetime import datetime, timedelta
-from odoo import http, _
+from datetime import datetime
+from odoo import http, fields, _
 from odoo.http import request
-from .base import AgencyPortalBase
+from odoo.tools import SQL
+from .base import AgencyPortalBase, agency_context
 
 _logger = logging.getLogger(__name__)
 
+# Visitor keys of the order edit page -> visitor.form fields
+VISITOR_FIELD_MAP = {
+    'first_name': 'visitor_first_name',
+    'last_name': 'visitor_last_name',
+    'phone': 'visitor_phone',
+    'email': 'visitor_email',
+    'identity': 'visitor_identity',
+}
+NEW_VISITOR_VALS = dict.fromkeys(VISITOR_FIELD_MAP.values(), '')
+
 
 class TicketOverviewController(AgencyPortalBase):
     """Ticket Overview controllers"""
@@ -18,15 +29,11 @@ class TicketOverviewController(AgencyPortalBase):
     # ==================== Overview Page ====================
 
     @http.route('/agency/tickets/overview', type='http', auth="public", website=True, csrf=False)
-    def ticket_overview_page(self, **kw):
+    @agency_context()
+    def ticket_overview_page(self, ctx, **kw):
         """Ticket overview page - dashboard + list"""
         try:
-            if not self._is_authenticated():
-                return request.redirect('/agency/login')
-
-            agency_data = self._get_agency_data()
-            if not agency_data:
-                return request.redirect('/agency/login')
+            agency_data = ctx.agency
 
             # Get filter parameters
             date_from = kw.get('date_from')
@@ -40,7 +47,7 @@ class TicketOverviewController(AgencyPortalBase):
             # Get orders
             orders = request.env['sale.order'].sudo().search(
                 domain,
-                order='date_order desc',
+                order='date_order desc, id desc',
                 limit=100
             )
 
@@ -66,9 +73,7 @@ class TicketOverviewController(AgencyPortalBase):
 
     def _build_order_domain(self, agency_data, date_from, date_to, status, search):
         """Build search domain for orders"""
-        domain = [
-            ('client_order_ref', 'like', f"AGENCY_{agency_data['id']}_")
-        ]
+        domain = [('portal_agency_id', '=', agency_data['id'])]
 
         if date_from:
             domain.append(('date_order', '>=', date_from))
@@ -79,83 +84,126 @@ class TicketOverviewController(AgencyPortalBase):
             domain.append(('state', '=', status))
 
         if search:
-            domain.append('|')
-            domain.append(('name', 'ilike', search))
-            domain.append(('partner_id.name', 'ilike', search))
+            # Order refs and visitor names, or the customer; both trigram indexed
+            search = search.strip()
+            domain += ['|', ('portal_search_text', 'ilike', search),
+                       ('partner_id', 'any', ['|', ('name', 'ilike', search), ('email', 'ilike', search)])]
 
         return domain
 
     def _calculate_stats(self, agency_data):
-        """Calculate dashboard statistics"""
-        SaleOrder = request.env['sale.order'].sudo()
-        base_domain = [('client_order_ref', 'like', f"AGENCY_{agency_data['id']}_")]
-
-        # Total orders
-        total_orders = SaleOrder.search_count(base_domain)
-
-        # Today's orders
+        """Calculate dashboard statistics from the daily ticket sales rollup"""
         today = datetime.now().date()
-        today_domain = base_domain + [('date_order', '>=', str(today))]
-        today_orders = SaleOrder.search_count(today_domain)
-
-        # This month's orders
         month_start = today.replace(day=1)
-        month_domain = base_domain + [('date_order', '>=', str(month_start))]
-        month_orders = SaleOrder.search_count(month_domain)
-
-        # Total revenue and commission
-        orders = SaleOrder.search(base_domain)
-        total_revenue = sum(orders.mapped('amount_total'))
 
-        # Check if commission_amount column exists
-        total_commission = 0
-        try:
-            request.env.cr.execute("""
-                SELECT column_name FROM information_schema.columns
-                WHERE table_name = 'sale_order' AND column_name = 'commission_amount'
-            """)
-            if request.env.cr.fetchone():
-                total_commission = sum(orders.mapped('commission_amount') or [0])
-        except Exception:
-            pass
-
-        # Pending orders (draft)
-        pending_domain = base_domain + [('state', '=', 'draft')]
-        pending_orders = SaleOrder.search_count(pending_domain)
-
-        # Confirmed orders (sale)
-        confirmed_domain = base_domain + [('state', '=', 'sale')]
-        confirmed_orders = SaleOrder.search_count(confirmed_domain)
+        # Order totals are the rows without product
+        request.env.cr.execute("""
+            SELECT COALESCE(sum(order_count), 0),
+                   COALESCE(sum(order_count) FILTER (WHERE day >= %(today)s), 0),
+                   COALESCE(sum(order_count) FILTER (WHERE day >= %(month_start)s), 0),
+                   COALESCE(sum(order_count) FILTER (WHERE state = 'draft'), 0),
+                   COALESCE(sum(order_count) FILTER (WHERE state = 'sale'), 0),
+                   COALESCE(sum(amount), 0),
+                   COALESCE(sum(commission), 0)
+              FROM agency_ticket_sales_rollup
+             WHERE agency_id = %(agency_id)s AND product_id = 0
+        """, {'today': today, 'month_start': month_start, 'agency_id': agency_data['id']})
+        (total_orders, today_orders, month_orders, pending_orders, confirmed_orders,
+         total_revenue, total_commission) = request.env.cr.fetchone()
+
+        # Commission amount comes from an optional extension module, it is
+        # only in the rollup when stored. Otherwise it is derived from the
+        # untaxed totals per commission type and percentage, as at checkout.
+        SaleOrder = request.env['sale.order'].sudo()
+        if (self._has_capability('sale_commission_amount')
+                and not self._has_capability('sale_commission_amount_stored')
+                and self._has_capability('sale_commission_type_stored')
+                and self._has_capability('sale_commission_percentage_stored')):
+            total_commission = 0.0
+            for commission_type, percentage, amount in SaleOrder._read_group(
+                    [('portal_agency_id', '=', agency_data['id'])],
+                    ['commission_type', 'commission_percentage'], ['amount_untaxed:sum']):
+                if not percentage:
+                    continue
+                if commission_type == 'net':
+                    total_commission += amount - amount / (1 + percentage / 100)
+                else:
+                    total_commission += amount * (percentage / 100)
 
         return {
             'total_orders': total_orders,
             'today_orders': today_orders,
             'month_orders': month_orders,
-            'total_revenue': total_revenue,
-            'total_commission': total_commission,
+            'total_revenue': float(total_revenue),
+            'total_commission': float(total_commission),
             'pending_orders': pending_orders,
             'confirmed_orders': confirmed_orders,
         }
 
+    def _serialize_orders(self, orders):
+        """Serialize orders for the orders API with batched reads"""
+        if not orders:
+            return []
+        fnames = ['name', 'date_order', 'partner_id', 'amount_total', 'state']
+        if self._has_capability('sale_ticket_date'):
+            fnames.append('ticket_date')
+        rows = orders.read(fnames, load=None)
+
+        partner_ids = {row['partner_id'] for row in rows if row['partner_id']}
+        partner_names = {
+            partner['id']: partner['name']
+            for partner in request.env['res.partner'].sudo().browse(partner_ids).read(['name'])
+        }
+
+        # Visitors are counted per order instead of loading the one2many
+        visitor_counts = {}
+        if self._has_capability('sale_visitor_forms'):
+            visitor_counts = {
+                order.id: count
+                for order, count in request.env['visitor.form'].sudo()._read_group(
+                    [('sale_order_id', 'in', orders.ids)], ['sale_order_id'], ['__count'])
+            }
+
+        return [{
+            'id': row['id'],
+            'name': row['name'],
+            'date_order': row['date_order'].strftime('%Y-%m-%d %H:%M') if row['date_order'] else '',
+            'ticket_date': row['ticket_date'].strftime('%Y-%m-%d') if row.get('ticket_date') else '',
+            'partner_name': partner_names.get(row['partner_id'], ''),
+            'amount_total': row['amount_total'],
+            'state': row['state'],
+            'visitor_count': visitor_counts.get(row['id'], 0),
+        } for row in rows]
+
+    def _format_order_cursor(self, order):
+        return f"{fields.Datetime.to_string(order.date_order)},{order.id}"
+
+    def _parse_order_cursor(self, cursor):
+        cursor_date, cursor_id = str(cursor).rsplit(',', 1)
+        return fields.Datetime.to_datetime(cursor_date), int(cursor_id)
+
+    def _estimate_order_count(self, domain):
+        """Row estimate of the planner, without counting the orders"""
+        query = request.env['sale.order'].sudo()._search(domain)
+        request.env.cr.execute(SQL("EXPLAIN (FORMAT JSON) %s", query.select()))
+        plan = request.env.cr.fetchone()[0]
+        return int(plan[0]['Plan']['Plan Rows'])
+
     # ==================== View Order ====================
 
     @http.route('/agency/tickets/overview/<int:order_id>', type='http', auth="public", website=True, csrf=False)
-    def view_order(self, order_id, **kw):
+    @agency_context()
+    def view_order(self, ctx, order_id, **kw):
         """View order details"""
         try:
-            if not self._is_authenticated():
-                return request.redirect('/agency/login')
-
-            agency_data = self._get_agency_data()
-            if not agency_data:
-                return request.redirect('/agency/login')
+            agency_data = ctx.agency
 
-            order = request.env['sale.order'].sudo().browse(order_id)
-            if not order.exists() or f"AGENCY_{agency_data['id']}_" not in (order.client_order_ref or ''):
+            order = self._get_agency_order(order_id, agency_data)
+            if not order:
                 return request.redirect('/agency/tickets/overview')
 
             # Get visitors
-            visitors = order.visitor_form_ids if hasattr(order, 'visitor_form_ids') else []
+            visitors = order.visitor_form_ids if self._has_capability('sale_visitor_forms') else []
 
             values = self._prepare_values(
                 page_name='ticket_order_detail',
@@ -171,18 +219,14 @@ class TicketOverviewController(AgencyPortalBase):
     # ==================== Edit Order ====================
 
     @http.route('/agency/tickets/overview/<int:order_id>/edit', type='http', auth="public", website=True, csrf=False)
-    def edit_order_page(self, order_id, **kw):
+    @agency_context()
+    def edit_order_page(self, ctx, order_id, **kw):
         """Edit order page"""
         try:
-            if not self._is_authenticated():
-                return request.redirect('/agency/login')
+            agency_data = ctx.agency
 
-            agency_data = self._get_agency_data()
-            if not agency_data:
-                return request.redirect('/agency/login')
-
-            order = request.env['sale.order'].sudo().browse(order_id)
-            if not order.exists() or f"AGENCY_{agency_data['id']}_" not in (order.client_order_ref or ''):
+            order = self._get_agency_order(order_id, agency_data)
+            if not order:
                 return request.redirect('/agency/tickets/overview')
 
             # Can only edit draft orders
@@ -190,7 +234,7 @@ class TicketOverviewController(AgencyPortalBase):
                 return request.redirect(f'/agency/tickets/overview/{order_id}')
 
             # Get visitors
-            visitors = order.visitor_form_ids if hasattr(order, 'visitor_form_ids') else []
+            visitors = order.visitor_form_ids if self._has_capability('sale_visitor_forms') else []
 
             values = self._prepare_values(
                 page_name='ticket_order_edit',
@@ -204,87 +248,154 @@ class TicketOverviewController(AgencyPortalBase):
             return request.redirect('/agency/tickets/overview')
 
     @http.route('/agency/api/tickets/order/update', type='json', auth='public', methods=['POST'], csrf=False)
-    def update_order(self, order_id, visitors=None, **kw):
-        """Update order visitors"""
+    @agency_context()
+    def update_order(self, ctx, order_id, visitors=None, deleted_ids=None, partial=False, **kw):
+        """Update order visitors.
+
+        ``visitors`` are matched to existing visitors by ``id``, else by
+        ``visitor_index``; only changed ones are written and unmatched ones
+        are created. ``deleted_ids`` are removed. Without ``partial``, the
+        list is the full visitor list and visitors missing from it are
+        removed too. Returns the visitors of the order after the update.
+        """
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
-            agency_data = self._get_agency_data()
-            if not agency_data:
-                return {'success': False, 'error': 'Agency not found'}
+            agency_data = ctx.agency
 
-            order = request.env['sale.order'].sudo().browse(int(order_id))
-            if not order.exists() or f"AGENCY_{agency_data['id']}_" not in (order.client_order_ref or ''):
+            order = self._get_agency_order(order_id, agency_data)
+            if not order:
                 return {'success': False, 'error': 'Order not found'}
 
             if order.state != 'draft':
                 return {'success': False, 'error': 'Cannot edit confirmed orders'}
 
+            if not self._has_capability('sale_visitor_forms'):
+                return {'success': False, 'error': 'Visitor forms are not available'}
+
             # Update visitors
-            if visitors:
-                self._update_order_visitors(order, visitors)
+            if visitors or deleted_ids:
+                self._update_order_visitors(order, visitors or [], deleted_ids or [], partial=partial)
 
-            return {'success': True, 'message': 'Order updated successfully'}
+            return {
+                'success': True,
+                'message': 'Order updated successfully',
+                'visitors': [self._visitor_to_dict(visitor) for visitor in order.visitor_form_ids],
+            }
 
         except Exception as e:
             _logger.error(f"Error updating order: {str(e)}", exc_info=True)
             return {'success': False, 'error': str(e)}
 
-    def _update_order_visitors(self, order, visitors):
-        """Update visitor records for order"""
-        VisitorForm = request.env['visitor.form'].sudo()
+    def _update_order_visitors(self, order, visitors, deleted_ids=(), partial=False):
+        """Apply a visitor diff to an order with batched unlink, write and create"""
+        existing = order.visitor_form_ids
+        by_id = {visitor.id: visitor for visitor in existing}
+        # Visitors sent without id are matched on their slot; indexes restart
+        # for every product. No product is False on both sides.
+        by_slot = {
+            (visitor.product_template_id.id or False, visitor.visitor_index): visitor for visitor in existing
+        }
 
-        # Delete existing visitors
-        if hasattr(order, 'visitor_form_ids'):
-            order.visitor_form_ids.unlink()
+        # Product templates of new visitors in one query
+        product_ids = {
+            int(v['product_id']) for v in visitors
+            if not v.get('product_template_id') and v.get('product_id')
+        }
+        products = request.env['product.product'].sudo().browse(list(product_ids)).exists()
+        template_by_product = {product.id: product.product_tmpl_id.id for product in products}
 
-        # Create new visitors
+        matched = request.env['visitor.form'].sudo()
+        updates = {}
+        create_vals = []
         for v in visitors:
-            product_template_id = v.get('product_template_id')
-            if not product_template_id:
-                product_id = v.get('product_id')
-                if product_id:
-                    product = request.env['product.product'].sudo().browse(int(product_id))
-                    product_template_id = product.product_tmpl_id.id if product.exists() else False
-
-            VisitorForm.create({
-                'sale_order_id': order.id,
-                'visitor_first_name': v.get('first_name', ''),
-                'visitor_last_name': v.get('last_name', ''),
-                'visitor_phone': v.get('phone', ''),
-                'visitor_email': v.get('email', ''),
-                'visitor_identity': v.get('identity', ''),
-                'product_template_id': int(product_template_id) if product_template_id else False,
-                'visitor_index': v.get('visitor_index', 0),
-            })
+            vals = self._visitor_vals(v, template_by_product)
+            if v.get('id'):
+                visitor = by_id.get(int(v['id']))
+            elif 'visitor_index' in vals:
+                visitor = by_slot.get((vals.get('product_template_id') or False, vals['visitor_index']))
+            else:
+                # Neither id nor slot: a new visitor
+                visitor = None
+            if visitor is None or visitor in matched:
+                create_vals.append(dict(NEW_VISITOR_VALS, **vals, sale_order_id=order.id))
+                continue
+            matched |= visitor
+            # Only the fields sent by the client are compared and written
+            changed = {
+                fname: value for fname, value in vals.items()
+                if self._visitor_value(visitor, fname) != value
+            }
+            if changed:
+                # Identical changes are written together
+                key = tuple(sorted(changed.items()))
+                updates[key] = updates.get(key, request.env['visitor.form'].sudo()) | visitor
+
+        deleted = {int(visitor_id) for visitor_id in deleted_ids}
+        to_delete = existing.filtered(lambda visitor: visitor.id in deleted)
+        if not partial:
+            to_delete |= existing - matched
+        to_delete.unlink()
+        for changes, records in updates.items():
+            records.write(dict(changes))
+        if create_vals:
+            request.env['visitor.form'].sudo().create(create_vals)
+
+    def _visitor_vals(self, v, template_by_product):
+        """visitor.form values of the fields sent for a visitor by the edit page"""
+        vals = {
+            fname: v[key] or '' for key, fname in VISITOR_FIELD_MAP.items() if key in v
+        }
+        if 'visitor_index' in v:
+            vals['visitor_index'] = int(v['visitor_index'] or 0)
+        product_template_id = v.get('product_template_id')
+        if not product_template_id and v.get('product_id'):
+            product_template_id = template_by_product.get(int(v['product_id']))
+        if product_template_id:
+            vals['product_template_id'] = int(product_template_id)
+        return vals
+
+    def _visitor_value(self, visitor, fname):
+        """Current value of a visitor field, in the form of _visitor_vals"""
+        if fname == 'product_template_id':
+            return visitor.product_template_id.id
+        if fname == 'visitor_index':
+            return visitor.visitor_index
+        return visitor[fname] or ''
+
+    def _visitor_to_dict(self, visitor):
+        return {
+            'id': visitor.id,
+            'first_name': visitor.visitor_first_name or '',
+            'last_name': visitor.visitor_last_name or '',
+            'phone': visitor.visitor_phone or '',
+            'email': visitor.visitor_email or '',
+            'identity': visitor.visitor_identity or '',
+            'product_template_id': visitor.product_template_id.id or False,
+            'visitor_index': visitor.visitor_index,
+        }
 
     # ==================== Delete Order ====================
 
     @http.route('/agency/api/tickets/order/delete', type='json', auth='public', methods=['POST'], csrf=False)
-    def delete_order(self, order_id, **kw):
+    @agency_context()
+    def delete_order(self, ctx, order_id, **kw):
         """Delete/Cancel order"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
+            agency_data = ctx.agency
 
-            agency_data = self._get_agency_data()
-            if not agency_data:
-                return {'success': False, 'error': 'Agency not found'}
-
-            order = request.env['sale.order'].sudo().browse(int(order_id))
-            if not order.exists() or f"AGENCY_{agency_data['id']}_" not in (order.client_order_ref or ''):
+            order = self._get_agency_order(int(order_id), agency_data)
+            if not order:
                 return {'success': False, 'error': 'Order not found'}
 
-            # Cancel order
+            # Tickets reserved at checkout go back with the order, see sale_order.py
             if order.state == 'draft':
                 # Delete draft orders
                 order.unlink()
-                return {'success': True, 'message': 'Order deleted successfully'}
+                message = 'Order deleted successfully'
             else:
                 # Cancel confirmed orders
                 order.action_cancel()
-                return {'success': True, 'message': 'Order cancelled successfully'}
+                message = 'Order cancelled successfully'
+            return {'success': True, 'message': message}
 
         except Exception as e:
             _logger.error(f"Error deleting order: {str(e)}", exc_info=True)
@@ -293,61 +404,61 @@ class TicketOverviewController(AgencyPortalBase):
     # ==================== API Endpoints ====================
 
     @http.route('/agency/api/tickets/orders', type='json', auth='public', methods=['POST'], csrf=False)
-    def get_orders(self, page=1, limit=20, **kw):
-        """Get orders list (paginated)"""
+    @agency_context()
+    def get_orders(self, ctx, page=1, limit=20, cursor=None, count='exact', **kw):
+        """Get orders list, newest first.
+
+        Pass the returned ``next_cursor`` as ``cursor`` to get the next page;
+        ``page`` is only used without cursor, for older clients. ``count``
+        is 'exact' (default), 'approx' (planner estimate) or False to skip
+        the total and pages.
+        """
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
-            agency_data = self._get_agency_data()
-            if not agency_data:
-                return {'success': False, 'error': 'Agency not found'}
-
-            domain = [('client_order_ref', 'like', f"AGENCY_{agency_data['id']}_")]
-
-            # Apply filters
-            if kw.get('date_from'):
-                domain.append(('date_order', '>=', kw['date_from']))
-            if kw.get('date_to'):
-                domain.append(('date_order', '<=', kw['date_to']))
-            if kw.get('status') and kw['status'] != 'all':
-                domain.append(('state', '=', kw['status']))
-            if kw.get('search'):
-                domain.extend(['|', ('name', 'ilike', kw['search']), ('partner_id.name', 'ilike', kw['search'])])
-
-            # Count total
-            total = request.env['sale.order'].sudo().search_count(domain)
-
-            # Get paginated orders
-            offset = (int(page) - 1) * int(limit)
-            orders = request.env['sale.order'].sudo().search(
-                domain,
-                order='date_order desc',
-                limit=int(limit),
-                offset=offset
-            )
+            agency_data = ctx.agency
+
+            SaleOrder = request.env['sale.order'].sudo()
+            limit = int(limit)
+            domain = self._build_order_domain(
+                agency_data, kw.get('date_from'), kw.get('date_to'), kw.get('status'), kw.get('search'))
+
+            # Keyset pagination on (date_order, id), served by the agency index
+            offset = 0
+            page_domain = list(domain)
+            if cursor:
+                cursor_date, cursor_id = self._parse_order_cursor(cursor)
+                page_domain += ['|', ('date_order', '<', cursor_date),
+                                '&', ('date_order', '=', cursor_date), ('id', '<', cursor_id)]
+            else:
+                offset = (int(page) - 1) * limit
 
-            order_list = []
-            for order in orders:
-                order_list.append({
-                    'id': order.id,
-                    'name': order.name,
-                    'date_order': order.date_order.strftime('%Y-%m-%d %H:%M') if order.date_order else '',
-                    'ticket_date': order.ticket_date.strftime('%Y-%m-%d') if hasattr(order, 'ticket_date') and order.ticket_date else '',
-                    'partner_name': order.partner_id.name if order.partner_id else '',
-                    'amount_total': order.amount_total,
-                    'state': order.state,
-                    'visitor_count': len(order.visitor_form_ids) if hasattr(order, 'visitor_form_ids') else 0,
-                })
+            # One extra row tells whether there is a next page
+            orders = SaleOrder.search(page_domain, order='date_order desc, id desc', limit=limit + 1, offset=offset)
+            has_more = len(orders) > limit
+            orders = orders[:limit]
+            order_list = self._serialize_orders(orders)
 
-            return {
+            total = None
+            if count == 'exact':
+                total = SaleOrder.search_count(domain)
+            elif count == 'approx':
+                total = self._estimate_order_count(domain)
+
+            result = {
                 'success': True,
                 'orders': order_list,
-                'total': total,
-                'page': page,
                 'limit': limit,
-                'pages': (total + int(limit) - 1) // int(limit)
+                'has_more': has_more,
+                'next_cursor': self._format_order_cursor(orders[-1]) if has_more else None,
             }
+            if total is not None:
+                result.update({
+                    'total': total,
+                    'total_is_estimate': count == 'approx',
+                    'pages': (total + limit - 1) // limit,
+                })
+            if not cursor:
+                result['page'] = page
+            return result
 
         except Exception as e:
             _logger.error(f"Error getting orders: {str(e)}", exc_info=True)
@@ -3,12 +3,12 @@
 Ticket Sales Controller for Agency Portal
 Communicates with Ticket API to manage ticket sales
 """
-import copy
 import logging
 from datetime import datetime
 from odoo import http, _
 from odoo.http import request
-from .base import AgencyPortalBase
+from ..utils.cart_trace import cart_trace
+from .base import AgencyPortalBase, agency_context
 
 _logger = logging.getLogger(__name__)
 
@@ -16,125 +16,28 @@ _logger = logging.getLogger(__name__)
 class TicketSalesController(AgencyPortalBase):
     """Ticket sales management controllers using Ticket API"""
 
-    def _get_cart_key(self):
-        """Get session key for ticket cart"""
-        agency_data = self._get_agency_data()
-        agency_id = agency_data.get('id', 0) if agency_data else 0
-        cart_key = f'ticket_cart_{agency_id}'
-        _logger.info(f"[CART-KEY] agency_id={agency_id}, cart_key={cart_key}")
-        return cart_key
-
-    def _get_cart(self):
-        """Get cart from session"""
-        cart_key = self._get_cart_key()
-        # Get raw session data
-        raw_cart = request.session.get(cart_key)
-        _logger.info(f"[CART-GET] key={cart_key}, raw_cart={raw_cart}")
-
-        if raw_cart is None:
-            cart = {'lines': [], 'visit_date': None, 'total': 0}
-            _logger.info(f"[CART-GET] Returning default empty cart")
-        else:
-            cart = raw_cart
-            _logger.info(f"[CART-GET] Cart lines count: {len(cart.get('lines', []))}")
-            for i, line in enumerate(cart.get('lines', [])):
-                _logger.info(f"[CART-GET] Line {i}: variant_id={line.get('variant_id')}, qty={line.get('quantity')}")
-
-        return cart
-
-    def _save_cart(self, cart):
-        """Save cart to session"""
-        cart_key = self._get_cart_key()
-        _logger.info(f"[CART-SAVE] key={cart_key}, lines_count={len(cart.get('lines', []))}")
-        for i, line in enumerate(cart.get('lines', [])):
-            _logger.info(f"[CART-SAVE] Line {i}: variant_id={line.get('variant_id')}, qty={line.get('quantity')}")
-
-        # Deep copy to ensure session detects change and prevent reference issues
-        cart_copy = copy.deepcopy(cart)
-
-        request.session[cart_key] = cart_copy
-        request.session.modified = True
-
-        # Force session save by triggering rotation check
-        if hasattr(request.session, 'should_save') and callable(request.session.should_save):
-            request.session.should_save = True
-
-        # Verify save
-        verify_cart = request.session.get(cart_key)
-        _logger.info(f"[CART-SAVE-VERIFY] Saved cart has {len(verify_cart.get('lines', []))} lines")
-
-    def _clear_cart(self):
-        """Clear cart from session"""
-        request.session.pop(self._get_cart_key(), None)
-
-    # ==================== Visitor Helper Methods ====================
-
-    def _get_visitors_key(self):
-        """Get session key for visitors"""
-        agency_data = self._get_agency_data()
-        agency_id = agency_data.get('id', 0) if agency_data else 0
-        return f'ticket_visitors_{agency_id}'
-
-    def _clear_visitors(self):
-        """Clear visitors from session"""
-        request.session.pop(self._get_visitors_key(), None)
-
-    def _delete_unused_visitors(self):
-        """Deletes visitors whose index exceeds current cart quantity.
-        Only removes excess visitors when quantity is reduced.
-        """
-        cart = self._get_cart()
-        visitors = request.session.get(self._get_visitors_key(), [])
-
-        _logger.info(f"_delete_unused_visitors (ticket_sales) - Cart: {cart}")
-        _logger.info(f"_delete_unused_visitors (ticket_sales) - Visitors before: {visitors}")
-
-        # Build dict of variant_id (as string) -> quantity from cart
-        cart_quantities = {}
-        for line in cart.get('lines', []):
-            variant_id = line.get('variant_id') or line.get('product_id')
-            if variant_id:
-                # Convert to string for consistent comparison with JS data
-                cart_quantities[str(variant_id)] = line.get('quantity', 0)
-
-        _logger.info(f"_delete_unused_visitors (ticket_sales) - cart_quantities: {cart_quantities}")
-
-        # Keep visitors whose index is within the cart quantity
-        updated_visitors = []
-        for visitor in visitors:
-            # Convert variant_id to string for comparison
-            variant_id = str(visitor.get('variant_id', ''))
-            visitor_index = visitor.get('visitor_index', 0)
-            max_quantity = cart_quantities.get(variant_id, 0)
-
-            _logger.info(f"_delete_unused_visitors (ticket_sales) - Checking visitor: variant_id={variant_id}, index={visitor_index}, max_qty={max_quantity}")
-
-            # Keep if variant still in cart AND visitor_index <= quantity
-            if variant_id in cart_quantities and visitor_index <= max_quantity:
-                updated_visitors.append(visitor)
-                _logger.info(f"_delete_unused_visitors (ticket_sales) - KEEPING visitor")
-            else:
-                _logger.info(f"_delete_unused_visitors (ticket_sales) - REMOVING visitor")
-
-        _logger.info(f"_delete_unused_visitors (ticket_sales) - Visitors after: {updated_visitors}")
-
-        request.session[self._get_visitors_key()] = updated_visitors
-        return updated_visitors
+    def _apply_held_stock(self, products, visit_date):
+        """Subtract stock held by other carts from product and variant stock"""
+        held = request.env['agency.ticket.hold'].sudo().get_held_quantities(
+            visit_date, exclude_cart_id=self._get_ticket_cart(create=False).id or None)
+        if not held:
+            return
+        for product in products:
+            for item in [product] + (product.get('variants') or []):
+                if 'available_stock' in item and item.get('id') in held:
+                    item['available_stock'] = max(0, (item['available_stock'] or 0) - held[item['id']])
 
     # ==================== Main Page ====================
 
     @http.route('/agency/tickets', type='http', auth="public", website=True, csrf=False)
-    def ticket_sales_page(self, **kw):
+    @agency_context()
+    def ticket_sales_page(self, ctx, **kw):
         """Main ticket sales page"""
         try:
-            if not self._is_authenticated():
-                return request.redirect('/agency/login')
-
-            user_data = self._get_current_user()
-            agency_data = self._get_agency_data()
+            agency_data = ctx.agency
 
             # Check if agency has Tickets purpose
-            if not agency_data or not agency_data.get('has_tickets', False):
+            if not agency_data.get('has_tickets', False):
                 return request.render('eth_agency_portal.agency_access_denied',
                     self._prepare_values(
                         page_name='tickets',
@@ -142,8 +45,7 @@ class TicketSalesController(AgencyPortalBase):
                     ))
 
             # Check permissions
-            permissions = user_data.get('permissions', {}) if user_data else {}
-            can_manage = permissions.get('can_manage_bookings', True) if permissions else True
+            can_manage = ctx.permissions.get('can_manage_bookings', True) if ctx.permissions else True
 
             if not can_manage:
                 return request.render('eth_agency_portal.agency_access_denied',
@@ -153,7 +55,7 @@ class TicketSalesController(AgencyPortalBase):
                     ))
 
             # Get current cart
-            cart = self._get_cart()
+            cart = self._get_ticket_cart(create=False).to_dict()
 
             values = self._prepare_values(
                 page_name='tickets',
@@ -168,12 +70,10 @@ class TicketSalesController(AgencyPortalBase):
     # ==================== API Endpoints ====================
 
     @http.route('/agency/api/tickets/types', type='json', auth='public', methods=['POST'], csrf=False)
-    def get_ticket_types(self, **kw):
+    @agency_context()
+    def get_ticket_types(self, ctx, **kw):
         """Get available ticket types"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
             api_client = request.env['travel.api.client'].sudo()
             result = api_client.get_ticket_types()
 
@@ -195,25 +95,13 @@ class TicketSalesController(AgencyPortalBase):
             return {'success': False, 'error': str(e)}
 
     @http.route('/agency/api/tickets/products', type='json', auth='public', methods=['POST'], csrf=False)
-    def get_products(self, ticket_type=None, visit_date=None, **kw):
+    @agency_context()
+    def get_products(self, ctx, ticket_type=None, visit_date=None, **kw):
         """Get ticket products from Ticket API"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
-            # Get agency commission settings
-            agency_data = self._get_agency_data()
-            commission_type = 'gross'
-            commission_percentage = 0.0
-
-            try:
-                if agency_data:
-                    agency = request.env['travel.agency'].sudo().browse(agency_data.get('id'))
-                    if agency.exists() and hasattr(agency, 'agency_group_id') and agency.agency_group_id:
-                        commission_type = agency.commission_type or 'gross'
-                        commission_percentage = agency.commission_percentage or 0.0
-            except Exception:
-                pass  # Commission fields may not exist yet
+            # Agency commission settings come with the request context
+            commission_type = ctx.commission_type
+            commission_percentage = ctx.commission_percentage
 
             api_client = request.env['travel.api.client'].sudo()
             result = api_client.get_ticket_products(
@@ -235,6 +123,10 @@ class TicketSalesController(AgencyPortalBase):
                         product['base_price'] = base_price
                         product['commission_included'] = True
 
+                # Stock held by other carts in checkout is not available
+                if visit_date:
+                    self._apply_held_stock(products, visit_date)
+
                 return {
                     'success': True,
                     'data': {
@@ -252,12 +144,10 @@ class TicketSalesController(AgencyPortalBase):
             return {'success': False, 'error': str(e)}
 
     @http.route('/agency/api/tickets/stock', type='json', auth='public', methods=['POST'], csrf=False)
-    def get_stock(self, product_id=None, visit_date=None, **kw):
+    @agency_context()
+    def get_stock(self, ctx, product_id=None, visit_date=None, **kw):
         """Get stock for a product on specific date"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
             if not product_id or not visit_date:
                 return {'success': False, 'error': 'product_id and visit_date are required'}
 
@@ -265,10 +155,12 @@ class TicketSalesController(AgencyPortalBase):
             result = api_client.get_ticket_stock(product_id, visit_date)
 
             if result.get('success'):
+                held = request.env['agency.ticket.hold'].sudo().get_held_quantities(
+                    visit_date, [product_id], exclude_cart_id=self._get_ticket_cart(create=False).id or None)
                 return {
                     'success': True,
                     'data': {
-                        'available_stock': result.get('available_stock', 0),
+                        'available_stock': max(0, result.get('available_stock', 0) - held.get(int(product_id), 0)),
                         'total_stock': result.get('total_stock', 0)
                     }
                 }
@@ -280,88 +172,90 @@ class TicketSalesController(AgencyPortalBase):
             return {'success': False, 'error': str(e)}
 
     @http.route('/agency/api/tickets/cart/add', type='json', auth='public', methods=['POST'], csrf=False)
-    def add_to_cart(self, product_id=None, product_name=None, quantity=1, price=0, visit_date=None, variant_id=None, ticket_product_type=None, current_cart=None, **kw):
+    @agency_context()
+    def add_to_cart(self, ctx, product_id=None, product_name=None, quantity=1, price=0, visit_date=None, variant_id=None, ticket_product_type=None, version=None, **kw):
         """Add product to cart"""
         try:
-            if not self._is_authenticated():
+            # Use variant_id if provided, otherwise use product_id
+            try:
+                line_variant_id = int(variant_id or product_id)
+            except (TypeError, ValueError):
+                return {'success': False, 'error': 'variant_id or product_id required'}
+
+            cart = self._get_ticket_cart()
+            if not cart:
                 return {'success': False, 'error': 'Unauthorized'}
 
-            _logger.info(f"")
-            _logger.info(f"========== ADD_TO_CART START ==========")
-            _logger.info(f"INPUT: variant_id={variant_id}, product_id={product_id}, quantity={quantity}")
+            # All or nothing: a failed change leaves the cart and its version untouched
+            with request.env.cr.savepoint():
+                # Reject changes made on a stale cart (e.g. from another tab) or
+                # without the version the client read
+                if cart._bump_version(version) is False:
+                    cart_trace(cart, 'cart.conflict', client_version=version, version=lambda: cart.version)
+                    return self._cart_conflict_response(cart)
+
+                # Changing the visit date empties the cart and its visitors
+                if visit_date:
+                    cart.set_visit_date(visit_date)
+
+                cart.set_line(
+                    line_variant_id,
+                    quantity,
+                    product_id=product_id,
+                    product_name=product_name,
+                    price=price,
+                    ticket_product_type=ticket_product_type,
+                )
+
+            cart_data = cart.to_dict()
+            cart_trace(cart, 'cart.add', variant_id=line_variant_id, quantity=quantity,
+                       lines=lambda: [(l['variant_id'], l['quantity']) for l in cart_data['lines']])
+
+            return {'success': True, 'cart': cart_data}
 
-            # Use frontend cart if provided (prevents session race condition)
-            if current_cart and current_cart.get('lines') is not None:
-                cart = current_cart
-                _logger.info(f"USING FRONTEND CART: {len(cart.get('lines', []))} lines")
-            else:
-                cart = self._get_cart()
-                _logger.info(f"USING SESSION CART: {len(cart.get('lines', []))} lines")
+        except Exception as e:
+            _logger.error(f"Error adding to cart: {str(e)}")
+            return {'success': False, 'error': str(e)}
 
-            # Update visit date
-            if visit_date:
-                # If visit date changed, clear cart and visitors
-                if cart.get('visit_date') and cart.get('visit_date') != visit_date and cart.get('lines'):
-                    cart = {'lines': [], 'visit_date': visit_date, 'total': 0}
-                    self._clear_visitors()
-                cart['visit_date'] = visit_date
+    @http.route('/agency/api/tickets/cart/apply', type='json', auth='public', methods=['POST'], csrf=False)
+    @agency_context()
+    def apply_cart_changes(self, ctx, operations=None, visitors=None, version=None, **kw):
+        """Apply a batch of cart line operations and visitor edits.
 
-            # Use variant_id if provided, otherwise use product_id
-            item_id = variant_id or product_id
-
-            # Check if product already in cart
-            existing_line = None
-            for line in cart.get('lines', []):
-                if line.get('variant_id') == item_id or line.get('product_id') == item_id:
-                    existing_line = line
-                    break
-
-            if existing_line:
-                if quantity <= 0:
-                    # Remove from cart
-                    cart['lines'] = [l for l in cart['lines'] if not (l.get('variant_id') == item_id or l.get('product_id') == item_id)]
-                else:
-                    existing_line['quantity'] = quantity
-                    existing_line['price'] = price
-                    if ticket_product_type:
-                        existing_line['ticket_product_type'] = ticket_product_type
-            else:
-                if quantity > 0:
-                    cart.setdefault('lines', []).append({
-                        'product_id': product_id,
-                        'variant_id': variant_id or product_id,
-                        'product_name': product_name,
-                        'quantity': quantity,
-                        'price': price,
-                        'ticket_product_type': ticket_product_type or '',
-                    })
-
-            # Calculate total
-            cart['total'] = sum(l['quantity'] * l['price'] for l in cart['lines'])
-            cart['item_count'] = sum(l['quantity'] for l in cart['lines'])
-
-            _logger.info(f"CART BEFORE SAVE: lines_count={len(cart['lines'])}, total={cart['total']}")
-            for i, line in enumerate(cart['lines']):
-                _logger.info(f"  Line {i}: variant_id={line.get('variant_id')}, name={line.get('product_name')}, qty={line.get('quantity')}")
-
-            self._save_cart(cart)
-            _logger.info(f"========== ADD_TO_CART END ==========")
-            _logger.info(f"")
+        operations: [{'op': 'set'|'remove'|'date', ...}], in order
+        visitors: [{'op': 'save'|'delete', ...}], applied after the lines
+        version: cart version the client last saw
+        """
+        try:
+            cart = self._get_ticket_cart()
 
-            return {'success': True, 'cart': cart}
+            # All or nothing: a rejected batch leaves the cart untouched
+            with request.env.cr.savepoint():
+                if cart._bump_version(version) is False:
+                    cart_trace(cart, 'cart.conflict', client_version=version, version=lambda: cart.version)
+                    return self._cart_conflict_response(cart)
+                cart.apply_changes(operations, visitors)
+
+            cart_trace(cart, 'cart.apply', operations=lambda: operations, visitors=lambda: visitors,
+                       total=lambda: cart.amount_total, items=lambda: cart.item_count)
+
+            return {
+                'success': True,
+                'cart': cart.to_dict(),
+                'visitors': cart.get_visitors(),
+                'version': cart.version,
+            }
 
         except Exception as e:
-            _logger.error(f"Error adding to cart: {str(e)}")
+            _logger.error(f"Error applying cart changes: {str(e)}")
             return {'success': False, 'error': str(e)}
 
     @http.route('/agency/api/tickets/cart/get', type='json', auth='public', methods=['POST'], csrf=False)
-    def get_cart(self, **kw):
+    @agency_context()
+    def get_cart(self, ctx, **kw):
         """Get current cart"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
-            cart = self._get_cart()
+            cart = self._get_ticket_cart(create=False).to_dict()
             return {'success': True, 'cart': cart}
 
         except Exception as e:
@@ -369,13 +263,11 @@ class TicketSalesController(AgencyPortalBase):
             return {'success': False, 'error': str(e)}
 
     @http.route('/agency/api/tickets/cart/clear', type='json', auth='public', methods=['POST'], csrf=False)
-    def clear_cart(self, **kw):
+    @agency_context()
+    def clear_cart(self, ctx, **kw):
         """Clear cart"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
-            self._clear_cart()
+            self._get_ticket_cart(create=False).clear()
             return {'success': True}
 
         except Exception as e:
@@ -383,17 +275,14 @@ class TicketSalesController(AgencyPortalBase):
             return {'success': False, 'error': str(e)}
 
     @http.route('/agency/api/tickets/order/create', type='json', auth='public', methods=['POST'], csrf=False)
-    def create_order(self, **kw):
+    @agency_context()
+    def create_order(self, ctx, **kw):
         """Create ticket order"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
-            agency_data = self._get_agency_data()
-            if not agency_data:
-                return {'success': False, 'error': 'Agency not found'}
+            agency_data = ctx.agency
 
-            cart = self._get_cart()
+            cart_record = self._get_ticket_cart(create=False)
+            cart = cart_record.to_dict()
             if not cart.get('lines'):
                 return {'success': False, 'error': 'Cart is empty'}
 
@@ -426,7 +315,7 @@ class TicketSalesController(AgencyPortalBase):
 
             if result.get('success'):
                 # Clear cart after successful order
-                self._clear_cart()
+                cart_record.clear()
 
                 return {
                     'success': True,
@@ -444,15 +333,11 @@ class TicketSalesController(AgencyPortalBase):
             return {'success': False, 'error': str(e)}
 
     @http.route('/agency/api/tickets/orders', type='json', auth='public', methods=['POST'], csrf=False)
-    def get_orders(self, **kw):
+    @agency_context()
+    def get_orders(self, ctx, **kw):
         """Get ticket orders for agency"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
-            agency_data = self._get_agency_data()
-            if not agency_data:
-                return {'success': False, 'error': 'Agency not found'}
+            agency_data = ctx.agency
 
             # For now, return empty list - orders are stored in ticket system
             # This could be enhanced to store local references
@@ -469,12 +354,10 @@ class TicketSalesController(AgencyPortalBase):
             return {'success': False, 'error': str(e)}
 
     @http.route('/agency/api/tickets/order/<int:order_id>', type='json', auth='public', methods=['POST'], csrf=False)
-    def get_order_detail(self, order_id, **kw):
+    @agency_context()
+    def get_order_detail(self, ctx, order_id, **kw):
         """Get order detail"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
             api_client = request.env['travel.api.client'].sudo()
             result = api_client.get_ticket_order(order_id)
 
@@ -488,12 +371,10 @@ class TicketSalesController(AgencyPortalBase):
             return {'success': False, 'error': str(e)}
 
     @http.route('/agency/api/tickets/order/<int:order_id>/confirm', type='json', auth='public', methods=['POST'], csrf=False)
-    def confirm_order(self, order_id, **kw):
+    @agency_context()
+    def confirm_order(self, ctx, order_id, **kw):
         """Confirm ticket order"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
             api_client = request.env['travel.api.client'].sudo()
             result = api_client.confirm_ticket_order(order_id)
 
@@ -507,12 +388,10 @@ class TicketSalesController(AgencyPortalBase):
             return {'success': False, 'error': str(e)}
 
     @http.route('/agency/api/tickets/order/<int:order_id>/cancel', type='json', auth='public', methods=['POST'], csrf=False)
-    def cancel_order(self, order_id, **kw):
+    @agency_context()
+    def cancel_order(self, ctx, order_id, **kw):
         """Cancel ticket order"""
         try:
-            if not self._is_authenticated():
-                return {'success': False, 'error': 'Unauthorized'}
-
             api_client = request.env['travel.api.client'].sudo()
             result = api_client.cancel_ticket_order(order_id)
 
@@ -6,7 +6,7 @@ import json
 from odoo import http, _
 from odoo.http import request
 from werkzeug.wrappers import Response
-from .base import AgencyPortalBase, require_auth, auto_language
+from .base import AgencyPortalBase, agency_context
 
 _logger = logging.getLogger(__name__)
 
@@ -34,13 +34,12 @@ class UserManagementController(AgencyPortalBase):
         )
 
     @http.route('/agency/users', type='http', auth="public", website=True, csrf=False)
-    @require_auth()
-    @auto_language
-    def agency_users(self, **kwargs):
+    @agency_context()
+    def agency_users(self, ctx, **kwargs):
         """Agency users management page"""
         try:
             # Check permission
-            if not self._has_permission('can_create_users'):
+            if not ctx.has_permission('can_create_users'):
                 return request.render('eth_agency_portal.agency_access_denied',
                     self._prepare_values(
                         page_name='users',
@@ -49,7 +48,7 @@ class UserManagementController(AgencyPortalBase):
 
             # Get agency users
             try:
-                token = request.session.get('agency_token')
+                token = ctx.token
                 auth_service = request.env['agency.auth.service'].sudo()
                 result = auth_service.get_agency_users(token)
                 users = result['users'] if result['success'] else []
@@ -69,13 +68,12 @@ class UserManagementController(AgencyPortalBase):
             return request.redirect('/agency/dashboard')
 
     @http.route('/agency/users/create', type='http', auth="public", website=True, csrf=False)
-    @require_auth()
-    @auto_language
-    def agency_user_create(self, **kwargs):
+    @agency_context()
+    def agency_user_create(self, ctx, **kwargs):
         """Create new agency user - AUTO PASSWORD GENERATION"""
         try:
             # Check permission
-            if not self._has_permission('can_create_users'):
+            if not ctx.has_permission('can_create_users'):
                 return request.render('eth_agency_portal.agency_access_denied',
                     self._prepare_values(
                         page_name='users',
@@ -115,7 +113,7 @@ class UserManagementController(AgencyPortalBase):
                         values['error'] = _('Name and email are required.')
                     else:
                         # Create user
-                        token = request.session.get('agency_token')
+                        token = ctx.token
                         auth_service = request.env['agency.auth.service'].sudo()
                         result = auth_service.create_agency_user(new_user_data, token)
 
@@ -140,13 +138,12 @@ class UserManagementController(AgencyPortalBase):
             return request.redirect('/agency/users')
 
     @http.route('/agency/users/edit/<int:user_id>', type='http', auth="public", website=True, csrf=False)
-    @require_auth()
-    @auto_language
-    def agency_user_edit(self, user_id, **kwargs):
+    @agency_context()
+    def agency_user_edit(self, ctx, user_id, **kwargs):
         """Edit agency user"""
         try:
             # Check permission
-            if not self._has_permission('can_create_users'):
+            if not ctx.has_permission('can_create_users'):
                 return request.render('eth_agency_portal.agency_access_denied',
                     self._prepare_values(
                         page_name='users',
@@ -155,7 +152,7 @@ class UserManagementController(AgencyPortalBase):
 
             # Get user to edit
             try:
-                token = request.session.get('agency_token')
+                token = ctx.token
                 auth_service = request.env['agency.auth.service'].sudo()
                 result = auth_service.get_agency_users(token)
 
@@ -221,15 +218,15 @@ class UserManagementController(AgencyPortalBase):
             return request.redirect('/agency/users')
 
     @http.route('/agency/users/delete/<int:user_id>', type='http', auth="public", website=True, csrf=False)
-    @require_auth()
-    def agency_user_delete(self, user_id, **kwargs):
+    @agency_context()
+    def agency_user_delete(self, ctx, user_id, **kwargs):
         """Delete agency user"""
         try:
             # Check permission
-            if not self._has_permission('can_create_users'):
+            if not ctx.has_permission('can_create_users'):
                 return request.redirect('/agency/users')
 
-            token = request.session.get('agency_token')
+            token = ctx.token
             auth_service = request.env['agency.auth.service'].sudo()
             auth_service.delete_agency_user(user_id, token)
 
@@ -239,11 +236,11 @@ class UserManagementController(AgencyPortalBase):
         return request.redirect('/agency/users')
 
     @http.route('/agency/users/send_credentials/<int:user_id>', type='http', auth="public", methods=['POST'], csrf=False)
-    @require_auth()
-    def send_user_credentials(self, user_id, **kwargs):
+    @agency_context()
+    def send_user_credentials(self, ctx, user_id, **kwargs):
         """Send login credentials to user via email"""
         try:
-            token = request.session.get('agency_token')
+            token = ctx.token
             auth_service = request.env['agency.auth.service'].sudo()
             result = auth_service.get_agency_users(token)
 
@@ -339,11 +336,11 @@ class UserManagementController(AgencyPortalBase):
             })
 
     @http.route('/agency/users/reset_password/<int:user_id>', type='http', auth="public", methods=['POST'], csrf=False)
-    @require_auth()
-    def reset_user_password(self, user_id, **kwargs):
+    @agency_context()
+    def reset_user_password(self, ctx, user_id, **kwargs):
         """Reset password and send to user via email"""
         try:
-            token = request.session.get('agency_token')
+            token = ctx.token
             auth_service = request.env['agency.auth.service'].sudo()
             result = auth_service.get_agency_users(token)
 
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Backfill sale_order.portal_agency_id from the AGENCY_<id>_<timestamp>
+client reference of portal orders, in id ranges so large tables are not
+updated in one statement.
+"""
+import logging
+
+_logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 50000
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    cr.execute("""
+        SELECT min(id), max(id)
+          FROM sale_order
+         WHERE portal_agency_id IS NULL
+           AND client_order_ref LIKE 'AGENCY\\_%%'
+    """)
+    min_id, max_id = cr.fetchone()
+    if min_id is None:
+        return
+
+    updated = 0
+    for start in range(min_id, max_id + 1, CHUNK_SIZE):
+        cr.execute("""
+            UPDATE sale_order so
+               SET portal_agency_id = a.id
+              FROM travel_agency a
+             WHERE so.id >= %s AND so.id < %s
+               AND so.portal_agency_id IS NULL
+               AND so.client_order_ref LIKE 'AGENCY\\_%%'
+               AND a.id = substring(so.client_order_ref FROM '^AGENCY_([0-9]+)_')::int
+        """, [start, start + CHUNK_SIZE])
+        updated += cr.rowcount
+    _logger.info(f"Backfilled portal agency of {updated} sale orders")
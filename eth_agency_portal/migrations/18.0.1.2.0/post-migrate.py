@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+Fill the ticket sales rollup from existing agency orders.
+"""
+from odoo import api, SUPERUSER_ID
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env['agency.ticket.sales.rollup'].rebuild()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Fill the portal search document of existing agency orders, in batches.
+"""
+import logging
+from odoo import api, SUPERUSER_ID
+from odoo.tools import split_every
+
+_logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 2000
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    SaleOrder = env['sale.order'].with_context(active_test=False)
+    field = SaleOrder._fields['portal_search_text']
+    order_ids = SaleOrder.search([('portal_agency_id', '!=', False)]).ids
+    for batch_ids in split_every(BATCH_SIZE, order_ids):
+        orders = SaleOrder.browse(batch_ids)
+        env.add_to_compute(field, orders)
+        orders.flush_recordset(['portal_search_text'])
+        env.invalidate_all()
+    _logger.info(f"Filled the search document of {len(order_ids)} agency orders")
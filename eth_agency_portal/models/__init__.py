@@ -1,2 +1,18 @@
 # -*- coding: utf-8 -*-
 from . import travel_api_client
+from . import portal_language
+from . import portal_route_timing
+from . import ir_http
+from . import ir_qweb
+from . import ticket_cart
+from . import portal_capabilities
+from . import ticket_inventory
+from . import ticket_hold
+from . import checkout_request
+from . import portal_lookup
+from . import res_partner
+from . import sale_order
+from . import ticket_sales_rollup
+from . import report_export
+from . import report_job
+from . import stop_sales_report
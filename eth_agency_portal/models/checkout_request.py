@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Checkout Request - Idempotency keys of ticket checkout submissions
+
+The key is derived from the checkout session and the cart version. It is
+claimed with a unique constraint in the same savepoint that creates the
+order and stores the response, so a double click or a client retry cannot
+build a second order and gets the response of the first one instead.
+"""
+from datetime import timedelta
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+
+
+class AgencyCheckoutRequest(models.Model):
+    _name = 'agency.checkout.request'
+    _description = 'Agency Checkout Request'
+    _order = 'id desc'
+
+    key = fields.Char(string='Idempotency Key', required=True, readonly=True)
+    agency_user_id = fields.Many2one(
+        'agency.user', string='Agency User', required=True, ondelete='cascade', readonly=True
+    )
+    payment_method = fields.Char(string='Payment Method', readonly=True)
+    order_id = fields.Integer(string='Order ID', readonly=True)
+    response = fields.Json(string='Response', readonly=True)
+
+    _sql_constraints = [
+        ('key_unique', 'unique(key)', 'A checkout can only be submitted once.'),
+    ]
+
+    @api.model
+    def get_response(self, key, agency_user_id):
+        """Response of an already processed checkout, or None"""
+        if not key:
+            return None
+        checkout_request = self.search([
+            ('key', '=', key), ('agency_user_id', '=', agency_user_id),
+        ], limit=1)
+        return checkout_request.response or None
+
+    @api.model
+    def claim(self, key, agency_user_id, payment_method):
+        """Claim a key before any checkout write.
+
+        Returns the claimed request and None, or the request of an earlier
+        duplicate and its response. A duplicate still in flight makes this
+        wait; once it commits, its row is not visible to this transaction
+        and PostgreSQL raises a serialization failure, on which Odoo retries
+        the request and the retry replays the stored response.
+        """
+        self.flush_model()
+        self.env.cr.execute("""
+            INSERT INTO agency_checkout_request AS r
+                   (key, agency_user_id, payment_method, create_uid, create_date, write_uid, write_date)
+            VALUES (%(key)s, %(user)s, %(method)s, %(uid)s, now() at time zone 'UTC',
+                    %(uid)s, now() at time zone 'UTC')
+            ON CONFLICT (key) DO UPDATE
+               SET write_date = EXCLUDED.write_date
+         RETURNING r.id, r.agency_user_id, r.xmax = 0
+        """, {'key': key, 'user': agency_user_id, 'method': payment_method, 'uid': self.env.uid})
+        request_id, owner_id, inserted = self.env.cr.fetchone()
+        checkout_request = self.browse(request_id)
+        if inserted:
+            return checkout_request, None
+        if owner_id != agency_user_id:
+            raise UserError(_('This order is already being processed.'))
+        checkout_request.invalidate_recordset()
+        if not checkout_request.response:
+            # Left without a response by an earlier version, take it over
+            checkout_request.write({'payment_method': payment_method})
+            return checkout_request, None
+        return checkout_request, checkout_request.response
+
+    def set_response(self, order, response):
+        """Store the response replayed to retries of the request"""
+        self.write({'order_id': order.id, 'response': response})
+
+    @api.autovacuum
+    def _gc_checkout_requests(self):
+        """Remove keys older than a week, retries do not come that late"""
+        limit = fields.Datetime.now() - timedelta(days=7)
+        self.search([('create_date', '<', limit)]).unlink()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from odoo import models
+from odoo.http import request
+from .portal_route_timing import (
+    start_route_timing, stop_route_timing, server_timing_header, record_route_timing,
+)
+
+
+class IrHttp(models.AbstractModel):
+    _inherit = 'ir.http'
+
+    @classmethod
+    def _pre_dispatch(cls, rule, args):
+        super()._pre_dispatch(rule, args)
+        if rule.rule.startswith('/agency'):
+            request._agency_route = rule.rule
+
+    @classmethod
+    def _dispatch(cls, endpoint):
+        route = getattr(request, '_agency_route', None)
+        if not route:
+            return super()._dispatch(endpoint)
+
+        # Covers the handler and the template rendering of lazy responses
+        start_route_timing(route)
+        try:
+            return super()._dispatch(endpoint)
+        finally:
+            stop_route_timing()
+
+    @classmethod
+    def _post_dispatch(cls, response):
+        super()._post_dispatch(response)
+        timing = getattr(request, '_agency_timing', None)
+        if timing and 'wall_ms' in timing:
+            if timing['expose']:
+                response.headers['Server-Timing'] = server_timing_header(timing)
+            record_route_timing(timing)
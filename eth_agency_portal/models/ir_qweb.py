@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+from odoo import models
+from .portal_route_timing import route_timing
+
+
+class IrQweb(models.AbstractModel):
+    _inherit = 'ir.qweb'
+
+    def _render(self, template, values=None, **options):
+        with route_timing('render'):
+            return super()._render(template, values=values, **options)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Portal Capabilities - Optional models and fields available in this database
+
+Ticket checkout and overview work with extension modules (sale commission
+fields, ticket dates, visitor forms, daily inventory, payment) that may not
+be installed. Instead of querying information_schema or probing records
+with hasattr per request, the capability map is computed once per registry,
+when it is loaded or reloaded after a module update.
+"""
+import logging
+from types import MappingProxyType
+from odoo import models, api
+
+_logger = logging.getLogger(__name__)
+
+# Capability -> (model, field); field None checks the model only.
+# Fields are also checked in the database, columns of a freshly
+# installed module may not exist yet.
+CAPABILITIES = {
+    'sale_commission': ('sale.order', 'commission_percentage'),
+    'sale_commission_amount': ('sale.order', 'commission_amount'),
+    'sale_agency': ('sale.order', 'agency_id'),
+    'sale_ticket_date': ('sale.order', 'ticket_date'),
+    'sale_visitor_forms': ('sale.order', 'visitor_form_ids'),
+    'visitor_form': ('visitor.form', None),
+    'daily_inventory': ('eth.daily.inventory', None),
+    'payment_provider': ('payment.provider', None),
+    'payment_transaction': ('payment.transaction', None),
+    'travel_hotel': ('eth.travel.hotel', None),
+    'travel_hotel_code': ('eth.travel.hotel', 'code'),
+    'travel_hotel_city': ('eth.travel.hotel', 'city_id'),
+    'update_request_hotels': ('agency.update.request', 'hotel_ids'),
+    'agency_interested_hotels': ('travel.agency', 'interested_hotel_ids'),
+}
+
+# Capability -> (model, candidate fields); resolves to the name of the
+# first candidate stored in the database, or False
+FIELD_CAPABILITIES = {
+    # Daily ticket capacity, checked when inventory is reserved; the
+    # eth_agency_portal.daily_inventory_capacity_field parameter overrides
+    # the guess (see agency.ticket.inventory)
+    'daily_inventory_capacity': ('eth.daily.inventory', ('total_qty', 'stock_qty', 'capacity')),
+    # Commission fields usable in SQL and read_group; the amount may be
+    # computed without being stored
+    'sale_commission_amount_stored': ('sale.order', ('commission_amount',)),
+    'sale_commission_type_stored': ('sale.order', ('commission_type',)),
+    'sale_commission_percentage_stored': ('sale.order', ('commission_percentage',)),
+}
+
+
+class AgencyPortalCapabilities(models.AbstractModel):
+    _name = 'agency.portal.capabilities'
+    _description = 'Agency Portal Capabilities'
+
+    def _register_hook(self):
+        super()._register_hook()
+        capabilities = self.pool._agency_portal_capabilities = self._compute_capabilities()
+        if capabilities['daily_inventory'] and not capabilities['daily_inventory_capacity']:
+            _logger.warning(
+                "eth.daily.inventory has none of the capacity fields %s: ticket availability is not "
+                "checked unless eth_agency_portal.daily_inventory_capacity_field names one",
+                FIELD_CAPABILITIES['daily_inventory_capacity'][1],
+            )
+
+    @api.model
+    def get(self, capability=None):
+        """Get the capability map, or whether a single capability is available"""
+        capabilities = getattr(self.pool, '_agency_portal_capabilities', None)
+        if capabilities is None:
+            # Registry still loading, hook not run yet
+            capabilities = self.pool._agency_portal_capabilities = self._compute_capabilities()
+        if capability is None:
+            return capabilities
+        return capabilities.get(capability, False)
+
+    def _compute_capabilities(self):
+        checked_fields = list(CAPABILITIES.values())
+        for model_name, field_names in FIELD_CAPABILITIES.values():
+            checked_fields.extend((model_name, field_name) for field_name in field_names)
+
+        stored_columns = {}
+        for model_name, field_name in checked_fields:
+            if field_name and model_name in self.env:
+                field = self.env[model_name]._fields.get(field_name)
+                if field and field.store and field.column_type:
+                    stored_columns.setdefault(self.env[model_name]._table, set()).add(field_name)
+
+        existing_columns = set()
+        if stored_columns:
+            self.env.cr.execute("""
+                SELECT table_name, column_name
+                  FROM information_schema.columns
+                 WHERE table_schema = current_schema()
+                   AND table_name IN %s
+            """, [tuple(stored_columns)])
+            existing_columns = set(self.env.cr.fetchall())
+
+        def is_available(model_name, field_name):
+            if model_name not in self.env:
+                return False
+            if not field_name:
+                return True
+            Model = self.env[model_name]
+            field = Model._fields.get(field_name)
+            if not field:
+                return False
+            if field.store and field.column_type:
+                return (Model._table, field_name) in existing_columns
+            return True
+
+        capabilities = {
+            capability: is_available(model_name, field_name)
+            for capability, (model_name, field_name) in CAPABILITIES.items()
+        }
+        for capability, (model_name, field_names) in FIELD_CAPABILITIES.items():
+            capabilities[capability] = next(
+                (name for name in field_names
+                 if is_available(model_name, name) and self.env[model_name]._fields[name].store),
+                False,
+            )
+        return MappingProxyType(capabilities)
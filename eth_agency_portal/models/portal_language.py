@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Portal Language - Precomputed per-language data for the agency portal
+"""
+from odoo import models, api, tools, _
+
+
+class AgencyPortalLanguage(models.AbstractModel):
+    _name = 'agency.portal.language'
+    _description = 'Agency Portal Language'
+
+    # Entries live in the registry ormcache: they are per database and are
+    # dropped on every registry cache invalidation (language activation,
+    # module update), which is signaled to all workers.
+
+    @api.model
+    def get_available_languages(self):
+        """Get active languages as (code, name) pairs"""
+        return self.env['res.lang'].get_installed()
+
+    @api.model
+    def get_translatable_terms(self, lang):
+        """Get common translatable terms for templates"""
+        return dict(self._get_translatable_terms_cached(lang))
+
+    @tools.ormcache('lang')
+    def _get_translatable_terms_cached(self, lang):
+        return self.with_context(lang=lang)._compute_translatable_terms()
+
+    def _compute_translatable_terms(self):
+        return {
+            'dashboard': _('Dashboard'),
+            'users': _('Users'),
+            'settings': _('Settings'),
+            'logout': _('Logout'),
+            'reports': _('Reports'),
+            'bookings': _('Bookings'),
+            'bonus': _('Bonus'),
+            'tickets': _('Tickets'),
+            'messages': _('Messages'),
+            'announcements': _('Announcements'),
+            'save': _('Save'),
+            'cancel': _('Cancel'),
+            'confirm': _('Confirm'),
+            'delete': _('Delete'),
+            'edit': _('Edit'),
+            'view': _('View'),
+            'loading': _('Loading...'),
+            'error': _('Error'),
+            'success': _('Success'),
+            'warning': _('Warning'),
+        }
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Portal Lookup - Cached reference data of the checkout and billing pages
+
+The EUR currency and pricelist, the enabled payment providers and the
+country list rarely change but used to be searched on every checkout.
+
+Cached entries are keyed on a lookup version. Models the lookups read
+inherit agency.portal.lookup.mixin, which bumps the version when a
+record is created or deleted, or when a field read by the lookups is
+written. The version is a table row updated in the writing transaction,
+so other workers see it together with the data it covers; entries of
+older versions are never read again and age out of the ormcache. Nothing
+else in the registry cache is cleared.
+"""
+from collections import namedtuple
+from odoo import models, fields, api, tools
+
+# Record stand-in for templates, which only use id and name
+LookupRecord = namedtuple('LookupRecord', ['id', 'name'])
+
+
+class AgencyPortalLookup(models.AbstractModel):
+    _name = 'agency.portal.lookup'
+    _description = 'Agency Portal Lookup'
+
+    @api.model
+    def get_pricelist_id(self, currency_name='EUR', company_id=None):
+        """Get the first active pricelist of a currency, or False"""
+        return self._get_pricelist_id(currency_name, company_id or self.env.company.id, self._get_version())
+
+    @api.model
+    def get_payment_providers(self, company_id=None):
+        """Get the enabled, published payment providers"""
+        return self._get_payment_providers(company_id or self.env.company.id, self.env.lang, self._get_version())
+
+    @api.model
+    def get_countries(self):
+        """Get all countries ordered by name"""
+        return self._get_countries(self.env.lang, self._get_version())
+
+    @api.model
+    def _get_version(self):
+        """Current lookup version, part of every cache key"""
+        self.env.cr.execute("SELECT version FROM agency_portal_lookup_version WHERE id = 1")
+        row = self.env.cr.fetchone()
+        return row[0] if row else 0
+
+    @api.model
+    def _bump_version(self):
+        """Make the cached lookups stale, for all workers once committed"""
+        self.env.cr.execute("""
+            INSERT INTO agency_portal_lookup_version (id, version) VALUES (1, 1)
+            ON CONFLICT (id) DO UPDATE SET version = agency_portal_lookup_version.version + 1
+        """)
+
+    @tools.ormcache('currency_name', 'company_id', 'version')
+    def _get_pricelist_id(self, currency_name, company_id, version):
+        currency = self.env['res.currency'].sudo().search([('name', '=', currency_name)], limit=1)
+        if not currency:
+            return False
+        pricelist = self.env['product.pricelist'].sudo().search([
+            ('currency_id', '=', currency.id),
+            ('active', '=', True),
+            ('company_id', 'in', [company_id, False]),
+        ], limit=1)
+        return pricelist.id
+
+    @tools.ormcache('company_id', 'lang', 'version')
+    def _get_payment_providers(self, company_id, lang, version):
+        providers = self.env['payment.provider'].sudo().with_context(lang=lang).search([
+            ('state', '=', 'enabled'),
+            ('is_published', '=', True),
+            ('company_id', '=', company_id),
+        ])
+        return tuple(LookupRecord(provider.id, provider.name) for provider in providers)
+
+    @tools.ormcache('lang', 'version')
+    def _get_countries(self, lang, version):
+        countries = self.env['res.country'].sudo().with_context(lang=lang).search([], order='name')
+        return tuple(LookupRecord(country.id, country.name) for country in countries)
+
+
+class AgencyPortalLookupVersion(models.Model):
+    _name = 'agency.portal.lookup.version'
+    _description = 'Agency Portal Lookup Version'
+    _log_access = False
+
+    # Single row (id 1), read and bumped in SQL by agency.portal.lookup
+    version = fields.Integer(required=True, default=0)
+
+
+class AgencyPortalLookupMixin(models.AbstractModel):
+    _name = 'agency.portal.lookup.mixin'
+    _description = 'Agency Portal Lookup Invalidation'
+
+    # Fields read by agency.portal.lookup, including its search orders;
+    # writes of other fields keep the cached lookups
+    _portal_lookup_fields = ()
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env['agency.portal.lookup']._bump_version()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if not set(self._portal_lookup_fields).isdisjoint(vals):
+            self.env['agency.portal.lookup']._bump_version()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env['agency.portal.lookup']._bump_version()
+        return res
+
+
+class ResCurrency(models.Model):
+    _name = 'res.currency'
+    _inherit = ['res.currency', 'agency.portal.lookup.mixin']
+
+    _portal_lookup_fields = ('name', 'active')
+
+
+class ProductPricelist(models.Model):
+    _name = 'product.pricelist'
+    _inherit = ['product.pricelist', 'agency.portal.lookup.mixin']
+
+    _portal_lookup_fields = ('currency_id', 'active', 'company_id', 'sequence')
+
+
+class ResCountry(models.Model):
+    _name = 'res.country'
+    _inherit = ['res.country', 'agency.portal.lookup.mixin']
+
+    _portal_lookup_fields = ('name',)
+
+
+class PaymentProvider(models.Model):
+    _name = 'payment.provider'
+    _inherit = ['payment.provider', 'agency.portal.lookup.mixin']
+
+    _portal_lookup_fields = ('state', 'is_published', 'company_id', 'name', 'sequence')
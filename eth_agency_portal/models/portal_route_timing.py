@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Portal Route Timing - Per-route performance instrumentation for /agency routes
+
+Each /agency request collects wall time, SQL query count and time, Travel API
+time and template render time (see ir.http and ir.qweb overrides). Samples are
+buffered per worker and flushed in batches to agency.portal.route.sample;
+agency.portal.route.stat aggregates them into percentiles for administrators.
+The measures are only sent back in a Server-Timing header to internal users,
+or to everyone when eth_agency_portal.server_timing_header is set.
+"""
+import cProfile
+import functools
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+from odoo import models, fields, api, tools, SUPERUSER_ID
+from odoo.http import request
+
+_logger = logging.getLogger(__name__)
+
+# Worker-level sample buffers, per database
+FLUSH_SIZE = 50
+FLUSH_INTERVAL = 60
+_buffers = {}
+_last_flush = {}
+_lock = threading.Lock()
+
+
+def _current_timing():
+    """Get the timing record of the current /agency request, if any"""
+    try:
+        return getattr(request, '_agency_timing', None) if request else None
+    except RuntimeError:
+        return None
+
+
+@contextmanager
+def route_timing(key):
+    """Accumulate the duration of the block under ``key`` for the current request.
+
+    Nested blocks with the same key are only counted once.
+    """
+    timing = _current_timing()
+    if timing is None or timing['depth'].get(key):
+        yield
+        return
+    timing['depth'][key] = 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing[key] += time.perf_counter() - start
+        timing['depth'][key] = 0
+
+
+def timed(key):
+    """Decorator version of route_timing"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with route_timing(key):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _expose_server_timing(ICP):
+    """Whether the Server-Timing header is sent: when enabled by parameter,
+    else only to internal users also logged in to the backend"""
+    if ICP.get_param('eth_agency_portal.server_timing_header', 'False').lower() in ('1', 'true'):
+        return True
+    return bool(request.session.uid) and request.env.user._is_internal()
+
+
+def start_route_timing(route):
+    """Start collecting timings for the current request"""
+    current_thread = threading.current_thread()
+    ICP = request.env['ir.config_parameter'].sudo()
+    timing = {
+        'route': route,
+        'start': time.perf_counter(),
+        'query_count': getattr(current_thread, 'query_count', 0),
+        'query_time': getattr(current_thread, 'query_time', 0.0),
+        'api': 0.0,
+        'render': 0.0,
+        'depth': {},
+        'slow_ms': float(ICP.get_param('eth_agency_portal.slow_request_ms', '2000') or 0),
+        'profiler': None,
+        'expose': _expose_server_timing(ICP),
+    }
+    request._agency_timing = timing
+
+    # Profile a sample of requests; the profile is only kept for slow ones
+    sample_rate = float(ICP.get_param('eth_agency_portal.profile_sample_rate', '0') or 0)
+    if sample_rate and random.random() < sample_rate:
+        try:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            timing['profiler'] = profiler
+        except ValueError:
+            # Another profiler is already active on this thread
+            pass
+    return timing
+
+
+def stop_route_timing():
+    """Stop collecting timings and compute the request measures"""
+    timing = _current_timing()
+    if not timing or 'wall_ms' in timing:
+        return timing
+    current_thread = threading.current_thread()
+    profiler = timing.pop('profiler')
+    if profiler:
+        profiler.disable()
+
+    timing['wall_ms'] = (time.perf_counter() - timing['start']) * 1000
+    timing['sql_count'] = getattr(current_thread, 'query_count', 0) - timing['query_count']
+    timing['sql_ms'] = (getattr(current_thread, 'query_time', 0.0) - timing['query_time']) * 1000
+    timing['api_ms'] = timing['api'] * 1000
+    timing['render_ms'] = timing['render'] * 1000
+    timing['is_slow'] = bool(timing['slow_ms']) and timing['wall_ms'] >= timing['slow_ms']
+    timing['profile'] = False
+    if profiler and timing['is_slow']:
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(40)
+        timing['profile'] = stream.getvalue()
+    return timing
+
+
+def server_timing_header(timing):
+    """Format the Server-Timing header value of a finished timing record"""
+    return ', '.join([
+        'app;dur=%.1f' % timing['wall_ms'],
+        'sql;desc="%d queries";dur=%.1f' % (timing['sql_count'], timing['sql_ms']),
+        'api;dur=%.1f' % timing['api_ms'],
+        'render;dur=%.1f' % timing['render_ms'],
+    ])
+
+
+def record_route_timing(timing):
+    """Buffer a finished timing record and flush the buffer when due"""
+    dbname = request.db
+    if not dbname:
+        return
+    sample = {
+        'route': timing['route'],
+        'method': request.httprequest.method,
+        'wall_ms': timing['wall_ms'],
+        'sql_count': timing['sql_count'],
+        'sql_ms': timing['sql_ms'],
+        'api_ms': timing['api_ms'],
+        'render_ms': timing['render_ms'],
+        'is_slow': timing['is_slow'],
+        'profile': timing['profile'],
+    }
+    now = time.monotonic()
+    with _lock:
+        samples = _buffers.setdefault(dbname, [])
+        samples.append(sample)
+        due = (
+            timing['profile']
+            or len(samples) >= FLUSH_SIZE
+            or now - _last_flush.setdefault(dbname, now) >= FLUSH_INTERVAL
+        )
+        if not due:
+            return
+        _buffers[dbname] = []
+        _last_flush[dbname] = now
+
+    # Separate cursor: the request cursor may be read-only or rolled back
+    try:
+        with request.env.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env['agency.portal.route.sample'].create(samples)
+    except Exception as e:
+        _logger.warning(f"Could not save portal route timings: {str(e)}")
+
+
+class AgencyPortalRouteSample(models.Model):
+    _name = 'agency.portal.route.sample'
+    _description = 'Agency Portal Route Timing Sample'
+    _order = 'id desc'
+    _log_access = False
+
+    create_date = fields.Datetime(string='Date', default=fields.Datetime.now, readonly=True, index=True)
+    route = fields.Char(string='Route', required=True, index=True, readonly=True)
+    method = fields.Char(string='Method', readonly=True)
+    wall_ms = fields.Float(string='Wall Time (ms)', readonly=True)
+    sql_count = fields.Integer(string='SQL Queries', readonly=True)
+    sql_ms = fields.Float(string='SQL Time (ms)', readonly=True)
+    api_ms = fields.Float(string='Travel API Time (ms)', readonly=True)
+    render_ms = fields.Float(string='Render Time (ms)', readonly=True)
+    is_slow = fields.Boolean(string='Slow', readonly=True, index=True)
+    profile = fields.Text(string='Profile', readonly=True)
+
+    @api.autovacuum
+    def _gc_samples(self):
+        """Remove samples older than the retention period"""
+        days = int(self.env['ir.config_parameter'].sudo().get_param(
+            'eth_agency_portal.route_timing_retention_days', '7'))
+        self.env.cr.execute("""
+            DELETE FROM agency_portal_route_sample
+             WHERE create_date < (now() at time zone 'UTC') - make_interval(days => %s)
+        """, [days])
+
+
+class AgencyPortalRouteStat(models.Model):
+    _name = 'agency.portal.route.stat'
+    _description = 'Agency Portal Route Statistics'
+    _auto = False
+    _order = 'wall_p95 desc'
+
+    route = fields.Char(string='Route', readonly=True)
+    method = fields.Char(string='Method', readonly=True)
+    request_count = fields.Integer(string='Requests', readonly=True)
+    wall_p50 = fields.Float(string='p50 (ms)', readonly=True)
+    wall_p95 = fields.Float(string='p95 (ms)', readonly=True)
+    wall_p99 = fields.Float(string='p99 (ms)', readonly=True)
+    wall_max = fields.Float(string='Max (ms)', readonly=True)
+    sql_count_avg = fields.Float(string='Avg SQL Queries', readonly=True)
+    sql_ms_avg = fields.Float(string='Avg SQL Time (ms)', readonly=True)
+    api_ms_avg = fields.Float(string='Avg Travel API Time (ms)', readonly=True)
+    render_ms_avg = fields.Float(string='Avg Render Time (ms)', readonly=True)
+    slow_count = fields.Integer(string='Slow Requests', readonly=True)
+
+    def init(self):
+        tools.drop_view_if_exists(self.env.cr, self._table)
+        self.env.cr.execute("""
+            CREATE OR REPLACE VIEW agency_portal_route_stat AS (
+                SELECT min(id) AS id,
+                       route,
+                       method,
+                       count(*) AS request_count,
+                       percentile_cont(0.5) WITHIN GROUP (ORDER BY wall_ms) AS wall_p50,
+                       percentile_cont(0.95) WITHIN GROUP (ORDER BY wall_ms) AS wall_p95,
+                       percentile_cont(0.99) WITHIN GROUP (ORDER BY wall_ms) AS wall_p99,
+                       max(wall_ms) AS wall_max,
+                       avg(sql_count) AS sql_count_avg,
+                       avg(sql_ms) AS sql_ms_avg,
+                       avg(api_ms) AS api_ms_avg,
+                       avg(render_ms) AS render_ms_avg,
+                       count(*) FILTER (WHERE is_slow) AS slow_count
+                  FROM agency_portal_route_sample
+                 GROUP BY route, method
+            )
+        """)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Report Export - Row streams of portal reports as CSV or XLSX
+
+Rows are produced in chunks: local data with keyset reads on id, Travel API
+data page by page. CSV is written out chunk by chunk; XLSX is built with
+xlsxwriter in constant memory mode into a temporary file and then streamed.
+Exports run after the request returned, on their own read-only cursor (see
+export_chunks). The first Travel API page is fetched in the request, so a failing
+API is reported in the response; a page failing later ends the file with an
+error row instead of silently truncating it.
+"""
+import csv
+import io
+import logging
+import tempfile
+from datetime import timedelta
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+from odoo.modules.registry import Registry
+
+_logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+API_PAGE_SIZE = 200
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# Report -> row method; every method takes date_from and date_to
+EXPORT_REPORTS = {
+    'tickets': '_iter_ticket_rows',
+    'bonus': '_iter_bonus_rows',
+    'bookings': '_iter_booking_rows',
+    'stop-sales': '_iter_stop_sales_rows',
+}
+
+# Report -> travel.api.client method listing its records
+API_REPORTS = {
+    'bonus': 'get_bonus_reservations',
+    'bookings': 'get_hotel_bookings',
+}
+
+# (header, key) columns of Travel API records
+BONUS_COLUMNS = [
+    ('ID', 'id'), ('Hotel', 'hotel_name'), ('Guest Name', 'guest_name'), ('Guest Surname', 'guest_surname'),
+    ('Check-in', 'checkin_date'), ('Room Nights', 'room_nights'), ('Bonus', 'bonus_amount'), ('State', 'state'),
+]
+BOOKING_COLUMNS = [
+    ('ID', 'id'), ('Hotel', 'hotel_name'), ('Guest', 'guest_name'), ('Check-in', 'checkin_date'),
+    ('Nights', 'nights'), ('Amount', 'total_amount'), ('State', 'state'),
+]
+
+
+def export_chunks(dbname, uid, context, report, export_format, params):
+    """Generate the bytes of a report export on a cursor of its own"""
+    with Registry(dbname).cursor(readonly=True) as cr:
+        env = api.Environment(cr, uid, context)
+        Export = env['agency.report.export']
+        rows = Export._rows_with_error(getattr(Export, EXPORT_REPORTS[report])(**params))
+        if export_format == 'xlsx':
+            yield from Export._xlsx_chunks(rows, report)
+        else:
+            yield from Export._csv_chunks(rows)
+
+
+class AgencyReportExport(models.AbstractModel):
+    _name = 'agency.report.export'
+    _description = 'Agency Report Export'
+
+    @api.model
+    def _prepare_export(self, report, params):
+        """Export params, with the first Travel API page of API reports.
+
+        Raises a UserError when the Travel API fails, before anything is sent.
+        """
+        if report not in API_REPORTS:
+            return params
+        fetch = self._api_fetch(report, params.get('token'))
+        first_page = self._fetch_api_page(
+            fetch, {'date_from': params['date_from'], 'date_to': params['date_to']}, 1)
+        return dict(params, first_page=first_page)
+
+    def _rows_with_error(self, rows):
+        """Rows of an export, ended by an error row when a later page fails"""
+        try:
+            yield from rows
+        except UserError as e:
+            _logger.warning(f"Report export incomplete: {str(e)}")
+            yield [_('Export incomplete: %s', str(e))]
+
+    # ==================== Formats ====================
+
+    def _csv_chunks(self, rows):
+        """Encode rows as CSV, one block of rows at a time"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # BOM so spreadsheet applications detect UTF-8
+        buffer.write('\ufeff')
+        for index, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if index % CHUNK_SIZE == 0:
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+
+    def _xlsx_chunks(self, rows, sheet_name):
+        """Write rows to an XLSX file in constant memory mode, then stream it"""
+        import xlsxwriter
+        with tempfile.TemporaryFile() as output:
+            workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'tmpdir': tempfile.gettempdir()})
+            worksheet = workbook.add_worksheet(sheet_name[:31])
+            for row_index, row in enumerate(rows):
+                worksheet.write_row(row_index, 0, row)
+            workbook.close()
+            output.seek(0)
+            while True:
+                block = output.read(STREAM_BLOCK_SIZE)
+                if not block:
+                    break
+                yield block
+
+    # ==================== Local Data ====================
+
+    def _iter_ticket_rows(self, agency_id, date_from, date_to, **kwargs):
+        """Ticket orders with their lines, read in id order by chunks"""
+        yield ['Order', 'Order Date', 'Ticket Date', 'Customer', 'State', 'Order Total',
+               'Product', 'Quantity', 'Unit Price', 'Subtotal']
+        SaleOrder = self.env['sale.order'].sudo()
+        SaleOrderLine = self.env['sale.order.line'].sudo()
+        order_fields = ['name', 'date_order', 'partner_id', 'state', 'amount_total']
+        has_ticket_date = self.env['agency.portal.capabilities'].get('sale_ticket_date')
+        if has_ticket_date:
+            order_fields.append('ticket_date')
+        domain = [
+            ('portal_agency_id', '=', agency_id),
+            ('date_order', '>=', date_from),
+            ('date_order', '<', fields.Date.to_date(date_to) + timedelta(days=1)),
+        ]
+        last_id = 0
+        while True:
+            orders = SaleOrder.search_read(
+                domain + [('id', '>', last_id)], order_fields, order='id', limit=CHUNK_SIZE)
+            if not orders:
+                break
+            last_id = orders[-1]['id']
+            lines_by_order = {}
+            for line in SaleOrderLine.search_read(
+                    [('order_id', 'in', [order['id'] for order in orders]), ('display_type', '=', False)],
+                    ['order_id', 'product_id', 'product_uom_qty', 'price_unit', 'price_subtotal'], order='id'):
+                lines_by_order.setdefault(line['order_id'][0], []).append(line)
+            for order in orders:
+                order_values = [
+                    order['name'],
+                    fields.Datetime.to_string(order['date_order']) if order['date_order'] else '',
+                    fields.Date.to_string(order['ticket_date']) if has_ticket_date and order['ticket_date'] else '',
+                    order['partner_id'][1] if order['partner_id'] else '',
+                    order['state'],
+                    order['amount_total'],
+                ]
+                for line in lines_by_order.get(order['id']) or [None]:
+                    if line is None:
+                        yield order_values + ['', '', '', '']
+                        continue
+                    yield order_values + [
+                        line['product_id'][1] if line['product_id'] else '',
+                        line['product_uom_qty'],
+                        line['price_unit'],
+                        line['price_subtotal'],
+                    ]
+            # Keep the cache bounded
+            self.env.invalidate_all()
+
+    def _iter_stop_sales_rows(self, agency_id, date_from, date_to, **kwargs):
+        """Stop sales of the agency's interested hotels, read in id order by chunks"""
+        StopSales = self.env['agency.stop.sales.report']._get_stop_sales_model()
+        yield ['Hotel', 'Date From', 'Date To', 'Room Type', 'Reason', 'State']
+        if StopSales is None:
+            return
+        domain = [('date_from', '<=', date_to), ('date_to', '>=', date_from)]
+        if self.env['agency.portal.capabilities'].get('agency_interested_hotels'):
+            hotel_ids = self.env['travel.agency'].sudo().browse(agency_id).interested_hotel_ids.ids
+            if hotel_ids:
+                domain.append(('hotel_id', 'in', hotel_ids))
+        optional_fields = [fname for fname in ('room_type_id', 'reason', 'state') if fname in StopSales._fields]
+        last_id = 0
+        while True:
+            records = StopSales.search_read(
+                domain + [('id', '>', last_id)], ['hotel_id', 'date_from', 'date_to'] + optional_fields,
+                order='id', limit=CHUNK_SIZE)
+            if not records:
+                break
+            last_id = records[-1]['id']
+            for record in records:
+                room_type = record.get('room_type_id')
+                yield [
+                    record['hotel_id'][1] if record['hotel_id'] else '',
+                    fields.Date.to_string(record['date_from']) if record['date_from'] else '',
+                    fields.Date.to_string(record['date_to']) if record['date_to'] else '',
+                    room_type[1] if room_type else 'All',
+                    record.get('reason') or '',
+                    record.get('state') or '',
+                ]
+            self.env.invalidate_all()
+
+    # ==================== Travel API Data ====================
+
+    def _api_fetch(self, report, token):
+        """Fetch function of the Travel API records of a report"""
+        method = getattr(self.env['travel.api.client'].sudo(), API_REPORTS[report])
+        return lambda params: method(token, params)
+
+    def _fetch_api_page(self, fetch, params, page):
+        """Records of one Travel API page; raises a UserError when it fails"""
+        result = fetch(dict(params, page=page, limit=API_PAGE_SIZE))
+        if not result.get('success'):
+            raise UserError(result.get('error') or _('The Travel API request failed.'))
+        return result.get('data') or []
+
+    def _iter_api_records(self, fetch, params, first_page=None):
+        """Records of a paginated Travel API list endpoint, page by page.
+
+        ``first_page`` is page 1 when already fetched. A failing page raises
+        a UserError.
+        """
+        page = 1
+        records = first_page if first_page is not None else self._fetch_api_page(fetch, params, page)
+        previous_first = None
+        # Stop on an empty page, or when the endpoint ignores pagination
+        while records and records[0] != previous_first:
+            yield from records
+            if len(records) < API_PAGE_SIZE:
+                return
+            previous_first = records[0]
+            page += 1
+            records = self._fetch_api_page(fetch, params, page)
+
+    def _iter_bonus_rows(self, token, date_from, date_to, first_page=None, **kwargs):
+        """Bonus reservations of the agency from the Travel API"""
+        yield [header for header, _key in BONUS_COLUMNS]
+        for record in self._iter_api_records(
+                self._api_fetch('bonus', token), {'date_from': date_from, 'date_to': date_to}, first_page):
+            yield [record.get(key, '') for _header, key in BONUS_COLUMNS]
+
+    def _iter_booking_rows(self, token, date_from, date_to, first_page=None, **kwargs):
+        """Hotel bookings of the agency from the Travel API"""
+        yield [header for header, _key in BOOKING_COLUMNS]
+        for record in self._iter_api_records(
+                self._api_fetch('bookings', token), {'date_from': date_from, 'date_to': date_to}, first_page):
+            yield [record.get(key, '') for _header, key in BOOKING_COLUMNS]
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+Report Job - Stored results of the ticket, bonus and booking report summaries
+
+A job is keyed by agency, report type, date range and data version; a
+request for a range that was already computed is served from the stored
+result. A new data version reuses the latest job of the range, so a range
+keeps one job instead of one per version. Short ranges are computed in the request, longer ones are queued
+for the report job cron and polled by the report pages.
+
+The data version of ticket reports is a digest of the agency's ticket sales
+rollup rows in the range, so results change with the orders. Bonus and
+booking data live in the Travel API and are versioned by time window
+(eth_agency_portal.report_cache_minutes).
+"""
+import logging
+import psycopg2
+from datetime import timedelta
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+REPORT_TYPES = [
+    ('tickets', 'Ticket Sales'),
+    ('bonus', 'Bonus Reservations'),
+    ('bookings', 'Hotel Bookings'),
+]
+
+# Jobs run by one cron run
+JOB_BATCH_SIZE = 20
+
+# Running jobs older than this are considered lost (worker killed) and run again
+JOB_TIMEOUT_MINUTES = 30
+
+
+class AgencyReportJob(models.Model):
+    _name = 'agency.report.job'
+    _description = 'Agency Report Job'
+    _order = 'id desc'
+
+    agency_id = fields.Many2one('travel.agency', string='Agency', required=True, ondelete='cascade', readonly=True)
+    report_type = fields.Selection(REPORT_TYPES, string='Report', required=True, readonly=True)
+    date_from = fields.Date(string='Date From', required=True, readonly=True)
+    date_to = fields.Date(string='Date To', required=True, readonly=True)
+    data_version = fields.Char(string='Data Version', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string='State', required=True, default='pending', readonly=True)
+    # Travel API token of the requesting user, kept until the job ran
+    token = fields.Char(string='Token', groups='base.group_system', copy=False)
+    started_at = fields.Datetime(string='Started At', readonly=True)
+    done_at = fields.Datetime(string='Done At', readonly=True)
+    result = fields.Json(string='Result', readonly=True)
+    error = fields.Text(string='Error', readonly=True)
+
+    _sql_constraints = [
+        ('report_unique', 'unique(agency_id, report_type, date_from, date_to, data_version)',
+         'A report can only be computed once per data version.'),
+    ]
+
+    # ==================== Request ====================
+
+    @api.model
+    def get_report(self, agency_id, report_type, date_from, date_to, token=None):
+        """Get the job of a report range.
+
+        The job is done when a result of the current data version exists or
+        the range is short enough to be computed now; otherwise it is queued.
+        """
+        date_from, date_to = fields.Date.to_date(date_from), fields.Date.to_date(date_to)
+        if date_from > date_to:
+            raise UserError(_('The start date must be before the end date.'))
+        data_version = self._get_data_version(agency_id, report_type, date_from, date_to)
+        range_domain = [
+            ('agency_id', '=', agency_id),
+            ('report_type', '=', report_type),
+            ('date_from', '=', date_from),
+            ('date_to', '=', date_to),
+        ]
+        job = self.search(range_domain + [('data_version', '=', data_version)], limit=1)
+        if not job:
+            # A new data version replaces the result of the latest job of the
+            # range, unless that one is being computed
+            job = self.search(range_domain, limit=1)
+            try:
+                with self.env.cr.savepoint():
+                    if job and job.state != 'running':
+                        job.write({
+                            'data_version': data_version,
+                            'state': 'pending',
+                            'result': False,
+                            'error': False,
+                            'done_at': False,
+                            'token': token,
+                        })
+                    else:
+                        job = self.create({
+                            'agency_id': agency_id,
+                            'report_type': report_type,
+                            'date_from': date_from,
+                            'date_to': date_to,
+                            'data_version': data_version,
+                            'token': token,
+                        })
+            except psycopg2.IntegrityError:
+                # Created by a concurrent request that is not committed yet
+                raise UserError(_('This report is already being prepared, please try again.'))
+        elif job.state == 'failed':
+            job.write({'state': 'pending', 'error': False, 'token': token})
+
+        if job.state != 'pending':
+            return job
+        sync_days = int(self.env['ir.config_parameter'].sudo().get_param(
+            'eth_agency_portal.report_sync_days', '31'))
+        if (date_to - date_from).days < sync_days:
+            if self._acquire_job(job.id):
+                job._run()
+        else:
+            self.env.ref('eth_agency_portal.ir_cron_run_report_jobs')._trigger()
+        return job
+
+    @api.model
+    def _get_data_version(self, agency_id, report_type, date_from, date_to):
+        """Version of the data a report of the range is computed from"""
+        if report_type == 'tickets':
+            self.env['agency.ticket.sales.rollup'].flush_model()
+            self.env.cr.execute("""
+                SELECT md5(COALESCE(string_agg(
+                           concat_ws(',', day, state, product_id, order_count, quantity, amount),
+                           ';' ORDER BY day, state, product_id), ''))
+                  FROM agency_ticket_sales_rollup
+                 WHERE agency_id = %s AND day >= %s AND day <= %s
+            """, [agency_id, date_from, date_to])
+            return self.env.cr.fetchone()[0]
+        minutes = int(self.env['ir.config_parameter'].sudo().get_param(
+            'eth_agency_portal.report_cache_minutes', '60')) or 1
+        return str(int(fields.Datetime.now().timestamp() // (minutes * 60)))
+
+    # ==================== Runner ====================
+
+    @api.model
+    def _acquire_job(self, job_id=None):
+        """Mark a pending job (or a lost running one) as running, return its id or None"""
+        lost_before = fields.Datetime.now() - timedelta(minutes=JOB_TIMEOUT_MINUTES)
+        self.flush_model()
+        self.env.cr.execute("""
+            UPDATE agency_report_job
+               SET state = 'running', started_at = now() AT TIME ZONE 'UTC'
+             WHERE id = (
+                   SELECT id FROM agency_report_job
+                    WHERE (state = 'pending' OR (state = 'running' AND started_at < %s))
+                      AND (%s IS NULL OR id = %s)
+                    ORDER BY id
+                    LIMIT 1
+                      FOR UPDATE SKIP LOCKED)
+         RETURNING id
+        """, [lost_before, job_id, job_id])
+        row = self.env.cr.fetchone()
+        self.invalidate_model(['state', 'started_at'])
+        return row and row[0]
+
+    @api.model
+    def _cron_run_jobs(self):
+        """Compute queued report jobs (cron)"""
+        for _index in range(JOB_BATCH_SIZE):
+            job_id = self._acquire_job()
+            if not job_id:
+                break
+            # Other workers must see the job running while it is computed
+            self.env.cr.commit()
+            self.browse(job_id)._run()
+            self.env.cr.commit()
+
+    def _run(self):
+        """Compute the report and store its result"""
+        self.ensure_one()
+        try:
+            with self.env.cr.savepoint():
+                result = getattr(self, f'_compute_{self.report_type}')()
+        except Exception as e:
+            _logger.error(f"Report job {self.id} ({self.report_type}) failed: {str(e)}")
+            self.write({'state': 'failed', 'error': str(e), 'token': False})
+            return
+        self.write({'state': 'done', 'result': result, 'token': False, 'done_at': fields.Datetime.now()})
+
+    @api.autovacuum
+    def _gc_report_jobs(self):
+        """Remove jobs not requested for two days, their data versions are outdated"""
+        limit = fields.Datetime.now() - timedelta(days=2)
+        self.search([('write_date', '<', limit)]).unlink()
+
+    # ==================== Reports ====================
+
+    def _compute_tickets(self):
+        """Ticket sales summary from the sales rollup"""
+        agency_id = self.agency_id.id
+        Rollup = self.env['agency.ticket.sales.rollup'].sudo()
+        domain = [
+            ('agency_id', '=', agency_id),
+            ('day', '>=', self.date_from),
+            ('day', '<=', self.date_to),
+        ]
+
+        # Group by state, on the order total rows
+        by_state = {}
+        total_orders = 0
+        total_amount = 0.0
+        for state, order_count, amount in Rollup._read_group(
+                domain + [('product_id', '=', 0)], ['state'], ['order_count:sum', 'amount:sum']):
+            by_state[state] = {'count': order_count, 'amount': amount}
+            total_orders += order_count
+            total_amount += amount
+
+        # Group by product (ticket type), on the product rows
+        by_product = {}
+        total_tickets = 0
+        product_rows = Rollup._read_group(
+            domain + [('product_id', '!=', 0)], ['product_id'], ['quantity:sum', 'amount:sum'])
+        products = self.env['product.product'].sudo().with_context(active_test=False).browse(
+            [product_id for product_id, _quantity, _amount in product_rows]
+        )
+        names = {product.id: product.name for product in products}
+        for product_id, quantity, amount in product_rows:
+            product_name = names.get(product_id, str(product_id))
+            if product_name not in by_product:
+                by_product[product_name] = {'quantity': 0, 'amount': 0}
+            by_product[product_name]['quantity'] += quantity
+            by_product[product_name]['amount'] += amount
+            total_tickets += quantity
+
+        # Recent orders
+        orders = self.env['sale.order'].sudo().search([
+            ('portal_agency_id', '=', agency_id),
+            ('date_order', '>=', self.date_from),
+            ('date_order', '<', self.date_to + timedelta(days=1)),
+        ], order='date_order desc', limit=10)
+        # Ticket counts of the recent orders in one grouped query
+        ticket_counts = dict(self.env['sale.order.line'].sudo()._read_group(
+            [('order_id', 'in', orders.ids), ('display_type', '=', False)],
+            ['order_id'], ['product_uom_qty:sum'],
+        )) if orders else {}
+        recent_orders = []
+        for order in orders:
+            recent_orders.append({
+                'id': order.id,
+                'name': order.name,
+                'date': order.date_order.strftime('%Y-%m-%d %H:%M') if order.date_order else '',
+                'amount': order.amount_total,
+                'state': order.state,
+                'ticket_count': ticket_counts.get(order, 0),
+            })
+
+        return {
+            'summary': {
+                'total_orders': total_orders,
+                'total_amount': total_amount,
+                'total_tickets': int(total_tickets),
+                'currency': orders[0].currency_id.symbol if orders else '€',
+            },
+            'by_state': by_state,
+            'by_product': by_product,
+            'recent_orders': recent_orders,
+            'date_from': fields.Date.to_string(self.date_from),
+            'date_to': fields.Date.to_string(self.date_to),
+        }
+
+    def _get_api_records(self, fetch):
+        """All records of a paginated Travel API list endpoint for the job range"""
+        return list(self.env['agency.report.export']._iter_api_records(fetch, {
+            'date_from': fields.Date.to_string(self.date_from),
+            'date_to': fields.Date.to_string(self.date_to),
+        }))
+
+    def _compute_bonus(self):
+        """Bonus reservations summary, without the wallet (not range data)"""
+        api_client = self.env['travel.api.client'].sudo()
+        token = self.sudo().token
+        reservations = self._get_api_records(lambda params: api_client.get_bonus_reservations(token, params))
+
+        # Group by state
+        by_state = {}
+        for res in reservations:
+            state = res.get('state', 'unknown')
+            if state not in by_state:
+                by_state[state] = {'count': 0, 'bonus': 0}
+            by_state[state]['count'] += 1
+            by_state[state]['bonus'] += res.get('bonus_amount', 0)
+
+        # Group by hotel
+        by_hotel = {}
+        for res in reservations:
+            hotel = res.get('hotel_name', 'Unknown')
+            if hotel not in by_hotel:
+                by_hotel[hotel] = {'count': 0, 'bonus': 0, 'nights': 0}
+            by_hotel[hotel]['count'] += 1
+            by_hotel[hotel]['bonus'] += res.get('bonus_amount', 0)
+            by_hotel[hotel]['nights'] += res.get('room_nights', 0)
+
+        return {
+            'summary': {
+                'total_reservations': len(reservations),
+                'total_bonus': sum(r.get('bonus_amount', 0) for r in reservations),
+                'currency': 'EUR',
+            },
+            'by_state': by_state,
+            'by_hotel': by_hotel,
+            'recent_reservations': reservations[:10],
+            'date_from': fields.Date.to_string(self.date_from),
+            'date_to': fields.Date.to_string(self.date_to),
+        }
+
+    def _compute_bookings(self):
+        """Hotel bookings summary"""
+        api_client = self.env['travel.api.client'].sudo()
+        token = self.sudo().token
+        bookings = self._get_api_records(lambda params: api_client.get_hotel_bookings(token, params))
+
+        # Group by state
+        by_state = {}
+        for booking in bookings:
+            state = booking.get('state', 'unknown')
+            if state not in by_state:
+                by_state[state] = {'count': 0, 'amount': 0}
+            by_state[state]['count'] += 1
+            by_state[state]['amount'] += booking.get('total_amount', 0)
+
+        # Group by hotel
+        by_hotel = {}
+        for booking in bookings:
+            hotel = booking.get('hotel_name', 'Unknown')
+            if hotel not in by_hotel:
+                by_hotel[hotel] = {'count': 0, 'amount': 0, 'nights': 0}
+            by_hotel[hotel]['count'] += 1
+            by_hotel[hotel]['amount'] += booking.get('total_amount', 0)
+            by_hotel[hotel]['nights'] += booking.get('nights', 0)
+
+        return {
+            'summary': {
+                'total_bookings': len(bookings),
+                'total_amount': sum(b.get('total_amount', 0) for b in bookings),
+                'total_nights': sum(b.get('nights', 0) for b in bookings),
+                'currency': 'EUR',
+            },
+            'by_state': by_state,
+            'by_hotel': by_hotel,
+            'recent_bookings': bookings[:10],
+            'date_from': fields.Date.to_string(self.date_from),
+            'date_to': fields.Date.to_string(self.date_to),
+        }
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Partner - Trigram indexes for the portal order search
+
+Customer name and email are matched on the partner at search time rather
+than copied into the search document of every order (see sale_order.py),
+so renaming a customer does not rewrite its orders.
+"""
+from odoo import models, tools
+
+# Partner columns matched by the portal order search
+SEARCH_PARTNER_FIELDS = ('name', 'email')
+
+
+class ResPartner(models.Model):
+    _inherit = 'res.partner'
+
+    def init(self):
+        super().init()
+        if not self.env.registry.has_trigram:
+            return
+        for fname in SEARCH_PARTNER_FIELDS:
+            tools.create_index(
+                self.env.cr, f'res_partner_portal_{fname}_trgm_idx', self._table,
+                [f'{fname} gin_trgm_ops'], method='gin',
+            )
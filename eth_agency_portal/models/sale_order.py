@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Sale Order - Agency ownership of ticket orders created in the portal
+
+Changes to agency orders and their lines are added to the daily ticket
+sales rollup (agency.ticket.sales.rollup). Agency orders also keep a search
+document (order references, visitor names and identities) with a trigram
+index for the portal order search. The customer is matched on the partner
+instead (see res_partner.py): checkout rewrites returning customers, which
+would recompute the document of all their orders.
+
+Tickets reserved for agency orders at checkout go back to the daily
+inventory (agency.ticket.inventory) when the order is cancelled or deleted,
+whatever the route.
+"""
+import re
+from odoo import models, fields, api, tools
+from odoo.tools.sql import column_exists, create_column
+
+# Client reference of portal orders, also sent to the Travel API
+AGENCY_REF_PATTERN = re.compile(r'^AGENCY_(\d+)_')
+
+# Order fields that move an order to another rollup bucket or change its totals
+ROLLUP_ORDER_FIELDS = {
+    'portal_agency_id', 'date_order', 'state', 'order_line', 'amount_total', 'commission_amount',
+}
+ROLLUP_LINE_FIELDS = {
+    'order_id', 'product_id', 'product_uom_qty', 'price_unit', 'discount', 'tax_id', 'display_type',
+}
+
+# Visitor fields of the optional visitor form module in the search document
+SEARCH_VISITOR_FIELDS = ('visitor_first_name', 'visitor_last_name', 'visitor_identity')
+
+
+def _search_document_depends(model):
+    depends = ['portal_agency_id', 'name', 'client_order_ref']
+    if 'visitor_form_ids' in model._fields and 'visitor.form' in model.env:
+        visitor_fields = model.env['visitor.form']._fields
+        depends += [f'visitor_form_ids.{fname}' for fname in SEARCH_VISITOR_FIELDS if fname in visitor_fields]
+    return depends
+
+
+class SaleOrder(models.Model):
+    _inherit = 'sale.order'
+
+    # Set by portal checkout; orders of other channels keep it empty, hence
+    # the partial index
+    portal_agency_id = fields.Many2one(
+        'travel.agency', string='Portal Agency', ondelete='set null', index='btree_not_null', copy=False,
+    )
+
+    portal_search_text = fields.Text(
+        string='Portal Search Document', compute='_compute_portal_search_text', store=True,
+        index='trigram', copy=False,
+    )
+
+    def _auto_init(self):
+        # Created empty instead of computed for every order of the table;
+        # agency orders are filled by the 18.0.1.3.0 migration
+        if not column_exists(self.env.cr, self._table, 'portal_search_text'):
+            create_column(self.env.cr, self._table, 'portal_search_text', 'text')
+        return super()._auto_init()
+
+    def init(self):
+        super().init()
+        # Agency order lists are sorted newest first and paginated on (date_order, id)
+        tools.create_index(
+            self.env.cr, 'sale_order_portal_agency_date_idx', self._table,
+            ['portal_agency_id', 'date_order DESC', 'id DESC'], where='portal_agency_id IS NOT NULL',
+        )
+
+    @api.depends(_search_document_depends)
+    def _compute_portal_search_text(self):
+        has_visitors = 'visitor_form_ids' in self._fields and 'visitor.form' in self.env
+        visitor_fields = [
+            fname for fname in SEARCH_VISITOR_FIELDS
+            if has_visitors and fname in self.env['visitor.form']._fields
+        ]
+        for order in self:
+            if not order.portal_agency_id:
+                order.portal_search_text = False
+                continue
+            terms = [order.name, order.client_order_ref]
+            if visitor_fields:
+                for visitor in order.visitor_form_ids:
+                    terms.extend(visitor[fname] for fname in visitor_fields)
+            order.portal_search_text = ' '.join(term for term in terms if term)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        # Orders created through the Travel API only carry the reference
+        ref_agency_ids = {}
+        for index, vals in enumerate(vals_list):
+            match = AGENCY_REF_PATTERN.match(vals.get('client_order_ref') or '')
+            if match and not vals.get('portal_agency_id'):
+                ref_agency_ids[index] = int(match.group(1))
+        if ref_agency_ids:
+            existing = set(self.env['travel.agency'].sudo().browse(set(ref_agency_ids.values())).exists().ids)
+            for index, agency_id in ref_agency_ids.items():
+                if agency_id in existing:
+                    vals_list[index]['portal_agency_id'] = agency_id
+
+        orders = super(SaleOrder, self.with_context(agency_rollup_skip=True)).create(vals_list)
+        agency_orders = orders.filtered('portal_agency_id')
+        if agency_orders and not self.env.context.get('agency_rollup_skip'):
+            Rollup = self.env['agency.ticket.sales.rollup']
+            Rollup._apply_delta({}, Rollup._snapshot(agency_orders.ids))
+        return orders.with_env(self.env)
+
+    def write(self, vals):
+        if self.env.context.get('agency_rollup_skip') or not ROLLUP_ORDER_FIELDS.intersection(vals):
+            return super().write(vals)
+        Rollup = self.env['agency.ticket.sales.rollup']
+        order_ids = self.filtered('portal_agency_id').ids if 'portal_agency_id' not in vals else self.ids
+        before = Rollup._snapshot(order_ids)
+        res = super(SaleOrder, self.with_context(agency_rollup_skip=True)).write(vals)
+        Rollup._apply_delta(before, Rollup._snapshot(order_ids))
+        return res
+
+    def _action_cancel(self):
+        # Called by action_cancel and the cancel wizard
+        self.env['agency.ticket.inventory'].sudo().release_orders(self)
+        return super()._action_cancel()
+
+    def unlink(self):
+        self.env['agency.ticket.inventory'].sudo().release_orders(self)
+        if self.env.context.get('agency_rollup_skip'):
+            return super().unlink()
+        Rollup = self.env['agency.ticket.sales.rollup']
+        before = Rollup._snapshot(self.filtered('portal_agency_id').ids)
+        res = super(SaleOrder, self.with_context(agency_rollup_skip=True)).unlink()
+        Rollup._apply_delta(before, {})
+        return res
+
+
+class SaleOrderLine(models.Model):
+    _inherit = 'sale.order.line'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        if self.env.context.get('agency_rollup_skip'):
+            return super().create(vals_list)
+        order_ids = self.env['sale.order'].browse(
+            {vals['order_id'] for vals in vals_list if vals.get('order_id')}
+        ).filtered('portal_agency_id').ids
+        Rollup = self.env['agency.ticket.sales.rollup']
+        before = Rollup._snapshot(order_ids)
+        lines = super(SaleOrderLine, self.with_context(agency_rollup_skip=True)).create(vals_list)
+        Rollup._apply_delta(before, Rollup._snapshot(order_ids))
+        return lines.with_env(self.env)
+
+    def write(self, vals):
+        if self.env.context.get('agency_rollup_skip') or not ROLLUP_LINE_FIELDS.intersection(vals):
+            return super().write(vals)
+        orders = self.order_id
+        if vals.get('order_id'):
+            orders |= self.env['sale.order'].browse(vals['order_id'])
+        order_ids = orders.filtered('portal_agency_id').ids
+        Rollup = self.env['agency.ticket.sales.rollup']
+        before = Rollup._snapshot(order_ids)
+        res = super(SaleOrderLine, self.with_context(agency_rollup_skip=True)).write(vals)
+        Rollup._apply_delta(before, Rollup._snapshot(order_ids))
+        return res
+
+    def unlink(self):
+        if self.env.context.get('agency_rollup_skip'):
+            return super().unlink()
+        order_ids = self.order_id.filtered('portal_agency_id').ids
+        Rollup = self.env['agency.ticket.sales.rollup']
+        before = Rollup._snapshot(order_ids)
+        res = super(SaleOrderLine, self.with_context(agency_rollup_skip=True)).unlink()
+        Rollup._apply_delta(before, Rollup._snapshot(order_ids))
+        return res
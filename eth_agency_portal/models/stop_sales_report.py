@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Stop Sales Report - Stop sale summary of the agency's interested hotels
+
+Stop sales come from hotel.stop.sales or travel.stop.sales, whichever is
+installed. Their periods are indexed as date ranges with GiST so the
+overlap with the report window is an index lookup, and the per-hotel counts
+and stopped days (clipped to the window) are aggregated in one query.
+"""
+import logging
+from odoo import models, api, tools
+from odoo.tools.sql import column_exists
+
+_logger = logging.getLogger(__name__)
+
+STOP_SALES_MODELS = ('hotel.stop.sales', 'travel.stop.sales')
+
+# Indexed period of a stop sale; get_summary repeats the expression and the
+# partial index condition so the index applies
+PERIOD_EXPRESSION = "daterange(date_from, date_to, '[]')"
+PERIOD_CONDITION = 'date_from <= date_to'
+
+
+class AgencyStopSalesReport(models.AbstractModel):
+    _name = 'agency.stop.sales.report'
+    _description = 'Agency Stop Sales Report'
+
+    def _register_hook(self):
+        super()._register_hook()
+        # The stop sales module may be installed after this one, the hook
+        # runs again on every registry load
+        StopSales = self._get_stop_sales_model()
+        if StopSales is None:
+            return
+        table = StopSales._table
+        if not all(column_exists(self.env.cr, table, column) for column in ('date_from', 'date_to')):
+            return
+        try:
+            with self.env.cr.savepoint():
+                tools.create_index(
+                    self.env.cr, f'{table}_agency_period_idx', table,
+                    [PERIOD_EXPRESSION], method='gist', where=PERIOD_CONDITION,
+                )
+        except Exception as e:
+            _logger.warning(f"Could not create the stop sales period index on {table}: {str(e)}")
+
+    @api.model
+    def _get_stop_sales_model(self):
+        """The installed stop sales model (sudo), or None"""
+        model_name = next((name for name in STOP_SALES_MODELS if name in self.env), None)
+        return self.env[model_name].sudo() if model_name else None
+
+    @api.model
+    def get_summary(self, agency_id, date_from, date_to, limit=10):
+        """Stop sales overlapping a window: totals, per-hotel counts and days, latest stop sales"""
+        StopSales = self._get_stop_sales_model()
+        hotel_ids = []
+        if self.env['agency.portal.capabilities'].get('agency_interested_hotels'):
+            hotel_ids = self.env['travel.agency'].sudo().browse(agency_id).interested_hotel_ids.ids
+
+        has_state = 'state' in StopSales._fields
+        conditions = [
+            'ss.date_from <= ss.date_to',
+            "daterange(ss.date_from, ss.date_to, '[]') && daterange(%(date_from)s::date, %(date_to)s::date, '[]')",
+        ]
+        params = {'date_from': date_from, 'date_to': date_to}
+        if hotel_ids:
+            conditions.append('ss.hotel_id = ANY(%(hotel_ids)s)')
+            params['hotel_ids'] = hotel_ids
+        if 'active' in StopSales._fields:
+            conditions.append('ss.active')
+
+        StopSales.flush_model()
+        # Days are counted on the part of each period inside the window
+        self.env.cr.execute(f"""
+            SELECT hotel_id, count(*), {"count(*) FILTER (WHERE state = 'active')" if has_state else 'count(*)'},
+                   COALESCE(sum(upper(clipped) - lower(clipped)), 0)
+              FROM (SELECT ss.hotel_id, {'ss.state' if has_state else 'NULL AS state'},
+                           daterange(ss.date_from, ss.date_to, '[]')
+                           * daterange(%(date_from)s::date, %(date_to)s::date, '[]') AS clipped
+                      FROM {StopSales._table} ss
+                     WHERE {' AND '.join(conditions)}) periods
+             GROUP BY hotel_id
+        """, params)
+        rows = self.env.cr.fetchall()
+
+        hotels = self.env[StopSales._fields['hotel_id'].comodel_name].sudo().browse(
+            [hotel_id for hotel_id, *_values in rows if hotel_id]
+        )
+        names = {hotel.id: hotel.name for hotel in hotels}
+        total_stop_sales = 0
+        active_stop_sales = 0
+        by_hotel = {}
+        for hotel_id, count, active_count, days in rows:
+            hotel_name = names.get(hotel_id, 'Unknown')
+            if hotel_name not in by_hotel:
+                by_hotel[hotel_name] = {'count': 0, 'days': 0}
+            by_hotel[hotel_name]['count'] += count
+            by_hotel[hotel_name]['days'] += days
+            total_stop_sales += count
+            active_stop_sales += active_count
+
+        # Latest stop sales
+        domain = [('date_from', '<=', date_to), ('date_to', '>=', date_from)]
+        if hotel_ids:
+            domain.append(('hotel_id', 'in', hotel_ids))
+        recent = []
+        for ss in StopSales.search(domain, order='date_from desc', limit=limit):
+            recent.append({
+                'id': ss.id,
+                'hotel_name': ss.hotel_id.name if ss.hotel_id else 'Unknown',
+                'date_from': ss.date_from.strftime('%Y-%m-%d') if ss.date_from else '',
+                'date_to': ss.date_to.strftime('%Y-%m-%d') if ss.date_to else '',
+                'room_type': ss.room_type_id.name if 'room_type_id' in ss._fields and ss.room_type_id else 'All',
+                'reason': ss.reason if 'reason' in ss._fields else '',
+            })
+
+        return {
+            'summary': {
+                'total_stop_sales': total_stop_sales,
+                'active_stop_sales': active_stop_sales,
+            },
+            'by_hotel': by_hotel,
+            'recent_stop_sales': recent,
+        }
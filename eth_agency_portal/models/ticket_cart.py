@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+"""
+Ticket Cart - Server-side ticket cart of an agency user
+
+Replaces the cart, visitor and checkout structures that used to be deep
+copied into the session on every change. Each change writes only the rows
+it touches and bumps the cart version, which clients send back to detect
+concurrent edits from another tab.
+"""
+import psycopg2
+from datetime import timedelta
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+from ..utils.cart_trace import cart_trace
+
+VISITOR_FIELDS = ('first_name', 'last_name', 'phone', 'email', 'identity')
+
+# Ticket product types that need one visitor per ticket
+VISITOR_TICKET_TYPES = ('adult', 'child')
+
+# Operations accepted by apply_changes
+LINE_OPERATIONS = ('set', 'remove', 'date')
+VISITOR_OPERATIONS = ('save', 'delete')
+
+
+class AgencyTicketCart(models.Model):
+    _name = 'agency.ticket.cart'
+    _description = 'Agency Ticket Cart'
+    _order = 'write_date desc'
+
+    agency_user_id = fields.Many2one(
+        'agency.user', string='Agency User', required=True, ondelete='cascade', index=True
+    )
+    agency_id = fields.Many2one(
+        'travel.agency', string='Agency', required=True, ondelete='cascade', index=True
+    )
+    visit_date = fields.Date(string='Visit Date')
+    version = fields.Integer(string='Version', default=0, readonly=True)
+    line_ids = fields.One2many('agency.ticket.cart.line', 'cart_id', string='Lines')
+    visitor_ids = fields.One2many('agency.ticket.cart.visitor', 'cart_id', string='Visitors')
+
+    # Maintained incrementally by the mutation methods, never recomputed from lines
+    amount_total = fields.Float(string='Total', digits=(16, 2), readonly=True)
+    item_count = fields.Integer(string='Items', readonly=True)
+    missing_visitor_count = fields.Integer(string='Missing Visitors', readonly=True)
+
+    # Checkout state
+    checkout_prepared_at = fields.Datetime(string='Checkout Prepared At')
+    billing_address = fields.Json(string='Billing Address')
+
+    _sql_constraints = [
+        ('agency_user_unique', 'unique(agency_user_id)', 'An agency user can only have one ticket cart.'),
+    ]
+
+    # ==================== Access ====================
+
+    @api.model
+    def _get_user_cart(self, agency_user_id, agency_id, create=True):
+        """Get the cart of an agency user, creating it on first use"""
+        cart = self.search([('agency_user_id', '=', agency_user_id)], limit=1)
+        if cart and cart.agency_id.id != agency_id:
+            # User moved to another agency, start over
+            cart.unlink()
+            cart = self.browse()
+        if cart or not create:
+            return cart
+        try:
+            with self.env.cr.savepoint():
+                return self.create({'agency_user_id': agency_user_id, 'agency_id': agency_id})
+        except psycopg2.IntegrityError:
+            # Created concurrently by another request of the same user
+            return self.search([('agency_user_id', '=', agency_user_id)], limit=1)
+
+    def _bump_version(self, expected_version):
+        """Increment the cart version if it still is the one the client read.
+
+        Returns the new version, or False when the cart was changed since
+        the client read it or the client sent no version.
+        """
+        self.ensure_one()
+        if expected_version is None:
+            return False
+        return self._increment_version(expected_version)
+
+    def _increment_version(self, expected_version=None):
+        """Increment the cart version, checking it first when given.
+
+        Without ``expected_version`` the version is bumped unconditionally,
+        which only internal changes such as clear() may do.
+        """
+        self.ensure_one()
+        query = """
+            UPDATE agency_ticket_cart
+               SET version = version + 1,
+                   write_date = now() at time zone 'UTC'
+             WHERE id = %s
+        """
+        params = [self.id]
+        if expected_version is not None:
+            query += " AND version = %s"
+            params.append(int(expected_version))
+        self.env.cr.execute(query + " RETURNING version", params)
+        row = self.env.cr.fetchone()
+        self.invalidate_recordset(['version', 'write_date'])
+        return row[0] if row else False
+
+    # ==================== Serialization ====================
+
+    def to_dict(self):
+        """Cart in the structure used by templates and the ticket sales UI"""
+        if not self:
+            return {'lines': [], 'visit_date': None, 'total': 0, 'item_count': 0,
+                    'missing_visitors': 0, 'version': 0}
+        self.ensure_one()
+        return {
+            'lines': [line._to_dict() for line in self.line_ids],
+            'visit_date': fields.Date.to_string(self.visit_date) if self.visit_date else None,
+            'total': self.amount_total,
+            'item_count': self.item_count,
+            'missing_visitors': self.missing_visitor_count,
+            'version': self.version,
+        }
+
+    def get_visitors(self):
+        """Visitors in the structure used by templates and the ticket sales UI"""
+        return [visitor._to_dict() for visitor in self.visitor_ids]
+
+    def get_checkout_data(self):
+        """Checkout snapshot, empty until checkout has been prepared"""
+        if not self or not self.checkout_prepared_at:
+            return {}
+        return {
+            'cart': self.to_dict(),
+            'visitors': self.get_visitors(),
+            'billing_address': self.billing_address or {},
+            'prepared_at': fields.Datetime.to_string(self.checkout_prepared_at),
+            'checkout_key': self.get_checkout_key(),
+        }
+
+    def get_checkout_key(self):
+        """Idempotency key of the prepared checkout: cart, checkout session and version"""
+        if not self or not self.checkout_prepared_at:
+            return None
+        self.ensure_one()
+        return f"{self.id}-{int(self.checkout_prepared_at.timestamp())}-{self.version}"
+
+    # ==================== Lookups ====================
+
+    def _get_line(self, variant_id):
+        """Get the line of a variant (unique index on cart and variant)"""
+        self.ensure_one()
+        return self.env['agency.ticket.cart.line'].search([
+            ('cart_id', '=', self.id), ('variant_id', '=', int(variant_id)),
+        ], limit=1)
+
+    def _get_line_map(self):
+        """Lines indexed by variant id, for operations touching many lines"""
+        self.ensure_one()
+        return {line.variant_id: line for line in self.line_ids}
+
+    def is_visitors_complete(self):
+        """Check that every adult and child ticket has its visitor"""
+        return not self or self.missing_visitor_count <= 0
+
+    # ==================== Mutations ====================
+
+    def _apply_totals_delta(self, amount=0.0, items=0, missing_visitors=0):
+        """Shift the cart counters by the effect of a single change"""
+        self.ensure_one()
+        if not (amount or items or missing_visitors):
+            return
+        counters = ['amount_total', 'item_count', 'missing_visitor_count']
+        self.flush_recordset(counters)
+        self.env.cr.execute("""
+            UPDATE agency_ticket_cart
+               SET amount_total = amount_total + %s,
+                   item_count = item_count + %s,
+                   missing_visitor_count = missing_visitor_count + %s
+             WHERE id = %s
+        """, [amount, items, missing_visitors, self.id])
+        self.invalidate_recordset(counters)
+
+    def _reset(self):
+        """Drop lines and visitors and zero the counters"""
+        self.line_ids.unlink()
+        self.visitor_ids.unlink()
+        self.write({'amount_total': 0.0, 'item_count': 0, 'missing_visitor_count': 0})
+
+    def set_visit_date(self, visit_date):
+        """Set the visit date; changing it empties the cart"""
+        self.ensure_one()
+        visit_date = fields.Date.to_date(visit_date) if visit_date else False
+        if visit_date == self.visit_date:
+            return False
+        if self.visit_date and self.line_ids:
+            self._reset()
+        self.write({'visit_date': visit_date})
+        return True
+
+    def set_line(self, variant_id, quantity, product_id=None, product_name=None, price=0.0,
+                 ticket_product_type=None, lines=None):
+        """Create, update or remove the line of a variant.
+
+        ``lines`` is an optional map from _get_line_map, kept up to date,
+        for callers changing many lines of the same cart.
+        """
+        self.ensure_one()
+        variant_id = int(variant_id)
+        quantity = int(quantity or 0)
+        Line = self.env['agency.ticket.cart.line']
+        line = lines.get(variant_id, Line) if lines is not None else self._get_line(variant_id)
+
+        old_amount = line.quantity * line.price
+        old_items = line.quantity
+        old_missing = line._get_missing_visitors()
+
+        if quantity <= 0:
+            if line:
+                line.unlink()
+                self._apply_totals_delta(-old_amount, -old_items, -old_missing)
+                if lines is not None:
+                    lines.pop(variant_id, None)
+            self._prune_visitors(variant_id, 0)
+            return Line
+
+        vals = {'quantity': quantity, 'price': price or 0.0}
+        if ticket_product_type:
+            vals['ticket_product_type'] = ticket_product_type
+        if line:
+            if quantity < old_items:
+                self._prune_visitors(variant_id, quantity)
+            if quantity != old_items:
+                # Recounted: visitors saved beyond the old quantity may now fill a slot
+                vals['visitor_count'] = self._count_filled_slots(variant_id, quantity)
+            line.write(vals)
+        else:
+            # Visitors left over without a line do not fill any slot
+            self._prune_visitors(variant_id, 0)
+            vals.update({
+                'cart_id': self.id,
+                'variant_id': variant_id,
+                'product_id': int(product_id or variant_id),
+                'product_name': product_name or '',
+            })
+            line = Line.create(vals)
+            if lines is not None:
+                lines[variant_id] = line
+
+        cart_trace(self, 'line.set', variant_id=variant_id, old_quantity=old_items, quantity=quantity)
+        self._apply_totals_delta(
+            line.quantity * line.price - old_amount,
+            line.quantity - old_items,
+            line._get_missing_visitors() - old_missing,
+        )
+        return line
+
+    def _prune_visitors(self, variant_id, quantity):
+        """Remove visitors whose index exceeds the quantity of their variant"""
+        visitors = self.env['agency.ticket.cart.visitor'].search([
+            ('cart_id', '=', self.id),
+            ('variant_id', '=', variant_id),
+            ('visitor_index', '>', quantity),
+        ])
+        if visitors:
+            cart_trace(self, 'visitor.prune', variant_id=variant_id, quantity=quantity,
+                       removed=lambda: [v.visitor_index for v in visitors])
+            visitors.unlink()
+
+    def _count_filled_slots(self, variant_id, quantity):
+        """Count the visitors filling slots 1..quantity of a variant"""
+        return self.env['agency.ticket.cart.visitor'].search_count([
+            ('cart_id', '=', self.id),
+            ('variant_id', '=', variant_id),
+            ('visitor_index', '>=', 1),
+            ('visitor_index', '<=', quantity),
+        ])
+
+    def _shift_visitor_count(self, line, delta):
+        """Count a visitor in or out of the slots of its line"""
+        old_missing = line._get_missing_visitors()
+        line.write({'visitor_count': line.visitor_count + delta})
+        self._apply_totals_delta(missing_visitors=line._get_missing_visitors() - old_missing)
+
+    def save_visitor(self, visitor_data):
+        """Create or update the visitor of a variant slot"""
+        self.ensure_one()
+        variant_id = int(visitor_data.get('variant_id'))
+        visitor_index = int(visitor_data.get('visitor_index') or 0)
+        vals = {
+            'product_name': visitor_data.get('product_name', ''),
+            'ticket_product_type': visitor_data.get('ticket_product_type', 'adult'),
+        }
+        for field_name in VISITOR_FIELDS:
+            vals[field_name] = visitor_data.get(field_name, '')
+
+        Visitor = self.env['agency.ticket.cart.visitor']
+        visitor = Visitor.search([
+            ('cart_id', '=', self.id),
+            ('variant_id', '=', variant_id),
+            ('visitor_index', '=', visitor_index),
+        ], limit=1)
+        if visitor:
+            visitor.write(vals)
+        else:
+            vals.update({'cart_id': self.id, 'variant_id': variant_id, 'visitor_index': visitor_index})
+            visitor = Visitor.create(vals)
+            line = self._get_line(variant_id)
+            if line and 1 <= visitor_index <= line.quantity:
+                self._shift_visitor_count(line, 1)
+        return visitor
+
+    def delete_visitor(self, variant_id, visitor_index):
+        """Delete the visitor of a variant slot"""
+        self.ensure_one()
+        visitor = self.env['agency.ticket.cart.visitor'].search([
+            ('cart_id', '=', self.id),
+            ('variant_id', '=', int(variant_id)),
+            ('visitor_index', '=', int(visitor_index)),
+        ], limit=1)
+        if not visitor:
+            return
+        visitor.unlink()
+        line = self._get_line(variant_id)
+        if line and 1 <= int(visitor_index) <= line.quantity:
+            self._shift_visitor_count(line, -1)
+
+    def apply_changes(self, operations=None, visitor_changes=None):
+        """Apply a batch of line operations, then visitor edits.
+
+        Line operations: {'op': 'set', 'variant_id', 'quantity', ...line values},
+        {'op': 'remove', 'variant_id'} and {'op': 'date', 'visit_date'}.
+        Visitor edits: {'op': 'save', ...visitor values} and
+        {'op': 'delete', 'variant_id', 'visitor_index'}.
+        The whole batch is validated before anything is written.
+        """
+        self.ensure_one()
+        operations = operations or []
+        visitor_changes = visitor_changes or []
+        self._check_changes(operations, visitor_changes)
+
+        lines = self._get_line_map()
+        for operation in operations:
+            op = operation['op']
+            if op == 'date':
+                if self.set_visit_date(operation.get('visit_date')):
+                    lines = self._get_line_map()
+            elif op == 'remove':
+                self.set_line(operation['variant_id'], 0, lines=lines)
+            else:
+                self.set_line(
+                    operation.get('variant_id') or operation.get('product_id'),
+                    operation.get('quantity', 0),
+                    product_id=operation.get('product_id'),
+                    product_name=operation.get('product_name'),
+                    price=operation.get('price', 0.0),
+                    ticket_product_type=operation.get('ticket_product_type'),
+                    lines=lines,
+                )
+
+        for change in visitor_changes:
+            if change['op'] == 'delete':
+                self.delete_visitor(change['variant_id'], change['visitor_index'])
+            else:
+                self.save_visitor(change)
+
+    @api.model
+    def _check_changes(self, operations, visitor_changes):
+        """Validate a batch of changes before applying it"""
+        for operation in operations:
+            op = operation.get('op')
+            if op not in LINE_OPERATIONS:
+                raise UserError(_('Unknown cart operation: %s') % op)
+            if op != 'date' and not (operation.get('variant_id') or operation.get('product_id')):
+                raise UserError(_('Cart operation "%s" needs a variant_id.') % op)
+        for change in visitor_changes:
+            op = change.get('op')
+            if op not in VISITOR_OPERATIONS:
+                raise UserError(_('Unknown visitor operation: %s') % op)
+            if change.get('variant_id') is None or change.get('visitor_index') is None:
+                raise UserError(_('Visitor operation "%s" needs variant_id and visitor_index.') % op)
+
+    def prepare_checkout(self):
+        """Mark the cart as ready for checkout and hold its tickets.
+
+        Raises a UserError when a product is no longer available.
+        """
+        self.ensure_one()
+        minutes = int(self.env['ir.config_parameter'].sudo().get_param(
+            'eth_agency_portal.ticket_hold_minutes', '15') or 0)
+        if minutes > 0 and self.visit_date:
+            self.env['agency.ticket.inventory'].hold(
+                self.id, self.agency_id.id, self.visit_date,
+                {line.variant_id: line.quantity for line in self.line_ids}, minutes,
+            )
+        self.write({'checkout_prepared_at': fields.Datetime.now()})
+
+    def clear(self):
+        """Empty lines, visitors and checkout state"""
+        self.env['agency.ticket.hold'].release_cart_holds(self.ids)
+        for cart in self:
+            cart._reset()
+            cart.write({'visit_date': False, 'checkout_prepared_at': False, 'billing_address': False})
+            cart._increment_version()
+
+    @api.autovacuum
+    def _gc_abandoned_carts(self):
+        """Remove carts untouched for a month"""
+        limit = fields.Datetime.now() - timedelta(days=30)
+        self.search([('write_date', '<', limit)]).unlink()
+
+
+class AgencyTicketCartLine(models.Model):
+    _name = 'agency.ticket.cart.line'
+    _description = 'Agency Ticket Cart Line'
+    _order = 'id'
+
+    cart_id = fields.Many2one('agency.ticket.cart', string='Cart', required=True, ondelete='cascade')
+    variant_id = fields.Integer(string='Variant ID', required=True)
+    product_id = fields.Integer(string='Product ID')
+    product_name = fields.Char(string='Product Name')
+    quantity = fields.Integer(string='Quantity', default=1)
+    price = fields.Float(string='Price', digits=(16, 2))
+    ticket_product_type = fields.Char(string='Ticket Product Type')
+    visitor_count = fields.Integer(string='Filled Visitor Slots', readonly=True)
+
+    _sql_constraints = [
+        ('cart_variant_unique', 'unique(cart_id, variant_id)', 'A variant can only appear once in a cart.'),
+    ]
+
+    def _to_dict(self):
+        return {
+            'product_id': self.product_id,
+            'variant_id': self.variant_id,
+            'product_name': self.product_name or '',
+            'quantity': self.quantity,
+            'price': self.price,
+            'ticket_product_type': self.ticket_product_type or '',
+            'missing_visitors': self._get_missing_visitors(),
+        }
+
+    def _get_missing_visitors(self):
+        """Number of empty visitor slots of the line"""
+        if not self or self.ticket_product_type not in VISITOR_TICKET_TYPES:
+            return 0
+        return max(0, self.quantity - self.visitor_count)
+
+
+class AgencyTicketCartVisitor(models.Model):
+    _name = 'agency.ticket.cart.visitor'
+    _description = 'Agency Ticket Cart Visitor'
+    _order = 'variant_id, visitor_index'
+
+    cart_id = fields.Many2one('agency.ticket.cart', string='Cart', required=True, ondelete='cascade')
+    variant_id = fields.Integer(string='Variant ID', required=True)
+    visitor_index = fields.Integer(string='Visitor Index', required=True)
+    product_name = fields.Char(string='Product Name')
+    ticket_product_type = fields.Char(string='Ticket Product Type', default='adult')
+    first_name = fields.Char(string='First Name')
+    last_name = fields.Char(string='Last Name')
+    phone = fields.Char(string='Phone')
+    email = fields.Char(string='Email')
+    identity = fields.Char(string='Identity')
+
+    _sql_constraints = [
+        ('cart_variant_index_unique', 'unique(cart_id, variant_id, visitor_index)',
+         'A visitor slot can only be filled once.'),
+    ]
+
+    def _to_dict(self):
+        values = {
+            'variant_id': self.variant_id,
+            'product_name': self.product_name or '',
+            'visitor_index': self.visitor_index,
+            'ticket_product_type': self.ticket_product_type or '',
+        }
+        for field_name in VISITOR_FIELDS:
+            values[field_name] = self[field_name] or ''
+        return values
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Ticket Hold - Short-lived stock holds of carts going through checkout
+
+Holds are taken when checkout is prepared and count against availability
+in the stock endpoints and inventory reservations until they expire or the
+order is placed. Expired holds are ignored by every query and removed by a
+periodic sweep.
+"""
+from datetime import timedelta
+from odoo import models, fields, api, tools
+
+
+class AgencyTicketHold(models.Model):
+    _name = 'agency.ticket.hold'
+    _description = 'Agency Ticket Stock Hold'
+    _order = 'expires_at'
+    _log_access = False
+
+    cart_id = fields.Many2one('agency.ticket.cart', string='Cart', required=True, ondelete='cascade', index=True)
+    agency_id = fields.Many2one('travel.agency', string='Agency', required=True, ondelete='cascade')
+    product_id = fields.Integer(string='Product ID', required=True)
+    visit_date = fields.Date(string='Visit Date', required=True)
+    quantity = fields.Integer(string='Quantity', required=True)
+    expires_at = fields.Datetime(string='Expires At', required=True, index=True)
+
+    def init(self):
+        # Availability lookups filter on product, date and expiry
+        tools.create_index(
+            self.env.cr, 'agency_ticket_hold_product_date_expiry_idx', self._table,
+            ['product_id', 'visit_date', 'expires_at'],
+        )
+
+    @api.model
+    def create_holds(self, cart_id, agency_id, visit_date, quantities, minutes):
+        """Create one hold per product, expiring after the given minutes"""
+        expires_at = fields.Datetime.now() + timedelta(minutes=minutes)
+        return self.create([{
+            'cart_id': cart_id,
+            'agency_id': agency_id,
+            'product_id': product_id,
+            'visit_date': visit_date,
+            'quantity': quantity,
+            'expires_at': expires_at,
+        } for product_id, quantity in quantities.items()])
+
+    @api.model
+    def release_cart_holds(self, cart_ids):
+        """Drop the holds of carts"""
+        if isinstance(cart_ids, int):
+            cart_ids = [cart_ids]
+        self.flush_model()
+        self.env.cr.execute("DELETE FROM agency_ticket_hold WHERE cart_id = ANY(%s)", [list(cart_ids)])
+        self.invalidate_model()
+
+    @api.model
+    def get_held_quantities(self, visit_date, product_ids=None, exclude_cart_id=None):
+        """Active held quantities of a visit date per product"""
+        query = """
+            SELECT product_id, sum(quantity)
+              FROM agency_ticket_hold
+             WHERE visit_date = %s
+               AND expires_at > now() at time zone 'UTC'
+               AND cart_id IS DISTINCT FROM %s
+        """
+        params = [visit_date, exclude_cart_id]
+        if product_ids is not None:
+            query += " AND product_id = ANY(%s)"
+            params.append([int(pid) for pid in product_ids])
+        self.flush_model()
+        self.env.cr.execute(query + " GROUP BY product_id", params)
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def _gc_expired_holds(self):
+        """Remove expired holds (cron)"""
+        self.env.cr.execute("""
+            DELETE FROM agency_ticket_hold
+             WHERE expires_at <= now() at time zone 'UTC'
+        """)
+        self.invalidate_model()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Ticket Inventory - Set-based updates of eth.daily.inventory for ticket checkout
+
+Each call locks the inventory rows of all products of a visit date with a
+single statement, in id order, so concurrent checkouts for the same date
+wait on each other instead of deadlocking. sale_qty is then incremented in
+the database instead of read and written back. Active holds of other carts
+(agency.ticket.hold) count against availability.
+
+eth.daily.inventory comes from another module. Its capacity column is the
+eth_agency_portal.daily_inventory_capacity_field parameter, else the first
+of total_qty, stock_qty and capacity that exists. Without one, sales are
+still counted but availability is not checked, which is logged when the
+registry loads.
+"""
+import logging
+from odoo import models, api, _
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+
+class AgencyTicketInventory(models.AbstractModel):
+    _name = 'agency.ticket.inventory'
+    _description = 'Agency Ticket Inventory'
+
+    @api.model
+    def reserve(self, visit_date, quantities, check_availability=True, cart_id=None):
+        """Add sold quantities to the confirmed inventory of a visit date.
+
+        ``quantities`` maps product ids to quantities. Products without a
+        confirmed inventory row are not stock-tracked and are skipped. When
+        ``check_availability`` is set and the inventory has a capacity field,
+        nothing is written if any product would exceed it and a UserError
+        is raised. The holds of ``cart_id`` are consumed by the reservation.
+        """
+        quantities = self._clean_quantities(quantities)
+        if not visit_date or not quantities:
+            return {}
+        rows = self._lock_inventory(visit_date, list(quantities), exclude_cart_id=cart_id)
+        if check_availability:
+            self._check_availability(visit_date, rows, quantities)
+        updated = self._shift_sale_qty(rows, quantities, 1)
+        if cart_id:
+            self.env['agency.ticket.hold'].sudo().release_cart_holds(cart_id)
+        return updated
+
+    @api.model
+    def release(self, visit_date, quantities):
+        """Give back quantities previously reserved for a visit date"""
+        quantities = self._clean_quantities(quantities)
+        if not visit_date or not quantities:
+            return {}
+        rows = self._lock_inventory(visit_date, list(quantities))
+        return self._shift_sale_qty(rows, quantities, -1)
+
+    @api.model
+    def release_orders(self, orders):
+        """Give back the tickets of portal orders being cancelled or deleted.
+
+        Portal orders are reserved for their ticket date at checkout and
+        released by sale.order when cancelled, so orders already cancelled
+        gave their tickets back before.
+        """
+        if not self.env['agency.portal.capabilities'].get('sale_ticket_date'):
+            return
+        orders = orders.filtered(lambda o: o.portal_agency_id and o.ticket_date and o.state != 'cancel')
+        for order in orders:
+            quantities = {}
+            for line in order.order_line.filtered(lambda l: not l.display_type and l.product_id):
+                quantities[line.product_id.id] = quantities.get(line.product_id.id, 0) + int(line.product_uom_qty)
+            self.release(order.ticket_date, quantities)
+
+    @api.model
+    def hold(self, cart_id, agency_id, visit_date, quantities, minutes):
+        """Replace the holds of a cart, failing fast when stock is exceeded.
+
+        Locking the inventory rows serializes holds and reservations of the
+        same products, so two carts cannot both hold the last tickets.
+        """
+        quantities = self._clean_quantities(quantities)
+        Hold = self.env['agency.ticket.hold'].sudo()
+        Hold.release_cart_holds(cart_id)
+        if not visit_date or not quantities:
+            return Hold
+        rows = self._lock_inventory(visit_date, list(quantities), exclude_cart_id=cart_id)
+        self._check_availability(visit_date, rows, quantities)
+        return Hold.create_holds(cart_id, agency_id, visit_date, quantities, minutes)
+
+    @api.model
+    def _clean_quantities(self, quantities):
+        return {int(pid): int(qty) for pid, qty in quantities.items() if pid and int(qty or 0) > 0}
+
+    def _lock_inventory(self, visit_date, product_ids, exclude_cart_id=None):
+        """Lock the confirmed inventory rows of the products in id order.
+
+        Returns {product_id: (inventory_id, sale_qty, capacity, held)}, where
+        held is the quantity of active holds of other carts.
+        """
+        capabilities = self.env['agency.portal.capabilities']
+        if not capabilities.get('daily_inventory'):
+            return {}
+        self.env['eth.daily.inventory'].sudo().flush_model(['product_id', 'date', 'state', 'sale_qty'])
+        self.env['agency.ticket.hold'].sudo().flush_model()
+
+        capacity_field = self._get_capacity_field()
+        capacity = f'i."{capacity_field}"' if capacity_field else 'NULL'
+        self.env.cr.execute(f"""
+            SELECT i.id, i.product_id, COALESCE(i.sale_qty, 0), {capacity},
+                   (SELECT COALESCE(sum(h.quantity), 0)
+                      FROM agency_ticket_hold h
+                     WHERE h.product_id = i.product_id
+                       AND h.visit_date = i.date
+                       AND h.expires_at > now() at time zone 'UTC'
+                       AND h.cart_id IS DISTINCT FROM %s)
+              FROM eth_daily_inventory i
+             WHERE i.id IN (
+                    SELECT DISTINCT ON (product_id) id
+                      FROM eth_daily_inventory
+                     WHERE date = %s AND state = 'confirmed' AND product_id = ANY(%s)
+                     ORDER BY product_id, id)
+             ORDER BY i.id
+               FOR UPDATE OF i
+        """, [exclude_cart_id, visit_date, product_ids])
+        return {
+            product_id: (inventory_id, sale_qty, capacity_value, held)
+            for inventory_id, product_id, sale_qty, capacity_value, held in self.env.cr.fetchall()
+        }
+
+    def _get_capacity_field(self):
+        """Capacity column of eth.daily.inventory, or False when availability is not checked"""
+        field_name = self.env['ir.config_parameter'].sudo().get_param(
+            'eth_agency_portal.daily_inventory_capacity_field')
+        if not field_name:
+            return self.env['agency.portal.capabilities'].get('daily_inventory_capacity')
+        field = self.env['eth.daily.inventory']._fields.get(field_name)
+        if not (field and field.store):
+            _logger.warning(f"Configured inventory capacity field {field_name} is not a stored field "
+                            f"of eth.daily.inventory, availability is not checked")
+            return False
+        return field_name
+
+    def _check_availability(self, visit_date, rows, quantities):
+        """Raise a UserError listing the products that would be oversold"""
+        rejected = {
+            product_id: capacity - sale_qty - held
+            for product_id, (_inventory_id, sale_qty, capacity, held) in rows.items()
+            if capacity is not None and sale_qty + held + quantities[product_id] > capacity
+        }
+        if not rejected:
+            return
+        products = self.env['product.product'].sudo().browse(list(rejected))
+        details = ', '.join(
+            f"{product.display_name} ({max(0, int(rejected[product.id]))})" for product in products
+        )
+        raise UserError(_('Not enough tickets available for %(date)s: %(details)s',
+                          date=visit_date, details=details))
+
+    def _shift_sale_qty(self, rows, quantities, sign):
+        """Add the quantities to the locked inventory rows in one statement"""
+        if not rows:
+            return {}
+        inventory_ids = [row[0] for row in rows.values()]
+        self.env.cr.execute("""
+            UPDATE eth_daily_inventory i
+               SET sale_qty = COALESCE(i.sale_qty, 0) + %s * v.qty
+              FROM unnest(%s::int[], %s::int[]) AS v(id, qty)
+             WHERE i.id = v.id
+         RETURNING i.product_id, i.sale_qty
+        """, [sign, inventory_ids, [quantities[product_id] for product_id in rows]])
+        updated = dict(self.env.cr.fetchall())
+
+        # Written in SQL: drop cached values and recompute dependent fields
+        inventories = self.env['eth.daily.inventory'].sudo().browse(inventory_ids)
+        inventories.invalidate_recordset(['sale_qty'])
+        inventories.modified(['sale_qty'])
+        _logger.debug("Inventory %s: %s", 'reserved' if sign > 0 else 'released', updated)
+        return updated
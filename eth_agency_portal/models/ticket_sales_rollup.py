@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Ticket Sales Rollup - Daily ticket sales totals per agency, state and product
+
+Rows with product_id 0 hold order totals (order count, amount_total and
+commission); the other rows hold the quantity and subtotal of the order
+lines of one product. Days are the UTC date of date_order.
+
+Order and order line hooks (see sale_order.py) aggregate the touched orders
+before and after the change and add the difference in the transaction of
+the change. Orders of an agency on the same day update the same rows, so
+the second of two concurrent checkouts fails with a serialization error
+once the first commits; checkout lets it through for Odoo to retry the
+request. Rows are updated in bucket order, so two multi-row updates wait
+on each other instead of deadlocking. A nightly cron rebuilds from scratch the
+days of orders modified since its last successful run, which repairs drift
+from recomputes and SQL writes that bypass the hooks; rebuild() backfills a
+whole range.
+"""
+import logging
+from datetime import timedelta
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+MEASURES = ('order_count', 'quantity', 'amount', 'commission')
+
+# Last successful reconcile; orders written since then have their days rebuilt
+RECONCILED_AT_PARAM = 'eth_agency_portal.rollup_reconciled_at'
+
+# Window of the first reconcile, when no run is recorded yet
+RECONCILE_DAYS = 2
+
+
+class AgencyTicketSalesRollup(models.Model):
+    _name = 'agency.ticket.sales.rollup'
+    _description = 'Agency Ticket Sales Rollup'
+    _order = 'day desc, agency_id, state, product_id'
+    _log_access = False
+
+    agency_id = fields.Many2one('travel.agency', string='Agency', required=True, ondelete='cascade')
+    day = fields.Date(string='Day', required=True)
+    state = fields.Char(string='State', required=True)
+    product_id = fields.Integer(string='Product ID', required=True, default=0)
+    order_count = fields.Integer(string='Orders')
+    quantity = fields.Float(string='Quantity')
+    amount = fields.Float(string='Amount')
+    commission = fields.Float(string='Commission')
+
+    _sql_constraints = [
+        ('bucket_unique', 'unique(agency_id, day, state, product_id)',
+         'A rollup bucket can only exist once.'),
+    ]
+
+    # ==================== Aggregation ====================
+
+    def _aggregate_query(self, where):
+        """Rollup rows of the sale orders matching ``where`` (on alias so)"""
+        SaleOrder = self.env['sale.order']
+        commission_field = SaleOrder._fields.get('commission_amount')
+        commission = 'sum(so.commission_amount)' if (
+            self.env['agency.portal.capabilities'].get('sale_commission_amount') and commission_field.store
+        ) else '0'
+        SaleOrder.flush_model()
+        self.env['sale.order.line'].flush_model()
+        return f"""
+            SELECT so.portal_agency_id, so.date_order::date, so.state, 0,
+                   count(*), 0, COALESCE(sum(so.amount_total), 0), COALESCE({commission}, 0)
+              FROM sale_order so
+             WHERE so.portal_agency_id IS NOT NULL AND {where}
+             GROUP BY 1, 2, 3
+             UNION ALL
+            SELECT so.portal_agency_id, so.date_order::date, so.state, sol.product_id,
+                   0, COALESCE(sum(sol.product_uom_qty), 0), COALESCE(sum(sol.price_subtotal), 0), 0
+              FROM sale_order_line sol
+              JOIN sale_order so ON so.id = sol.order_id
+             WHERE so.portal_agency_id IS NOT NULL AND {where}
+               AND sol.display_type IS NULL AND sol.product_id IS NOT NULL
+             GROUP BY 1, 2, 3, 4
+        """
+
+    @api.model
+    def _snapshot(self, order_ids):
+        """Rollup contribution of orders: {bucket: [order_count, quantity, amount, commission]}"""
+        if not order_ids:
+            return {}
+        self.env.cr.execute(self._aggregate_query('so.id = ANY(%(order_ids)s)'), {'order_ids': list(order_ids)})
+        return {
+            (agency_id, day, state, product_id): [float(value) for value in values]
+            for agency_id, day, state, product_id, *values in self.env.cr.fetchall()
+        }
+
+    @api.model
+    def _apply_delta(self, before, after):
+        """Add the difference between two snapshots to the rollup rows"""
+        rows = []
+        for bucket in sorted(set(before) | set(after)):
+            old = before.get(bucket, [0.0] * len(MEASURES))
+            new = after.get(bucket, [0.0] * len(MEASURES))
+            delta = [n - o for n, o in zip(new, old)]
+            if any(delta):
+                rows.append((*bucket, *delta))
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        self.env.cr.execute("""
+            INSERT INTO agency_ticket_sales_rollup AS r
+                   (agency_id, day, state, product_id, order_count, quantity, amount, commission)
+            SELECT * FROM unnest(%s::int[], %s::date[], %s::varchar[], %s::int[],
+                                 %s::int[], %s::float8[], %s::float8[], %s::float8[])
+            ON CONFLICT (agency_id, day, state, product_id) DO UPDATE
+               SET order_count = r.order_count + EXCLUDED.order_count,
+                   quantity = r.quantity + EXCLUDED.quantity,
+                   amount = r.amount + EXCLUDED.amount,
+                   commission = r.commission + EXCLUDED.commission
+        """, [list(columns[0]), list(columns[1]), list(columns[2]), list(columns[3]),
+              [int(value) for value in columns[4]], list(columns[5]), list(columns[6]), list(columns[7])])
+        self.invalidate_model()
+
+    # ==================== Rebuild ====================
+
+    @api.model
+    def rebuild(self, date_from=None, date_to=None, agency_ids=None):
+        """Recompute the rollup of a day range (all days by default) from the orders.
+
+        Backfill from a shell with env['agency.ticket.sales.rollup'].rebuild().
+        """
+        rollup_conditions, order_conditions, params = ['TRUE'], ['TRUE'], {}
+        if date_from:
+            rollup_conditions.append('day >= %(date_from)s')
+            order_conditions.append('so.date_order::date >= %(date_from)s')
+            params['date_from'] = date_from
+        if date_to:
+            rollup_conditions.append('day <= %(date_to)s')
+            order_conditions.append('so.date_order::date <= %(date_to)s')
+            params['date_to'] = date_to
+        if agency_ids:
+            rollup_conditions.append('agency_id = ANY(%(agency_ids)s)')
+            order_conditions.append('so.portal_agency_id = ANY(%(agency_ids)s)')
+            params['agency_ids'] = list(agency_ids)
+        rollup_where = ' AND '.join(rollup_conditions)
+        order_where = ' AND '.join(order_conditions)
+
+        self.env.cr.execute(f"DELETE FROM agency_ticket_sales_rollup WHERE {rollup_where}", params)
+        self.env.cr.execute(f"""
+            INSERT INTO agency_ticket_sales_rollup
+                   (agency_id, day, state, product_id, order_count, quantity, amount, commission)
+            {self._aggregate_query(order_where)}
+        """, params)
+        count = self.env.cr.rowcount
+        self.invalidate_model()
+        _logger.info(f"Rebuilt {count} ticket sales rollup rows")
+        return count
+
+    @api.model
+    def _rebuild_buckets(self, buckets):
+        """Recompute the rollup of (agency_id, day) pairs from the orders"""
+        if not buckets:
+            return
+        agency_ids, days = map(list, zip(*buckets))
+        params = {'agency_ids': agency_ids, 'days': days}
+        self.env.cr.execute("""
+            DELETE FROM agency_ticket_sales_rollup r
+             USING unnest(%(agency_ids)s::int[], %(days)s::date[]) AS b(agency_id, day)
+             WHERE r.agency_id = b.agency_id AND r.day = b.day
+        """, params)
+        order_where = """(so.portal_agency_id, so.date_order::date) IN (
+            SELECT * FROM unnest(%(agency_ids)s::int[], %(days)s::date[]))"""
+        self.env.cr.execute(f"""
+            INSERT INTO agency_ticket_sales_rollup
+                   (agency_id, day, state, product_id, order_count, quantity, amount, commission)
+            {self._aggregate_query(order_where)}
+        """, params)
+        self.invalidate_model()
+
+    @api.model
+    def _cron_reconcile(self):
+        """Rebuild the days of agency orders modified since the last run (cron)"""
+        ICP = self.env['ir.config_parameter'].sudo()
+        since = fields.Datetime.to_datetime(ICP.get_param(RECONCILED_AT_PARAM)) or (
+            fields.Datetime.now() - timedelta(days=RECONCILE_DAYS))
+        # Transactions still running may commit orders written before now;
+        # the next run starts from the oldest of them (this one included)
+        self.env.cr.execute("""
+            SELECT min(xact_start) AT TIME ZONE 'UTC'
+              FROM pg_stat_activity
+             WHERE datname = current_database() AND xact_start IS NOT NULL
+        """)
+        reconciled_at = self.env.cr.fetchone()[0] or fields.Datetime.now()
+        self.env['sale.order'].flush_model(['portal_agency_id', 'date_order'])
+        self.env.cr.execute("""
+            SELECT DISTINCT portal_agency_id, date_order::date
+              FROM sale_order
+             WHERE portal_agency_id IS NOT NULL AND write_date >= %s
+        """, [since])
+        buckets = self.env.cr.fetchall()
+        self._rebuild_buckets(buckets)
+        # Committed with the rebuild, a failed run is retried from the same point
+        ICP.set_param(RECONCILED_AT_PARAM, fields.Datetime.to_string(reconciled_at.replace(microsecond=0)))
+        _logger.info(f"Reconciled {len(buckets)} ticket sales rollup days modified since {since}")
@@ -6,6 +6,7 @@ import logging
 import json
 import requests
 from odoo import models, api
+from .portal_route_timing import timed
 
 _logger = logging.getLogger(__name__)
 
@@ -23,6 +24,7 @@ class TravelAPIClient(models.AbstractModel):
             'timeout': int(ICP.get_param('eth_agency_portal.api_timeout', '30')),
         }
 
+    @timed('api')
     def _make_request(self, method, endpoint, data=None, agency_token=None):
         """Make HTTP request to Travel API"""
         config = self._get_api_config()
@@ -238,6 +240,7 @@ class TravelAPIClient(models.AbstractModel):
             'api_key': ICP.get_param('eth_ticket.api_key', ''),
         }
 
+    @timed('api')
     def _make_ticket_request(self, method, endpoint, data=None):
         """Make HTTP request to Ticket API"""
         config = self._get_ticket_api_config()
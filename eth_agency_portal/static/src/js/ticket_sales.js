@@ -425,35 +425,22 @@ function deleteLastVisitor(variantId, visitorIndex) {
     console.log('Deleted visitor', variantId, visitorIndex, 'remaining:', visitors);
 }
 
+// Cart changes are applied locally at once and sent to the server in one
+// batch when the user pauses (see flushCartChanges)
+const CART_FLUSH_DELAY = 400;
+let pendingLineOps = new Map(); // variant id -> latest 'set' operation
+let pendingVisitDate = null;
+let cartFlushTimer = null;
+let cartFlushPromise = null;
+
 window.setQuantity = async function(productId, variantId, name, price, quantity, maxStock, ticketProductType = '') {
     quantity = parseInt(quantity) || 0;
 
-    // Prevent concurrent cart updates (session race condition)
-    if (isUpdatingCart) {
-        console.log('setQuantity: Waiting for previous update to complete...');
-        // Wait and retry
-        await new Promise(resolve => setTimeout(resolve, 300));
-        if (isUpdatingCart) {
-            console.log('setQuantity: Still busy, skipping');
-            return;
-        }
-    }
-
-    // Prevent API calls during re-rendering (avoids race condition from onchange events)
+    // Prevent changes during re-rendering (avoids loops from onchange events)
     if (isRendering) {
-        console.log('setQuantity: Skipping - rendering in progress');
         return;
     }
 
-    // Prevent race condition: check if quantity actually changed
-    const currentCartQty = getCartQuantity(variantId);
-    if (quantity === currentCartQty) {
-        console.log('setQuantity: No change for variantId', variantId, '- skipping API call');
-        return;
-    }
-
-    console.log('setQuantity: variantId=', variantId, 'currentCartQty=', currentCartQty, 'newQty=', quantity);
-
     if (quantity > maxStock) {
         quantity = maxStock;
         Swal.fire({
@@ -465,43 +452,159 @@ window.setQuantity = async function(productId, variantId, name, price, quantity,
         });
     }
 
-    const qtyElement = document.getElementById(`qty_${variantId}`);
-    if (qtyElement) qtyElement.textContent = quantity;
+    if (quantity === getCartQuantity(variantId)) {
+        return;
+    }
 
     const visitDate = document.getElementById('visit_date')?.value;
+    if (visitDate && visitDate !== cart.visit_date) {
+        pendingVisitDate = visitDate;
+    }
+
+    const operation = {
+        op: 'set',
+        product_id: productId,
+        variant_id: variantId,
+        product_name: name,
+        quantity: quantity,
+        price: price,
+        ticket_product_type: ticketProductType
+    };
+    pendingLineOps.set(variantId, operation);
+    applyLocalOperation(operation);
+
+    saveToLocalStorage();
+    renderCart();
+    renderProducts();
+
+    scheduleCartFlush();
+};
+
+// Apply a line operation to the local cart, keeping totals in step
+function applyLocalOperation(operation) {
+    if (pendingVisitDate) {
+        cart.visit_date = pendingVisitDate;
+    }
+    cart.lines = cart.lines || [];
+    const line = getCartLine(operation.variant_id);
+    if (line) {
+        cart.total -= line.quantity * line.price;
+        cart.item_count -= line.quantity;
+    }
+    if (operation.quantity <= 0) {
+        cart.lines = cart.lines.filter(l => l !== line);
+        return;
+    }
+    if (line) {
+        line.quantity = operation.quantity;
+        line.price = operation.price;
+        if (operation.ticket_product_type) {
+            line.ticket_product_type = operation.ticket_product_type;
+        }
+    } else {
+        cart.lines.push({
+            product_id: operation.product_id,
+            variant_id: operation.variant_id,
+            product_name: operation.product_name,
+            quantity: operation.quantity,
+            price: operation.price,
+            ticket_product_type: operation.ticket_product_type || ''
+        });
+    }
+    cart.total += operation.quantity * operation.price;
+    cart.item_count += operation.quantity;
+}
+
+function scheduleCartFlush() {
+    clearTimeout(cartFlushTimer);
+    cartFlushTimer = setTimeout(flushCartChanges, CART_FLUSH_DELAY);
+}
+
+function takePendingOperations() {
+    const operations = [];
+    if (pendingVisitDate) {
+        operations.push({ op: 'date', visit_date: pendingVisitDate });
+    }
+    operations.push(...pendingLineOps.values());
+    pendingLineOps = new Map();
+    pendingVisitDate = null;
+    return operations;
+}
+
+// Send pending cart changes; only one batch is in flight at a time
+async function flushCartChanges() {
+    clearTimeout(cartFlushTimer);
+    cartFlushTimer = null;
+    while (cartFlushPromise) {
+        await cartFlushPromise;
+    }
+    const operations = takePendingOperations();
+    if (!operations.length) {
+        return;
+    }
+    cartFlushPromise = sendCartChanges(operations);
+    try {
+        await cartFlushPromise;
+    } finally {
+        cartFlushPromise = null;
+    }
+}
 
-    isUpdatingCart = true; // Lock
+async function sendCartChanges(operations) {
+    isUpdatingCart = true;
     try {
-        // Send current cart state to prevent session race condition
-        const result = await apiCall('/agency/api/tickets/cart/add', {
-            product_id: productId,
-            variant_id: variantId,
-            product_name: name,
-            quantity: quantity,
-            price: price,
-            visit_date: visitDate,
-            ticket_product_type: ticketProductType,
-            current_cart: cart  // Send current frontend cart state
+        const result = await apiCall('/agency/api/tickets/cart/apply', {
+            operations: operations,
+            version: cart.version
         });
 
-        if (result && result.success) {
+        if (result && (result.success || result.conflict)) {
             cart = result.cart;
-            console.log('Cart updated:', cart);
-            // Save to localStorage for F5 persistence
-            saveToLocalStorage();
-            // Don't reload visitors - keep existing ones
-            renderCart();
-            renderProducts();
-            renderVisitors();
+            visitors = result.visitors || visitors;
+            if (result.conflict) {
+                // Cart was changed in another tab: show the server cart
+                pendingLineOps = new Map();
+                pendingVisitDate = null;
+                Swal.fire('Cart Updated', result.error, 'warning');
+            } else {
+                // Keep changes made while this batch was in flight
+                pendingLineOps.forEach(applyLocalOperation);
+            }
         } else {
             console.error('Failed to update cart:', result?.error);
+            await loadCart();
         }
+        saveToLocalStorage();
+        renderCart();
+        renderProducts();
+        renderVisitors();
     } catch (error) {
         console.error('Error updating cart:', error);
     } finally {
-        isUpdatingCart = false; // Unlock
+        isUpdatingCart = false;
     }
-};
+}
+
+// Do not lose a pending batch when leaving the page
+window.addEventListener('pagehide', function() {
+    clearTimeout(cartFlushTimer);
+    const operations = takePendingOperations();
+    if (!operations.length) {
+        return;
+    }
+    fetch('/agency/api/tickets/cart/apply', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        credentials: 'include',
+        keepalive: true,
+        body: JSON.stringify({
+            jsonrpc: '2.0',
+            method: 'call',
+            params: { operations: operations, version: cart.version },
+            id: Date.now()
+        })
+    });
+});
 
 // Cart management
 async function loadCart() {
@@ -582,6 +685,7 @@ window.clearCart = async function() {
     if (!result.isConfirmed) return;
 
     try {
+        await flushCartChanges();
         const apiResult = await apiCall('/agency/api/tickets/cart/clear');
         if (apiResult && apiResult.success) {
             cart = { lines: [], visit_date: null, total: 0, item_count: 0 };
@@ -627,6 +731,7 @@ window.confirmOrder = async function() {
             didOpen: () => Swal.showLoading()
         });
 
+        await flushCartChanges();
         const apiResult = await apiCall('/agency/api/tickets/order/create');
 
         if (apiResult && apiResult.success) {
@@ -791,9 +896,10 @@ window.handleAgencySaveVisitor = async function(event) {
     };
 
     try {
+        await flushCartChanges();
         const result = await apiCall('/agency/api/tickets/visitors/save', {
             visitor_data: visitorData,
-            current_visitors: visitors  // Send current frontend visitors state
+            version: cart.version
         });
 
         if (result && result.success) {
@@ -801,6 +907,10 @@ window.handleAgencySaveVisitor = async function(event) {
             const modal = bootstrap.Modal.getInstance(document.getElementById('visitorFormModal'));
             if (modal) modal.hide();
 
+            if (result.version !== undefined) {
+                cart.version = result.version;
+            }
+
             // Use visitors from response if available, otherwise update locally
             if (result.visitors) {
                 visitors = result.visitors;
@@ -831,6 +941,14 @@ window.handleAgencySaveVisitor = async function(event) {
                 timer: 1500,
                 showConfirmButton: false
             });
+        } else if (result && result.conflict) {
+            // Cart was changed in another tab: reload it before retrying
+            cart = result.cart;
+            visitors = result.visitors || [];
+            saveToLocalStorage();
+            renderCart();
+            renderProducts();
+            Swal.fire('Error', result.error, 'error');
         } else {
             Swal.fire('Error', result?.error || 'Failed to save visitor', 'error');
         }
@@ -856,8 +974,9 @@ window.goToCheckout = async function() {
         line.ticket_product_type === 'adult' || line.ticket_product_type === 'child'
     );
 
-    let missingVisitors = false;
-    for (const line of ticketLines) {
+    // The server counts empty visitor slots; fall back to scanning local visitors
+    let missingVisitors = cart.missing_visitors > 0;
+    for (const line of (missingVisitors ? [] : ticketLines)) {
         const variantId = line.variant_id || line.product_id;
         const quantity = line.quantity;
 
@@ -885,6 +1004,7 @@ window.goToCheckout = async function() {
 
     // Save cart and visitors to session before redirecting
     try {
+        await flushCartChanges();
         const result = await apiCall('/agency/api/tickets/checkout/prepare', {
             cart: cart,
             visitors: visitors
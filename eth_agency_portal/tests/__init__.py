@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+from . import test_ticket_inventory
+from . import test_checkout_request
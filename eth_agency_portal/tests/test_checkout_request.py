@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Checkout Request - Concurrent submissions of the same checkout
+
+Runs on real cursors (not the test cursor of TransactionCase) so that the
+duplicate actually waits on the claim of the first submission.
+"""
+from odoo import api, SUPERUSER_ID
+from odoo.modules.registry import Registry
+from odoo.tests.common import BaseCase, get_db_name, tagged
+from odoo.addons.eth_agency_portal.controllers.base import CONCURRENCY_ERRORS
+from .test_ticket_inventory import ConcurrentCall
+
+CHECKOUT_KEY = 'test-concurrent-checkout'
+
+
+@tagged('post_install', '-at_install')
+class TestCheckoutRequestConcurrency(BaseCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.registry = Registry(get_db_name())
+
+    def setUp(self):
+        super().setUp()
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            partner = env['res.partner'].create({'name': 'Checkout Test Agency', 'is_agency': True})
+            agency = env['travel.agency'].create({
+                'name': 'Checkout Test Agency', 'code': 'CHECKOUT_TEST', 'partner_id': partner.id,
+            })
+            user = env['agency.user'].create({
+                'name': 'Checkout Test User', 'email': 'checkout-test@example.com', 'agency_id': agency.id,
+            })
+            self.partner_id = partner.id
+            self.agency_id = agency.id
+            self.agency_user_id = user.id
+        self.addCleanup(self._remove_records)
+
+    def _remove_records(self):
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env['agency.checkout.request'].search([('key', '=', CHECKOUT_KEY)]).unlink()
+            env['travel.agency'].browse(self.agency_id).unlink()
+            env['res.partner'].browse(self.partner_id).unlink()
+
+    def test_concurrent_duplicate_replays_first_response(self):
+        response = {'success': True, 'order_id': 1, 'order_name': 'S00001'}
+        with self.registry.cursor() as cr1, self.registry.cursor() as cr2:
+            env1 = api.Environment(cr1, SUPERUSER_ID, {})
+            env2 = api.Environment(cr2, SUPERUSER_ID, {})
+
+            # Both submissions started before either one commits
+            cr1.execute("SELECT 1")
+            self.assertIsNone(env2['agency.checkout.request'].get_response(CHECKOUT_KEY, self.agency_user_id))
+
+            first, replayed = env1['agency.checkout.request'].claim(
+                CHECKOUT_KEY, self.agency_user_id, 'bank_transfer')
+            self.assertIsNone(replayed)
+
+            # The duplicate waits on the claim of the first submission
+            second = ConcurrentCall(lambda: env2['agency.checkout.request'].claim(
+                CHECKOUT_KEY, self.agency_user_id, 'bank_transfer'))
+            second.start()
+            second.join(1)
+            self.assertTrue(second.is_alive(), "The duplicate should wait for the first submission")
+
+            first.write({'response': response})
+            cr1.commit()
+            second.join(30)
+            self.assertFalse(second.is_alive())
+
+            # It fails with an error Odoo retries the request on
+            self.assertIsInstance(second.error, CONCURRENCY_ERRORS)
+            cr2.rollback()
+            env2.invalidate_all()
+
+            # The retried request replays the response of the first one
+            self.assertEqual(
+                env2['agency.checkout.request'].get_response(CHECKOUT_KEY, self.agency_user_id), response)
+            cr2.rollback()
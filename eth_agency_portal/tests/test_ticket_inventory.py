@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Ticket Inventory - Concurrent reservations of the last ticket of a day and
+release of the tickets of cancelled agency orders
+
+The concurrency test runs on real cursors (not the test cursor of
+TransactionCase) so that two reservations actually compete for the
+inventory row lock.
+"""
+import threading
+from datetime import date
+from odoo import api, SUPERUSER_ID
+from odoo.exceptions import UserError
+from odoo.modules.registry import Registry
+from odoo.tests.common import BaseCase, TransactionCase, get_db_name, tagged
+from odoo.addons.eth_agency_portal.controllers.base import CONCURRENCY_ERRORS
+
+VISIT_DATE = date(2030, 1, 15)
+
+
+class ConcurrentCall(threading.Thread):
+    """Run a call in another thread, keeping its result or error"""
+
+    def __init__(self, func):
+        super().__init__(daemon=True)
+        self.func = func
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func()
+        except Exception as e:
+            self.error = e
+
+
+@tagged('post_install', '-at_install')
+class TestTicketInventoryConcurrency(BaseCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.registry = Registry(get_db_name())
+
+    def setUp(self):
+        super().setUp()
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            capacity_field = env['agency.ticket.inventory']._get_capacity_field()
+            if not env['agency.portal.capabilities'].get('daily_inventory') or not capacity_field:
+                self.skipTest('eth.daily.inventory with a capacity field is not installed')
+            product = env['product.product'].create({'name': 'Concurrency Test Ticket'})
+            inventory = env['eth.daily.inventory'].create({
+                'product_id': product.id,
+                'date': VISIT_DATE,
+                'state': 'confirmed',
+                'sale_qty': 0,
+                capacity_field: 1,
+            })
+            self.product_id = product.id
+            self.inventory_id = inventory.id
+        self.addCleanup(self._remove_records)
+
+    def _remove_records(self):
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env['eth.daily.inventory'].browse(self.inventory_id).unlink()
+            env['product.product'].browse(self.product_id).unlink()
+
+    def _sale_qty(self):
+        with self.registry.cursor() as cr:
+            cr.execute("SELECT sale_qty FROM eth_daily_inventory WHERE id = %s", [self.inventory_id])
+            return cr.fetchone()[0]
+
+    def test_concurrent_reservations_do_not_oversell(self):
+        quantities = {self.product_id: 1}
+        with self.registry.cursor() as cr1, self.registry.cursor() as cr2:
+            env1 = api.Environment(cr1, SUPERUSER_ID, {})
+            env2 = api.Environment(cr2, SUPERUSER_ID, {})
+
+            # Both checkouts started before either one commits
+            cr1.execute("SELECT 1")
+            cr2.execute("SELECT 1")
+
+            env1['agency.ticket.inventory'].reserve(VISIT_DATE, quantities)
+
+            # The second checkout waits on the row locked by the first one
+            second = ConcurrentCall(lambda: env2['agency.ticket.inventory'].reserve(VISIT_DATE, quantities))
+            second.start()
+            second.join(1)
+            self.assertTrue(second.is_alive(), "The second reservation should wait for the first one")
+
+            cr1.commit()
+            second.join(30)
+            self.assertFalse(second.is_alive())
+
+            # It fails with an error Odoo retries the request on, which the
+            # checkout handlers re-raise
+            self.assertIsInstance(second.error, CONCURRENCY_ERRORS)
+            cr2.rollback()
+            env2.invalidate_all()
+
+            # The retried request finds the day sold out
+            with self.assertRaises(UserError):
+                env2['agency.ticket.inventory'].reserve(VISIT_DATE, quantities)
+            cr2.rollback()
+
+        self.assertEqual(self._sale_qty(), 1)
+
+
+@tagged('post_install', '-at_install')
+class TestTicketInventoryRelease(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        capabilities = self.env['agency.portal.capabilities']
+        capacity_field = self.env['agency.ticket.inventory']._get_capacity_field()
+        if not (capabilities.get('daily_inventory') and capabilities.get('sale_ticket_date') and capacity_field):
+            self.skipTest('eth.daily.inventory with a capacity field or sale.order ticket_date is not installed')
+        self.product = self.env['product.product'].create({'name': 'Release Test Ticket'})
+        self.inventory = self.env['eth.daily.inventory'].create({
+            'product_id': self.product.id,
+            'date': VISIT_DATE,
+            'state': 'confirmed',
+            'sale_qty': 0,
+            capacity_field: 10,
+        })
+        partner = self.env['res.partner'].create({'name': 'Release Test Agency', 'is_agency': True})
+        self.agency = self.env['travel.agency'].create({
+            'name': 'Release Test Agency', 'code': 'RELEASE_TEST', 'partner_id': partner.id,
+        })
+
+    def _create_reserved_order(self, quantity):
+        order = self.env['sale.order'].create({
+            'partner_id': self.agency.partner_id.id,
+            'portal_agency_id': self.agency.id,
+            'ticket_date': VISIT_DATE,
+            'order_line': [(0, 0, {'product_id': self.product.id, 'product_uom_qty': quantity})],
+        })
+        self.env['agency.ticket.inventory'].reserve(VISIT_DATE, {self.product.id: quantity})
+        return order
+
+    def test_cancel_then_delete_releases_once(self):
+        order = self._create_reserved_order(3)
+        self.assertEqual(self.inventory.sale_qty, 3)
+
+        order.action_cancel()
+        self.assertEqual(self.inventory.sale_qty, 0)
+
+        # Cancelled orders gave their tickets back already
+        order.unlink()
+        self.assertEqual(self.inventory.sale_qty, 0)
+
+    def test_delete_draft_releases(self):
+        order = self._create_reserved_order(2)
+        order.unlink()
+        self.assertEqual(self.inventory.sale_qty, 0)
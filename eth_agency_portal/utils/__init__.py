@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 from . import voucher_ocr
 from . import ocr
+from . import cart_trace
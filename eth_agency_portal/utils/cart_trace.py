@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Cart Trace - Sampled debug trace of ticket cart, visitor and checkout operations
+
+Off by default. Set eth_agency_portal.cart_trace_agency_ids to a comma
+separated list of agency ids (or '*' for all agencies) to trace them, and
+optionally eth_agency_portal.cart_trace_sample_rate to a fraction of
+operations to keep. Values passed as callables are only evaluated when the
+trace line is emitted, so an untraced call costs a parameter lookup.
+"""
+import logging
+import random
+
+_logger = logging.getLogger(__name__)
+
+# Parsed agency parameter, keyed by its raw value
+_parsed_agency_ids = {}
+
+
+def _traced_agencies(raw):
+    """Parse the agency parameter: None for all agencies, else a set of ids"""
+    if raw not in _parsed_agency_ids:
+        if raw.strip() == '*':
+            value = None
+        else:
+            value = frozenset(int(part) for part in raw.split(',') if part.strip().isdigit())
+        _parsed_agency_ids[raw] = value
+    return _parsed_agency_ids[raw]
+
+
+def is_cart_trace_enabled(env, agency_id):
+    """Check whether operations of an agency are traced"""
+    if not _logger.isEnabledFor(logging.INFO):
+        return False
+    ICP = env['ir.config_parameter'].sudo()
+    raw = ICP.get_param('eth_agency_portal.cart_trace_agency_ids')
+    if not raw:
+        return False
+    agencies = _traced_agencies(raw)
+    if agencies is not None and agency_id not in agencies:
+        return False
+    sample_rate = float(ICP.get_param('eth_agency_portal.cart_trace_sample_rate', '1') or 0)
+    return sample_rate >= 1 or random.random() < sample_rate
+
+
+def cart_trace(cart, event, **values):
+    """Trace a cart operation as 'event key=value ...'.
+
+    ``cart`` is an agency.ticket.cart record; callable values are evaluated lazily.
+    """
+    if not cart or not is_cart_trace_enabled(cart.env, cart.agency_id.id):
+        return
+    fields = [f"agency={cart.agency_id.id}", f"cart={cart.id}"]
+    for key in sorted(values):
+        value = values[key]
+        if callable(value):
+            value = value()
+        fields.append(f"{key}={value!r}")
+    _logger.info("%s %s", event, ' '.join(fields))